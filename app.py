@@ -10,9 +10,13 @@ import logging
 import datetime as dt
 import requests
 import re
+import json
 import math
 import threading
 import gc
+import hashlib
+import sqlite3
+import calendar as _cal
 from typing import Dict, List, Optional, Tuple
 
 # ลด malloc heap fragmentation ป้องกัน "double linked list corrupted"
@@ -24,7 +28,7 @@ import altair as alt
 import streamlit as st
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload, MediaFileUpload
 from googleapiclient.errors import HttpError
 import ssl
 
@@ -497,6 +501,7 @@ warnings.filterwarnings("ignore", message=".*dayfirst.*")
 st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+PARQUET_MIME = "application/vnd.apache.parquet"
 
 if "gcp_service_account" not in st.secrets:
     st.error("❌ ไม่พบ gcp_service_account ใน secrets.toml"); st.stop()
@@ -528,11 +533,22 @@ FILE_ATTEND="attendance_report.xlsx"; FILE_LEAVE="leave_report.xlsx"; FILE_TRAVE
 FILE_STAFF="staff_master.xlsx"; FILE_NOTIFY="activity_log.xlsx"; FILE_HOLIDAYS="special_holidays.xlsx"; FILE_MANUAL_SCAN="manual_scan.xlsx"
 FOLDER_ID="1YFJZvs59ahRHmlRrKcQwepWJz6A-4B7d"; ATTACHMENT_FOLDER_NAME="Attachments_Leave_App"; BACKUP_FOLDER_NAME="Backup"
 STAFF_MASTER_COLS=["ชื่อ-สกุล","กลุ่มงาน","ตำแหน่ง","ประเภทบุคลากร","วันเริ่มงาน","สถานะ"]
+STAFF_ALIAS_COL="ชื่อเรียกอื่น"  # (ไม่บังคับ) ชื่อในเครื่องสแกน/สะกดแบบอื่น คั่นด้วย ,
+STAFF_NAME_COL="_name"   # ชื่อมาตรฐานจากทะเบียน (คอลัมน์ ชื่อ-สกุล คงค่าดิบตามไฟล์)
+DERIVED_COLS: List[str]=["staff_id",STAFF_NAME_COL,"_ym","_fy","_wd","_day"]  # คอลัมน์ที่คำนวณตอนโหลด — ไม่เขียนกลับลง Drive
 MANUAL_SCAN_COLS=["ชื่อ-สกุล","วันที่","เวลาเข้า","เวลาออก","หมายเหตุ"]
+MANUAL_SCAN_STORE_COLS=MANUAL_SCAN_COLS+["_op","_ts"]; MANUAL_OP_ADD="add"; MANUAL_OP_DEL="del"
 ACTIVITY_LOG_COLS=["Timestamp","ประเภท","รายละเอียด","ผู้เกี่ยวข้อง"]
 HOLIDAY_COLS=["วันที่","ชื่อวันหยุด","ประเภท","หมายเหตุ"]
 TRAVEL_REQUIRED_COLS=["ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด","เรื่อง/กิจกรรม"]
+TRAVEL_COMPANION_COL="ผู้ร่วมเดินทาง"
+TRAVEL_PARTICIPANT_COLS=["trip_id","staff_id","ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด","เรื่อง/กิจกรรม"]
 _NON_TRAVEL_FILES={FILE_ATTEND,FILE_LEAVE,FILE_STAFF,FILE_NOTIFY,FILE_HOLIDAYS,FILE_MANUAL_SCAN}
+LOCAL_CACHE_DIR=os.environ.get("LEAVE_APP_CACHE_DIR",os.path.join(os.path.dirname(os.path.abspath(__file__)),".leave_cache"))
+TRAVEL_MANIFEST_PATH=os.path.join(LOCAL_CACHE_DIR,"travel_manifest.pkl"); _TRAVEL_MANIFEST_VERSION=1
+ACTIVITY_SPOOL_PATH=os.path.join(LOCAL_CACHE_DIR,"activity_spool.jsonl")   # event ที่ยังไม่ขึ้น Drive (รอด restart)
+ATTACHMENT_SPOOL_DIR=os.path.join(LOCAL_CACHE_DIR,"attachments")   # PDF ที่รออัปโหลด + งาน .json (รอด restart)
+LOCAL_STORE_PATH=os.path.join(LOCAL_CACHE_DIR,f"hr_store.{os.getpid()}.sqlite3")   # SQLite mirror ของ snapshot ต่อ process — token เวอร์ชันนับต่อ process จึงใช้ไฟล์ร่วมกันไม่ได้ (Drive ยังเป็นต้นฉบับ)
 
 # ===========================
 # 🔒 Drive Thread-Safety
@@ -678,17 +694,29 @@ def _drive_execute(request, retries: int = 2):
     logger.error("Drive circuit opened — will reset in %.0fs", _DRIVE_CIRCUIT_TIMEOUT)
     raise last_exc or RuntimeError("Drive API: max retries exceeded")
 
-def get_file_id(filename: str, parent_id: str = FOLDER_ID) -> Optional[str]:
+def get_file_meta(filename: str, parent_id: str = FOLDER_ID, sidecar: bool = False) -> Optional[dict]:
+    """
+    {id, name, modifiedTime} ของไฟล์ล่าสุดตามชื่อ (ไฟล์ชื่อซ้ำที่เก่ากว่าถูกลบ)
+    sidecar=True → list ไฟล์ parquet คู่กันใน request เดียวกัน → meta["sidecar"] (None ถ้าไม่มี)
+    """
+    names = [filename] + ([_sidecar_name(filename)] if sidecar else [])
+    q_names = " or ".join(f"name='{n}'" for n in names)
     try:
-        res = _drive_execute(lambda: get_drive_service().files().list(q=f"name='{filename}' and '{parent_id}' in parents and trashed=false", fields="files(id,modifiedTime)", orderBy="modifiedTime desc", supportsAllDrives=True, includeItemsFromAllDrives=True))
-        files = res.get("files", [])
-        if not files: return None
-        keep_id = files[0]["id"]
-        for dup in files[1:]:
-            try: _drive_execute(lambda: get_drive_service().files().delete(fileId=dup["id"], supportsAllDrives=True))
-            except Exception: pass
-        return keep_id
-    except Exception as e: logger.error(f"get_file_id({filename}): {e}"); return None
+        res = _drive_execute(lambda: get_drive_service().files().list(q=f"({q_names}) and '{parent_id}' in parents and trashed=false", fields="files(id,name,modifiedTime,appProperties)", orderBy="modifiedTime desc", supportsAllDrives=True, includeItemsFromAllDrives=True))
+        by_name: Dict[str, List[dict]] = {}
+        for f in res.get("files", []): by_name.setdefault(f.get("name", filename), []).append(f)
+        for group in by_name.values():
+            for dup in group[1:]:
+                try: _drive_execute(lambda: get_drive_service().files().delete(fileId=dup["id"], supportsAllDrives=True))
+                except Exception: pass
+        if filename not in by_name: return None
+        meta = by_name[filename][0]
+        return {**meta, "sidecar": by_name.get(names[-1], [None])[0]} if sidecar else meta
+    except Exception as e: logger.error(f"get_file_meta({filename}): {e}"); return None
+
+def get_file_id(filename: str, parent_id: str = FOLDER_ID) -> Optional[str]:
+    meta = get_file_meta(filename, parent_id)
+    return meta["id"] if meta else None
 
 def get_or_create_folder(folder_name: str, parent_id: str) -> Optional[str]:
     try:
@@ -700,116 +728,554 @@ def get_or_create_folder(folder_name: str, parent_id: str) -> Optional[str]:
         return new.get("id")
     except Exception as e: logger.error(f"get_or_create_folder: {e}"); return None
 
+def _download_bytes(file_id: str, revision_id: Optional[str] = None) -> io.BytesIO:
+    svc = get_drive_service()
+    req = svc.revisions().get_media(fileId=file_id, revisionId=revision_id) if revision_id \
+          else svc.files().get_media(fileId=file_id, supportsAllDrives=True)
+    fh = io.BytesIO(); dl = MediaIoBaseDownload(fh, req); done = False
+    while not done: _, done = dl.next_chunk()
+    fh.seek(0); return fh
+
+def _download_excel(file_id: str) -> pd.DataFrame:
+    return pd.read_excel(_download_bytes(file_id), engine="openpyxl")
+
 @st.cache_data(ttl=900, show_spinner=False)
 def _read_file_by_id(file_id: str) -> pd.DataFrame:
-    try:
-        svc = get_drive_service()
-        req = svc.files().get_media(fileId=file_id, supportsAllDrives=True)
-        fh = io.BytesIO(); dl = MediaIoBaseDownload(fh, req); done = False
-        while not done: _, done = dl.next_chunk()
-        fh.seek(0); return pd.read_excel(fh, engine="openpyxl")
+    try: return _download_excel(file_id)
     except Exception as e: logger.warning(f"_read_file_by_id({file_id}): {e}"); return pd.DataFrame()
 
+@st.cache_data(max_entries=256, show_spinner=False)
+def _read_file_version(file_id: str, modified_time: str, fmt: str = "xlsx") -> pd.DataFrame:
+    """อ่านไฟล์ตามเวอร์ชัน (id + modifiedTime จากการ list) — ไฟล์ไม่เปลี่ยนใช้ cache ได้ไม่จำกัดเวลา; fmt="parquet" → sidecar"""
+    try: return pd.read_parquet(_download_bytes(file_id), engine="pyarrow") if fmt == "parquet" else _download_excel(file_id)
+    except Exception as e: logger.warning(f"_read_file_version({file_id}): {e}"); return pd.DataFrame()
+
+# ---------------------------
+# 🧱 Parquet sidecar (ไฟล์ที่แอปเขียนเองเท่านั้น)
+# ---------------------------
+# xlsx ยังเป็นต้นฉบับที่คนเปิดแก้ได้ — sidecar จด modifiedTime ของ xlsx ที่มันถอดมา (appProperties)
+# ตรงกัน → อ่าน parquet (ไม่ต้อง parse openpyxl, ไฟล์เล็กกว่า); ไม่ตรง (มีคนแก้ xlsx ตรง ๆ) → อ่าน xlsx ตามเดิม
+SIDECAR_SRC_PROP = "src_modified"
+PARQUET_SIDECAR_FILES = {FILE_LEAVE, FILE_TRAVEL, FILE_MANUAL_SCAN}
+
+def _sidecar_name(filename: str) -> str:
+    return os.path.splitext(filename)[0] + ".parquet"
+
+def _wants_sidecar(filename: str) -> bool:
+    """ไฟล์ที่แอปเขียนเป็นหลัก: leave / travel / manual scan + คลังปีงบ + ไฟล์เดือนของคลัง activity log"""
+    return (filename in PARQUET_SIDECAR_FILES or bool(re.search(r"_FY\d{4}\.xlsx$", filename))
+            or (filename.startswith("activity_log_") and filename != ACTIVITY_INDEX_FILE))
+
+def _parquet_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """ชื่อคอลัมน์เป็น str + คอลัมน์ object ที่ปนหลายชนิด (เช่น วันที่ปนข้อความ) → ข้อความ ให้ pyarrow เขียนได้"""
+    out = df.copy(); out.columns = [str(c) for c in out.columns]
+    for col in out.columns:
+        if out[col].dtype == object and out[col].dropna().map(type).nunique() > 1:
+            out[col] = out[col].where(out[col].isna(), out[col].astype(str))
+    return out
+
+def write_parquet_to_drive(name: str, df: pd.DataFrame, parent_id: str = FOLDER_ID, known_file_id: Optional[str] = None,
+                           app_properties: Optional[Dict[str, str]] = None) -> dict:
+    """อัปโหลดตารางเป็น parquet (zstd) สร้าง/เขียนทับตามชื่อ → {id, modifiedTime} (error โยนต่อให้ผู้เรียก)"""
+    buf = io.BytesIO(); _parquet_safe(df).to_parquet(buf, engine="pyarrow", compression="zstd", index=False)
+    buf.seek(0); media = MediaIoBaseUpload(buf, mimetype=PARQUET_MIME, resumable=False)
+    body = {"appProperties": app_properties} if app_properties else {}
+    fid = known_file_id or get_file_id(name, parent_id)
+    if fid: return _drive_execute(lambda: get_drive_service().files().update(fileId=fid, body=body, media_body=media, supportsAllDrives=True, fields="id,modifiedTime")) or {}
+    return _drive_execute(lambda: get_drive_service().files().create(body={**body, "name": name, "parents": [parent_id]}, media_body=media, supportsAllDrives=True, fields="id,modifiedTime")) or {}
+
+def write_parquet_sidecar(filename: str, df: pd.DataFrame, src_modified: Optional[str], parent_id: str = FOLDER_ID,
+                          sidecar_id: Optional[str] = None) -> bool:
+    """เขียน <ชื่อไฟล์>.parquet (zstd) คู่กับ xlsx ที่เพิ่งเขียน — ล้มเหลวไม่เป็นไร ผู้อ่านกลับไปใช้ xlsx เอง"""
+    if not src_modified: return False
+    name = _sidecar_name(filename)
+    try:
+        write_parquet_to_drive(name, df, parent_id, sidecar_id, {SIDECAR_SRC_PROP: src_modified})
+        return True
+    except Exception as e:
+        logger.warning("write_parquet_sidecar(%s): %s", name, e); return False
+
+def read_file_meta(meta: dict, sidecar: Optional[dict] = None) -> pd.DataFrame:
+    """อ่านไฟล์ตาม meta — sidecar ที่ src_modified ตรงกับ modifiedTime ของ xlsx มาก่อน (อ่านไม่ได้/ว่าง → xlsx)"""
+    if sidecar and (sidecar.get("appProperties") or {}).get(SIDECAR_SRC_PROP) == meta.get("modifiedTime"):
+        df = _read_file_version(sidecar["id"], sidecar.get("modifiedTime", ""), "parquet")
+        if not df.empty: return df
+    return _read_file_version(meta["id"], meta.get("modifiedTime", ""))
+
 @st.cache_data(ttl=900)
 def read_excel_from_drive(filename: str) -> pd.DataFrame:
     fid = get_file_id(filename)
     if not fid: return pd.DataFrame()
     return _read_file_by_id(fid)
 
+def read_excel_versioned(filename: str, parent_id: str = FOLDER_ID) -> Tuple[pd.DataFrame, Optional[str], Optional[str]]:
+    """(ข้อมูล, file id, modifiedTime ของข้อมูลชุดนั้น) — เวอร์ชันตรงกับข้อมูลเสมอ ใช้เป็น base_version ตอนเขียนกลับ"""
+    meta = get_file_meta(filename, parent_id, sidecar=_wants_sidecar(filename))
+    if not meta: return pd.DataFrame(), None, None
+    return read_file_meta(meta, meta.get("sidecar")), meta["id"], meta.get("modifiedTime")
+
 def read_excel_with_id(filename: str) -> Tuple[pd.DataFrame, Optional[str]]:
-    fid = get_file_id(filename)
-    if not fid: return pd.DataFrame(), None
-    return _read_file_by_id(fid), fid
-
-def read_excel_with_backup(filename: str, dedup_cols: Optional[List[str]] = None) -> Tuple[pd.DataFrame, Optional[str]]:
-    frames: List[pd.DataFrame] = []
-    df_main, main_fid = read_excel_with_id(filename)
-    if not df_main.empty: df_main["_src"]="main"; frames.append(df_main)
-    bak_name = f"BAK_{filename}"
-    try:
-        backup_root = get_or_create_folder(BACKUP_FOLDER_NAME, FOLDER_ID)
-        if backup_root:
-            bak_sub = get_or_create_folder(bak_name, backup_root)
-            if bak_sub:
-                bak_fid = get_file_id(bak_name, bak_sub)
-                if bak_fid:
-                    df_bak = _read_file_by_id(bak_fid)
-                    if not df_bak.empty: df_bak["_src"]="backup"; frames.append(df_bak)
-    except Exception as e: logger.warning(f"Backup read failed '{filename}': {e}")
-    if not frames: return pd.DataFrame(), main_fid
-    df_all = pd.concat(frames, ignore_index=True)
-    if dedup_cols:
-        df_all["_src_order"] = df_all["_src"].map({"main":0,"backup":1})
-        df_all = df_all.sort_values("_src_order").drop_duplicates(subset=dedup_cols, keep="first").drop(columns=["_src_order"], errors="ignore")
-    return df_all.drop(columns=["_src"], errors="ignore").reset_index(drop=True), main_fid
-
-def write_excel_to_drive(filename: str, df: pd.DataFrame, known_file_id: Optional[str] = None) -> bool:
+    df, fid, _ = read_excel_versioned(filename)
+    return df, fid
+
+def read_excel_dedup(filename: str, dedup_cols: Optional[List[str]] = None) -> Tuple[pd.DataFrame, Optional[str], Optional[str]]:
+    """ไฟล์หลัก (แถวซ้ำตาม dedup_cols เก็บแถวแรก) → (ข้อมูล, file id, เวอร์ชัน)
+    [Rev] ไม่รวม BAK_ อีกแล้ว — สำรองด้วย revision ของไฟล์เอง (โฟลเดอร์ Backup/BAK_* เดิมถูกปล่อยไว้เฉย ๆ)"""
+    df, fid, ver = read_excel_versioned(filename)
+    if df.empty: return pd.DataFrame(), fid, ver
+    cols = [c for c in (dedup_cols or []) if c in df.columns]
+    if cols: df = df.drop_duplicates(subset=cols, keep="first")
+    return df.reset_index(drop=True), fid, ver
+
+# ---------------------------
+# 🔐 Optimistic concurrency (versioned writes)
+# ---------------------------
+_WRITE_CONFLICT_RETRIES = 3
+
+@st.cache_resource(show_spinner=False)
+def _write_metrics() -> dict:
+    """ตัวนับระดับ process: เขียนสำเร็จ / ชนกับผู้อื่น / แถวที่ merge ให้ / ยกเลิกเพราะ merge ไม่ได้"""
+    return {"lock": threading.Lock(), "writes": 0, "conflicts": 0, "merged_rows": 0, "aborted": 0, "by_file": {}}
+
+def _count_write(key: str, filename: str = "", n: int = 1) -> None:
+    m = _write_metrics()
+    with m["lock"]:
+        m[key] += n
+        if key == "conflicts": m["by_file"][filename] = m["by_file"].get(filename, 0) + n
+
+def _read_version_key(filename: str) -> str:
+    """key ใน snapshot: modifiedTime ของไฟล์ตอนโหลด dataset (base_version ของการเขียนจาก cache)"""
+    return f"_ver::{filename}"
+
+def _row_keys(df: pd.DataFrame, cols: List[str]) -> pd.MultiIndex:
+    parts = {c: (df[c].dt.strftime("%Y-%m-%d %H:%M:%S") if pd.api.types.is_datetime64_any_dtype(df[c])
+                 else df[c].astype(str).str.strip()) for c in cols}
+    return pd.MultiIndex.from_frame(pd.DataFrame(parts))
+
+def merge_appended_rows(df_ours: pd.DataFrame, df_remote: pd.DataFrame, key: List[str]) -> Tuple[pd.DataFrame, int]:
+    """แถวในเวอร์ชันใหม่บน Drive ที่ key ไม่อยู่ในข้อมูลเรา (ผู้อื่นเพิ่มระหว่างนั้น) → ต่อท้าย; แถวที่ key ซ้ำใช้ของเรา"""
+    cols = [c for c in key if c in df_ours.columns and c in df_remote.columns]
+    if not cols or df_remote.empty: return df_ours, 0
+    df_remote = df_remote.drop(columns=[c for c in DERIVED_COLS if c in df_remote.columns])
+    extra = df_remote[~_row_keys(df_remote, cols).isin(_row_keys(df_ours, cols))]
+    if extra.empty: return df_ours, 0
+    return pd.concat([df_ours, extra], ignore_index=True), len(extra)
+
+def write_excel_to_drive(filename: str, df: pd.DataFrame, known_file_id: Optional[str] = None,
+                         write_through: bool = False, parent_id: str = FOLDER_ID,
+                         base_version: Optional[str] = None, merge_key: Optional[List[str]] = None,
+                         sidecar: Optional[bool] = None) -> bool:
+    """
+    เขียนทับไฟล์ใน Drive แล้วจด modifiedTime ที่ได้กลับมา (เวอร์ชันของเราเอง ไม่นับเป็นการเปลี่ยนจากภายนอก)
+    write_through=True → ผู้เรียกอัปเดต session cache เอง (cache_apply_rows/cache_replace_dataset) ไม่ต้องโหลดไฟล์ซ้ำ
+    parent_id: โฟลเดอร์ของไฟล์ (ไฟล์ในโฟลเดอร์ย่อยไม่ใช่ dataset ใน cache → ส่ง write_through=True)
+    [OCC] base_version: modifiedTime ของไฟล์ตอนอ่านข้อมูลชุดนี้ — ไฟล์ถูกแก้หลังจากนั้น (conflict):
+      merge_key → ดึงเวอร์ชันใหม่ ต่อแถวที่ผู้อื่นเพิ่มเข้ามา แล้วตรวจ/เขียนใหม่ (สูงสุด _WRITE_CONFLICT_RETRIES รอบ)
+      ไม่มี merge_key (เช่น การลบ) → ไม่เขียนทับ ให้ผู้ใช้โหลดใหม่
+    Drive ไม่มีเงื่อนไข If-Match ตอน update → ยังมีช่วงแคบระหว่างตรวจกับอัปโหลด
+    sidecar: เขียน parquet คู่กันด้วย (ค่าเริ่มต้น: ไฟล์ใน PARQUET_SIDECAR_FILES / ไฟล์เดือนของ activity log)
+    """
     try:
+        df = df.drop(columns=[c for c in DERIVED_COLS if c in df.columns])
+        fid = known_file_id or get_file_id(filename, parent_id)
+        merged = 0
+        for attempt in range(_WRITE_CONFLICT_RETRIES + 1):
+            if not (fid and base_version): break
+            cur = (_drive_execute(lambda: get_drive_service().files().get(fileId=fid, fields="modifiedTime,headRevisionId", supportsAllDrives=True)) or {}).get("modifiedTime")
+            if cur == base_version: break
+            _count_write("conflicts", filename)
+            logger.warning("write conflict %s: base=%s remote=%s (attempt %d)", filename, base_version, cur, attempt + 1)
+            if not merge_key or attempt == _WRITE_CONFLICT_RETRIES:
+                _count_write("aborted")
+                st.error(f"❌ {filename} ถูกแก้ไขโดยผู้ใช้อื่นหลังจากโหลดข้อมูล — กด 🔄 โหลดข้อมูลใหม่ แล้วบันทึกอีกครั้ง")
+                _invalidate_cache(FILE_DATASETS.get(filename, ()))
+                return False
+            df, n = merge_appended_rows(df, _download_excel(fid), merge_key)
+            merged += n; base_version = cur
         buf = io.BytesIO()
         with pd.ExcelWriter(buf, engine="xlsxwriter") as w: df.to_excel(w, index=False)
         buf.seek(0); media = MediaIoBaseUpload(buf, mimetype=EXCEL_MIME, resumable=False)
-        svc = get_drive_service(); fid = known_file_id or get_file_id(filename)
-        if fid: _drive_execute(lambda: get_drive_service().files().update(fileId=fid, media_body=media, supportsAllDrives=True))
-        else: _drive_execute(lambda: get_drive_service().files().create(body={"name":filename,"parents":[FOLDER_ID]}, media_body=media, supportsAllDrives=True, fields="id"))
+        if fid: res = _drive_execute(lambda: get_drive_service().files().update(fileId=fid, media_body=media, supportsAllDrives=True, fields="id,modifiedTime"))
+        else: res = _drive_execute(lambda: get_drive_service().files().create(body={"name":filename,"parents":[parent_id]}, media_body=media, supportsAllDrives=True, fields="id,modifiedTime"))
+        want_sidecar = _wants_sidecar(filename) if sidecar is None else sidecar
+        if want_sidecar:
+            write_parquet_sidecar(filename, df, (res or {}).get("modifiedTime"), parent_id)
+        # merge แถวของผู้อื่นมาแล้ว → cache ของเรายังไม่มีแถวเหล่านั้น: ไม่เลื่อน base_version + โหลด dataset ใหม่
+        _note_remote_version(filename, (res or {}).get("modifiedTime"), read_version=not merged)
+        _count_write("writes")
+        if merged:
+            _count_write("merged_rows", n=merged)
+            st.info(f"🔀 รวม {merged} แถวที่ผู้ใช้อื่นบันทึกพร้อมกันเข้า {filename} แล้ว")
+            _invalidate_cache(FILE_DATASETS.get(filename, ()))
         # ⚡ ล้างเฉพาะ @st.cache_data ของไฟล์นั้น ไม่ล้างทั้งหมด
         read_excel_from_drive.clear(filename)
-        _invalidate_cache()  # บังคับโหลด session cache ใหม่รอบต่อไป
+        if fid: _read_file_by_id.clear(fid)
+        if not write_through:
+            _invalidate_cache(FILE_DATASETS.get(filename))  # โหลดใหม่เฉพาะ dataset ของไฟล์นี้ (ไม่รู้จัก → ทั้งหมด)
         return True
     except Exception as e:
         logger.error("write_excel_to_drive(%s): %s", filename, e)
         st.error(f"บันทึกไฟล์ล้มเหลว: {e}")
         return False
 
-def backup_excel(filename: str, df: pd.DataFrame) -> None:
-    """
-    สำรองไฟล์ — รันหลัง write เสร็จแล้ว (synchronous แต่ silent)
-    ไม่ใช้ background thread เพราะ thread แยกใช้ httplib2 connection
-    ร่วมกับ main thread ทำให้เกิด heap corruption
-    """
-    if df.empty:
-        return
+# ---------------------------
+# 🕰️ Revision backups (Drive file revisions)
+# ---------------------------
+# [Rev] ทุก files().update สร้าง revision ใหม่ให้เองอยู่แล้ว → การบันทึกปกติไม่มี call สำรองเพิ่ม
+# Drive ลบ revision ของไฟล์ binary ที่ไม่ keepForever หลัง ~30 วัน/100 รุ่น → worker ปัก keepForever วันละรุ่น
+# + ก่อนเขียนทับแบบเสี่ยง (รวม delta / ย้ายปีงบ / ตัดเดือนสแกน / admin อัปโหลดทับ) — เก็บรุ่นที่ปักไว้ล่าสุด _REVISION_KEEP_MAX รุ่น
+REVISION_BACKUP_FILES: Tuple[str, ...] = (FILE_LEAVE, FILE_TRAVEL, FILE_ATTEND, FILE_STAFF, FILE_MANUAL_SCAN, FILE_HOLIDAYS)
+_REVISION_PIN_INTERVAL_SEC = 24 * 3600
+_REVISION_KEEP_MAX         = 60      # Drive ให้ keepForever ได้ไม่เกิน 200 รุ่นต่อไฟล์
+
+@st.cache_resource(show_spinner=False)
+def _revision_state() -> dict:
+    """เวลาที่ตรวจ/ปัก revision ล่าสุดของแต่ละไฟล์ (ระดับ process)"""
+    return {"lock": threading.Lock(), "checked": {}}
+
+def list_revisions(file_id: str) -> List[dict]:
+    """revision ทั้งหมดของไฟล์ เก่า → ใหม่"""
+    revs: List[dict] = []; token = None
+    while True:
+        res = _drive_execute(lambda: get_drive_service().revisions().list(
+            fileId=file_id, pageSize=1000, pageToken=token,
+            fields="nextPageToken,revisions(id,modifiedTime,keepForever,size,lastModifyingUser/displayName)")) or {}
+        revs.extend(res.get("revisions", [])); token = res.get("nextPageToken")
+        if not token: return revs
+
+def _set_keep_forever(file_id: str, revision_id: str, keep: bool) -> None:
+    _drive_execute(lambda: get_drive_service().revisions().update(
+        fileId=file_id, revisionId=revision_id, body={"keepForever": keep}, fields="id"))
+
+def pin_revision(filename: str, file_id: Optional[str] = None) -> Optional[str]:
+    """ปัก keepForever ให้รุ่นปัจจุบันของไฟล์ (ก่อนเขียนทับแบบเสี่ยง) → revision id / None ถ้าไม่สำเร็จ (ไม่ขวางงานหลัก)"""
     try:
-        fid = get_file_id(filename)
-        if not fid:
-            return
-        bak_name    = f"BAK_{filename}"
-        backup_root = get_or_create_folder(BACKUP_FOLDER_NAME, FOLDER_ID)
-        if not backup_root:
-            return
-        bak_sub = get_or_create_folder(bak_name, backup_root)
-        if not bak_sub:
-            return
-        existing = get_file_id(bak_name, bak_sub)
-        if existing:
+        fid = file_id or get_file_id(filename)
+        if not fid: return None
+        head = (_drive_execute(lambda: get_drive_service().files().get(fileId=fid, fields="headRevisionId", supportsAllDrives=True)) or {}).get("headRevisionId")
+        if head: _set_keep_forever(fid, head, True)
+        return head
+    except Exception as e:
+        logger.warning("pin_revision(%s): %s", filename, e); return None
+
+def apply_revision_retention(file_id: str, revs: List[dict]) -> int:
+    """ปลด keepForever รุ่นที่ปักไว้เกิน _REVISION_KEEP_MAX (เก่าสุดก่อน) → จำนวนรุ่นที่ปลด"""
+    pinned = [r for r in revs if r.get("keepForever")]
+    drop = pinned[:max(0, len(pinned) - _REVISION_KEEP_MAX)]
+    for r in drop: _set_keep_forever(file_id, r["id"], False)
+    return len(drop)
+
+def pin_due_revisions() -> None:
+    """รอบปัก revision (worker เบื้องหลัง): ไฟล์ละครั้งต่อ _REVISION_PIN_INTERVAL_SEC — มีรุ่นที่ปักไว้ใหม่พอแล้วก็ข้าม"""
+    state = _revision_state()
+    if not state["lock"].acquire(blocking=False): return
+    try:
+        now = time.time()
+        for filename in REVISION_BACKUP_FILES:
+            if now - state["checked"].get(filename, 0) < _REVISION_PIN_INTERVAL_SEC: continue
             try:
-                _drive_execute(lambda: get_drive_service().files().delete(
-                    fileId=existing, supportsAllDrives=True))
-            except Exception:
-                pass
-        _drive_execute(lambda: get_drive_service().files().copy(
-            fileId=fid,
-            body={"name": bak_name, "parents": [bak_sub]},
-            supportsAllDrives=True,
-        ))
-        logger.info("backup_excel: %s → BAK สำเร็จ", filename)
+                fid = get_file_id(filename)
+                revs = list_revisions(fid) if fid else []
+                if revs:
+                    last_pin = max((pd.Timestamp(r["modifiedTime"]) for r in revs if r.get("keepForever") and r.get("modifiedTime")), default=None)
+                    if not revs[-1].get("keepForever") and (last_pin is None or (pd.Timestamp.now(tz="UTC") - last_pin).total_seconds() >= _REVISION_PIN_INTERVAL_SEC):
+                        _set_keep_forever(fid, revs[-1]["id"], True); revs[-1]["keepForever"] = True
+                    apply_revision_retention(fid, revs)
+                state["checked"][filename] = now
+            except Exception as e:
+                logger.warning("pin_due_revisions(%s): %s", filename, e)
+    finally:
+        state["lock"].release()
+
+def read_revision(file_id: str, revision_id: str) -> pd.DataFrame:
+    try: return pd.read_excel(_download_bytes(file_id, revision_id), engine="openpyxl")
+    except Exception as e: logger.error("read_revision(%s@%s): %s", file_id, revision_id, e); return pd.DataFrame()
+
+def prepare_overwrite(filename: str, file_id: str, seen_version: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """
+    ก่อนเขียนทับทั้งไฟล์ (admin อัปโหลด / ย้อนเวอร์ชัน) → (ทำต่อได้, base_version สำหรับเขียนทับ)
+    ไฟล์ต้องยังเป็นรุ่นที่ admin เห็น → รวม delta ที่ค้างเข้าไฟล์หลักก่อน (รุ่นที่ปักไว้มีแถวครบ ไม่ทิ้งแถวที่อยู่ใน delta เท่านั้น) → ปักรุ่นนั้น
+    """
+    def _ver() -> Optional[str]:
+        return (_drive_execute(lambda: get_drive_service().files().get(fileId=file_id, fields="modifiedTime", supportsAllDrives=True)) or {}).get("modifiedTime")
+    if _ver() != seen_version:
+        st.error(f"❌ {filename} ถูกแก้ไขหลังจากเปิดหน้านี้ — โหลดหน้าใหม่ ตรวจสอบ แล้วทำอีกครั้ง"); return False, None
+    if filename in DELTA_TARGETS:
+        compact_delta_journal(filename, force=True)   # ล้างรายการ delta เองก่อนรวม และหลังลบ
+        if list_delta_files()[filename]:
+            st.error(f"❌ ยังรวม delta ของ {filename} เข้าไฟล์หลักไม่ได้ (มีการรวมอื่นทำอยู่) — ลองใหม่อีกครั้ง"); return False, None
+    pin_revision(filename, file_id)   # [Rev] รุ่นก่อนเขียนทับย้อนคืนได้
+    return True, _ver()   # รวม delta แล้ว → รุ่นที่การรวมเพิ่งเขียน (เนื้อหา = ที่ admin เห็น)
+
+def restore_revision(filename: str, file_id: str, revision_id: str, seen_version: Optional[str]) -> bool:
+    """
+    ย้อนไฟล์เป็น revision ที่เลือก: อัปโหลด bytes ของ revision ตรง ๆ (ครบทุกชีต/รูปแบบ ไม่ผ่าน pandas) เป็นรุ่นใหม่
+    seen_version = modifiedTime ที่ admin เห็นตอนเลือก — ไฟล์ถูกแก้หลังจากนั้น → ไม่ย้อน (รุ่นก่อนย้อนถูกปักไว้ จึงย้อนกลับได้อีก)
+    """
+    try: fh = _download_bytes(file_id, revision_id)
     except Exception as e:
-        logger.warning("backup_excel(%s): %s", filename, e)
-
-def upload_pdf_to_drive(uploaded_file, new_filename: str, folder_id: str) -> str:
+        logger.error("restore_revision(%s@%s): %s", file_id, revision_id, e)
+        st.error("❌ อ่านเวอร์ชันที่เลือกไม่ได้"); return False
+    ok, base = prepare_overwrite(filename, file_id, seen_version)
+    if not ok: return False
     try:
-        svc = get_drive_service(); meta = {"name":new_filename,"parents":[folder_id]}
-        media = MediaIoBaseUpload(io.BytesIO(uploaded_file.getvalue()), mimetype="application/pdf", resumable=True)
-        created = _drive_execute(lambda: get_drive_service().files().create(body=meta, media_body=media, supportsAllDrives=True, fields="id,webViewLink"))
-        return created.get("webViewLink", "-")
-    except Exception as e: logger.error(f"upload_pdf: {e}"); return "-"
+        cur = (_drive_execute(lambda: get_drive_service().files().get(fileId=file_id, fields="modifiedTime", supportsAllDrives=True)) or {}).get("modifiedTime")
+        if cur != base:
+            st.error(f"❌ {filename} ถูกแก้ไขระหว่างย้อนเวอร์ชัน — ลองใหม่อีกครั้ง"); return False
+        media = MediaIoBaseUpload(fh, mimetype=EXCEL_MIME, resumable=False)
+        res = _drive_execute(lambda: get_drive_service().files().update(fileId=file_id, media_body=media, supportsAllDrives=True, fields="id,modifiedTime"))
+    except Exception as e:
+        logger.error("restore_revision(%s): %s", filename, e)
+        st.error(f"ย้อนเวอร์ชันล้มเหลว: {e}"); return False
+    _note_remote_version(filename, (res or {}).get("modifiedTime"), read_version=False)
+    read_excel_from_drive.clear(filename); _read_file_by_id.clear(file_id)
+    _invalidate_cache(FILE_DATASETS.get(filename))   # sidecar เดิมไม่ตรงเวอร์ชันใหม่ → ผู้อ่านข้ามเอง
+    _reset_after_overwrite(filename)
+    return True
 
 @st.cache_data(ttl=900)
-def list_all_files_in_folder(parent_id: str = FOLDER_ID) -> List[dict]:
+def list_all_files_in_folder(parent_id: str = FOLDER_ID, mime: Optional[str] = EXCEL_MIME) -> List[dict]:
+    """ไฟล์ทั้งหมดในโฟลเดอร์ (mime=None → ทุกชนิด เช่น xlsx + parquet sidecar ใน request เดียว)"""
+    files: List[dict] = []; token = None
+    q = f"'{parent_id}' in parents and trashed=false" + (f" and mimeType='{mime}'" if mime else "")
     try:
-        res = _drive_execute(lambda: get_drive_service().files().list(q=f"'{parent_id}' in parents and trashed=false and mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'", fields="files(id,name,modifiedTime)", supportsAllDrives=True, includeItemsFromAllDrives=True, orderBy="modifiedTime desc"))
-        return res.get("files", [])
+        while True:
+            res = _drive_execute(lambda: get_drive_service().files().list(q=q, fields="nextPageToken,files(id,name,modifiedTime,appProperties)", supportsAllDrives=True, includeItemsFromAllDrives=True, orderBy="modifiedTime desc", pageSize=1000, pageToken=token))
+            files.extend(res.get("files", [])); token = res.get("nextPageToken")
+            if not token: return files
     except Exception as e: logger.error(f"list_all_files: {e}"); return []
 
+# ---------------------------
+# 🧾 Delta journal (leave / travel)
+# ---------------------------
+DELTA_FOLDER_NAME = "_DELTA_JOURNAL"
+# ไฟล์หลัก → (dataset, คอลัมน์ dedup) — บันทึกใหม่เป็นไฟล์ delta เล็ก ๆ ไม่อัปโหลด workbook ทั้งก้อน
+DELTA_TARGETS: Dict[str, Tuple[str, List[str]]] = {
+    FILE_LEAVE:  ("leave",  ["ชื่อ-สกุล","วันที่เริ่ม","ประเภทการลา"]),
+    FILE_TRAVEL: ("travel", ["ชื่อ-สกุล","วันที่เริ่ม","เรื่อง/กิจกรรม"]),
+}
+_DELTA_COMPACT_MIN     = 25          # delta ค้าง ≥ นี้ → รวมเข้าไฟล์หลักรอบถัดไปของ worker
+_DELTA_COMPACT_AGE_SEC = 6 * 3600    # หรือ delta เก่าสุดค้างนานเกินนี้
+# [Attach] delta ที่ถูกเติมลิงก์ไฟล์แนบทีหลัง: ตั้ง appProperties นี้ → fingerprint เปลี่ยน process อื่นจึงโหลดใหม่
+DELTA_EDIT_PROP = "edited"
+
+@st.cache_resource(show_spinner=False)
+def _delta_state() -> dict:
+    """สถานะระดับ process: id โฟลเดอร์ journal + lock กัน compaction ซ้อน"""
+    return {"lock": threading.Lock(), "folder": None}
+
+def _delta_folder_id() -> Optional[str]:
+    state = _delta_state()
+    if state["folder"] is None: state["folder"] = get_or_create_folder(DELTA_FOLDER_NAME, FOLDER_ID)
+    return state["folder"]
+
+def _clear_delta_listing() -> None:
+    """รายการ delta มาจาก list_all_files_in_folder (cache ttl 900) — ล้างหลังสร้าง/ลบ delta และก่อนรวม/ตรวจ remote"""
+    folder = _delta_state()["folder"]
+    if folder: list_all_files_in_folder.clear(folder)
+
+def _delta_key(filename: str) -> str:
+    """key ใน remote versions ของชุด delta ที่ค้างของไฟล์หลัก"""
+    return f"__delta__{filename}"
+
+def _delta_fingerprint(ids) -> str:
+    return _digest(sorted(ids))   # ไม่ใช้ hash() — salt ต่อ process ทำให้เทียบข้าม process ไม่ได้
+
+def _delta_fingerprint_part(f: dict) -> str:
+    """id ของ delta (+ รุ่นที่แก้ ถ้าถูกเติมลิงก์ทีหลัง) — delta ที่เพิ่งเขียนเองได้ค่าเท่ากับ id ที่จดไว้ใน snapshot"""
+    edited = (f.get("appProperties") or {}).get(DELTA_EDIT_PROP)
+    return f"{f['id']}@{edited}" if edited else f["id"]
+
+def list_delta_files() -> Dict[str, List[dict]]:
+    """delta ที่ค้างของแต่ละไฟล์หลัก (list ครั้งเดียว) เรียงตามเวลาบันทึก — ชื่อ: <ไฟล์หลัก>__<timestamp>_<rand>.xlsx"""
+    folder = _delta_folder_id()
+    out: Dict[str, List[dict]] = {f: [] for f in DELTA_TARGETS}
+    for f in (list_all_files_in_folder(folder) if folder else []):
+        base = f.get("name", "").split("__", 1)[0]
+        if base in out: out[base].append(f)
+    for lst in out.values(): lst.sort(key=lambda f: f.get("name", ""))
+    return out
+
+def append_delta_rows(filename: str, rows: List[dict]) -> Optional[str]:
+    """
+    [Journal] บันทึกแถวใหม่เป็นไฟล์ delta ขนาดเล็ก — ไม่อ่าน/เขียนไฟล์หลักทั้งก้อน → คืน file id ของ delta
+    ผู้อ่าน replay delta ทับไฟล์หลัก (replay_deltas), compact_delta_journal รวมเข้าไฟล์หลักตามรอบ
+    """
+    try:
+        folder = _delta_folder_id()
+        if not folder: raise RuntimeError(f"สร้างโฟลเดอร์ {DELTA_FOLDER_NAME} ไม่ได้")
+        df = pd.DataFrame(rows)
+        df = df.drop(columns=[c for c in DERIVED_COLS if c in df.columns])
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="xlsxwriter") as w: df.to_excel(w, index=False)
+        buf.seek(0); media = MediaIoBaseUpload(buf, mimetype=EXCEL_MIME, resumable=False)
+        name = f"{filename}__{dt.datetime.now().strftime('%Y%m%dT%H%M%S%f')}_{os.urandom(3).hex()}.xlsx"
+        res = _drive_execute(lambda: get_drive_service().files().create(body={"name":name,"parents":[folder]}, media_body=media, supportsAllDrives=True, fields="id"))
+        _clear_delta_listing()   # โหลดใหม่ใน process นี้ต้อง replay delta ที่เพิ่งเขียน
+        return (res or {}).get("id")
+    except Exception as e:
+        logger.error("append_delta_rows(%s): %s", filename, e)
+        st.error(f"บันทึกไฟล์ล้มเหลว: {e}")
+        return None
+
+def read_delta_frames(deltas: List[dict]) -> List[pd.DataFrame]:
+    # cache ตาม id + modifiedTime: delta ที่ถูกเติมลิงก์ไฟล์แนบทีหลังถูกอ่านใหม่
+    return [d for d in (_read_file_version(f["id"], f.get("modifiedTime", "")) for f in deltas) if not d.empty]
+
+def replay_deltas(filename: str, df_base: pd.DataFrame,
+                  deltas: Optional[List[dict]] = None) -> Tuple[pd.DataFrame, Tuple[str, ...]]:
+    """ไฟล์หลัก + delta ที่ค้างตามลำดับเวลา → (ตารางปัจจุบัน, id ของ delta ที่ใช้) — แถวซ้ำตามคอลัมน์ dedup เก็บของไฟล์หลัก"""
+    deltas = list_delta_files()[filename] if deltas is None else deltas
+    ids, frames = tuple(f["id"] for f in deltas), read_delta_frames(deltas)
+    if not frames: return df_base, ids
+    df_all = pd.concat([df_base, *frames], ignore_index=True)
+    cols = [c for c in DELTA_TARGETS[filename][1] if c in df_all.columns]
+    if cols: df_all = df_all.drop_duplicates(subset=cols, keep="first")
+    return df_all.reset_index(drop=True), ids
+
+def drop_delta_files(ids) -> None:
+    for fid in ids:
+        try: _drive_execute(lambda: get_drive_service().files().delete(fileId=fid, supportsAllDrives=True))
+        except Exception as e: logger.warning("drop delta %s: %s", fid, e)
+    _clear_delta_listing()
+
+def compact_delta_journal(filename: str, force: bool = False) -> int:
+    """
+    [Journal] รวม delta ที่ค้างเข้าไฟล์หลัก (สำรองไฟล์หลักก่อน) แล้วลบ delta ที่รวมแล้ว → คืนจำนวน delta ที่รวม
+    ไม่ force: ทำเมื่อค้าง ≥ _DELTA_COMPACT_MIN ไฟล์ หรือ delta เก่าสุดค้างเกิน _DELTA_COMPACT_AGE_SEC
+    delta ที่เขียนระหว่าง compaction ไม่อยู่ในรายการ → ไม่ถูกลบ และถูก replay ต่อในรอบหน้า
+    """
+    state = _delta_state()
+    if not state["lock"].acquire(blocking=False): return 0   # มี compaction อื่นทำอยู่
+    try:
+        _clear_delta_listing()
+        deltas = list_delta_files()[filename]
+        if not deltas: return 0
+        age = (pd.Timestamp.now(tz="UTC") - pd.Timestamp(deltas[0].get("modifiedTime") or pd.Timestamp.now(tz="UTC"))).total_seconds()
+        if not force and len(deltas) < _DELTA_COMPACT_MIN and age < _DELTA_COMPACT_AGE_SEC: return 0
+        dedup = DELTA_TARGETS[filename][1]
+        df_base, fid, ver = read_excel_dedup(filename, dedup_cols=dedup)
+        df_full, ids = replay_deltas(filename, df_base, deltas)
+        pin_revision(filename, fid)   # [Rev] รุ่นก่อนรวม delta
+        # เนื้อหาเท่าเดิม (ไฟล์หลัก + delta) → ไม่ต้องโหลด cache ใหม่
+        if not write_excel_to_drive(filename, df_full, known_file_id=fid, write_through=True,
+                                    base_version=ver, merge_key=dedup): return 0
+        drop_delta_files(ids)
+        _note_compacted_deltas(filename, {f["id"] for f in list_delta_files()[filename]})
+        logger.info("Delta journal compacted: %s (%d deltas)", filename, len(ids))
+        return len(ids)
+    finally:
+        state["lock"].release()
+
+def compact_due_journals() -> None:
+    """รอบ compaction ตามกำหนด (เรียกจาก worker เบื้องหลัง)"""
+    for filename in DELTA_TARGETS:
+        try: compact_delta_journal(filename)
+        except Exception as e: logger.warning("compact_delta_journal(%s): %s", filename, e)
+
+def _read_journaled(filename: str) -> Tuple[pd.DataFrame, Optional[str], Optional[str], Tuple[str, ...]]:
+    """ไฟล์หลัก + delta ที่ค้าง → (ตาราง, file id, เวอร์ชันไฟล์หลัก, id ของ delta ที่ replay)"""
+    df, fid, ver = read_excel_dedup(filename, dedup_cols=DELTA_TARGETS[filename][1])
+    df, ids = replay_deltas(filename, df)
+    return df, fid, ver, ids
+
+# ---------------------------
+# 🗃️ Fiscal-year archive (leave / travel)
+# ---------------------------
+# [FY] ไฟล์หลักเก็บเฉพาะ HOT_FISCAL_YEARS ปีงบล่าสุด — ปีงบที่ปิดแล้วย้ายไป _FY_ARCHIVE/<ไฟล์>_FY<พ.ศ.>.xlsx
+# เมนูทั่วไปใช้ leave / travel (ร้อน); รายงานหลายปี (Dashboard, ตรวจสอบ, ปีย้อนหลัง) ใช้ leave_all / travel_all ที่อ่านคลังด้วย
+FY_ARCHIVE_FOLDER_NAME = "_FY_ARCHIVE"
+
+@st.cache_resource(show_spinner=False)
+def _fy_archive_state() -> dict:
+    """id โฟลเดอร์คลัง + {ไฟล์: ปีงบร้อนเก่าสุดที่ย้ายเสร็จแล้ว} (ย้ายครั้งแรกของ process และเมื่อขึ้นปีงบใหม่)"""
+    return {"folder": None, "rolled": {}}
+
+def _fy_archive_folder_id() -> Optional[str]:
+    state = _fy_archive_state()
+    if state["folder"] is None: state["folder"] = get_or_create_folder(FY_ARCHIVE_FOLDER_NAME, FOLDER_ID)
+    return state["folder"]
+
+def fy_archive_file(filename: str, fiscal_year: int) -> str:
+    return f"{os.path.splitext(filename)[0]}_FY{int(fiscal_year)}.xlsx"
+
+def list_fy_archives(filename: str) -> Tuple[Dict[int, dict], Dict[str, dict]]:
+    """({ปีงบ: meta xlsx}, {ชื่อไฟล์: meta รวม sidecar}) ของไฟล์หลักนี้ในคลัง — list โฟลเดอร์ครั้งเดียว"""
+    folder = _fy_archive_folder_id()
+    files = {f["name"]: f for f in (list_all_files_in_folder(folder, mime=None) if folder else [])}
+    pat = re.compile(rf"^{re.escape(os.path.splitext(filename)[0])}_FY(\d{{4}})\.xlsx$")
+    years: Dict[int, dict] = {}
+    for name, meta in files.items():
+        m = pat.match(name)
+        if m: years[int(m.group(1))] = meta
+    return years, files
+
+def read_fy_archives(filename: str, fiscal_years=None) -> pd.DataFrame:
+    """แถวในคลังของปีงบที่ระบุ (None = ทุกปี) — อ่านตามเวอร์ชัน + sidecar parquet"""
+    years, files = list_fy_archives(filename)
+    frames = [read_file_meta(meta, files.get(_sidecar_name(meta["name"]))) for fy, meta in sorted(years.items())
+              if fiscal_years is None or fy in fiscal_years]
+    frames = [f for f in frames if not f.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def archive_closed_fiscal_years(filename: str) -> Optional[int]:
+    """
+    [FY] ย้ายแถวปีงบเก่ากว่า hot_fiscal_year_min() จากไฟล์หลัก (+ delta ที่ค้าง) เข้าคลัง → จำนวนแถวที่ย้าย
+    None = ยังไม่สำเร็จ (compaction อื่นถือ lock / เขียนไม่ผ่าน) ลองใหม่รอบหน้า
+    เขียนคลังก่อน (dedup → ทำซ้ำได้) แล้วค่อยตัดออกจากไฟล์หลัก: ล้มกลางทางไม่หายไม่ซ้ำ
+    """
+    state = _delta_state()
+    if not state["lock"].acquire(blocking=False): return None   # lock เดียวกับ compaction (เขียนไฟล์หลักทับเหมือนกัน)
+    folder = None
+    try:
+        dedup = DELTA_TARGETS[filename][1]
+        df_main, fid, ver = read_excel_versioned(filename)
+        if df_main.empty or "วันที่เริ่ม" not in df_main.columns: return 0
+        _clear_delta_listing()
+        df_full, ids = replay_deltas(filename, df_main)
+        fy = fiscal_years_be(df_full["วันที่เริ่ม"])
+        old = (fy > 0) & (fy < hot_fiscal_year_min())
+        if not old.any(): return 0
+        folder = _fy_archive_folder_id()
+        if not folder: return None
+        list_all_files_in_folder.clear(folder, mime=None)   # meta คลังล่าสุด (ไม่ใช้ cache ttl) → base_version ตรงไฟล์จริง
+        years, files = list_fy_archives(filename)
+        for year in sorted(set(fy[old].tolist())):
+            name, meta = fy_archive_file(filename, year), years.get(year)
+            df_arc = read_file_meta(meta, files.get(_sidecar_name(name))) if meta else pd.DataFrame()
+            df_arc = pd.concat([df_arc, df_full[fy == year]], ignore_index=True)
+            cols = [c for c in dedup if c in df_arc.columns]
+            if cols: df_arc = df_arc.drop_duplicates(subset=cols, keep="first")
+            if not write_excel_to_drive(name, df_arc, known_file_id=meta["id"] if meta else None, write_through=True,
+                                        parent_id=folder, base_version=(meta or {}).get("modifiedTime"), merge_key=dedup): return None
+        # ไม่ merge เมื่อชน: แถวที่เพิ่งย้ายจะถูกต่อกลับเข้าไฟล์หลัก → ยกเลิก รอบหน้าลองใหม่ (คลัง dedup อยู่แล้ว)
+        pin_revision(filename, fid)   # [Rev] เก็บรุ่นก่อนตัดปีงบเก่าออก
+        if not write_excel_to_drive(filename, df_full[~old].reset_index(drop=True), known_file_id=fid,
+                                    write_through=True, base_version=ver): return None
+        drop_delta_files(ids)
+        _note_compacted_deltas(filename, {f["id"] for f in list_delta_files()[filename]})
+        _invalidate_cache(FILE_DATASETS.get(filename, ()))
+        logger.info("Fiscal-year archive: %s moved %d rows (FY %s)", filename, int(old.sum()), sorted(set(fy[old].tolist())))
+        return int(old.sum())
+    finally:
+        if folder: list_all_files_in_folder.clear(folder, mime=None)   # leave_all / travel_all ที่โหลดใหม่เห็นไฟล์ปีงบที่เพิ่งย้าย
+        state["lock"].release()
+
+def archive_due_fiscal_years() -> None:
+    """รอบย้ายปีงบเก่าเข้าคลัง (worker เบื้องหลัง) — ไฟล์ละครั้งต่อปีงบร้อน"""
+    state, hot_min = _fy_archive_state(), hot_fiscal_year_min()
+    for filename in DELTA_TARGETS:
+        if state["rolled"].get(filename) == hot_min: continue
+        try:
+            if archive_closed_fiscal_years(filename) is not None: state["rolled"][filename] = hot_min
+        except Exception as e: logger.warning("archive_closed_fiscal_years(%s): %s", filename, e)
+
+def _reset_after_overwrite(filename: str) -> None:
+    """ไฟล์ถูกเขียนทับทั้งก้อน (admin อัปโหลด / ย้อนเวอร์ชัน) → ตรวจปีงบเก่าใหม่
+    delta ที่ค้างถูกรวมไว้แล้วใน prepare_overwrite — delta ที่เขียนหลังจากนั้นเป็นแถวใหม่จริง จึงคงไว้ให้ replay ต่อ"""
+    if filename in DELTA_TARGETS:
+        _fy_archive_state()["rolled"].pop(filename, None)   # [FY] ไฟล์ใหม่อาจมีปีงบเก่า → ย้ายรอบหน้า
+
 # ===========================
 # 🛠️ Data Processing
 # ===========================
@@ -902,6 +1368,55 @@ def clean_names(df: pd.DataFrame, col: str) -> pd.DataFrame:
     df[col] = series.astype(str).str.strip().str.replace(r"\s+"," ",regex=True)
     return df
 
+def month_key(d) -> int:
+    """วันที่ → month key แบบ int (YYYYMM) ให้ตรงกับคอลัมน์ _ym"""
+    return d.year * 100 + d.month
+
+def month_label(keys) -> np.ndarray:
+    """month key (YYYYMM) → 'YYYY-MM' — แปลงเฉพาะค่า unique (-1 → None)"""
+    uniq, inv = np.unique(np.asarray(keys), return_inverse=True)
+    labels = np.array([f"{k//100:04d}-{k%100:02d}" if k > 0 else None for k in uniq], dtype=object)
+    return labels[inv]
+
+def add_derived_columns(df: pd.DataFrame, date_col: str) -> pd.DataFrame:
+    """
+    [Derived] คำนวณครั้งเดียวต่อการโหลดข้อมูล (in place) — render code แค่กรอง:
+      _ym  = YYYYMM, _fy = ปีงบประมาณ (พ.ศ., เริ่ม ต.ค.), _wd = วันในสัปดาห์ (จ.=0), _day = วันที่ของเดือน
+    วันที่ว่าง → -1
+    """
+    if df.empty or date_col not in df.columns: return df
+    d  = pd.to_datetime(df[date_col], errors="coerce")
+    ok = d.notna().to_numpy()
+    y  = d.dt.year.fillna(0).to_numpy(dtype=np.int32)
+    m  = d.dt.month.fillna(0).to_numpy(dtype=np.int32)
+    df["_ym"]  = np.where(ok, y * 100 + m, -1).astype(np.int32)
+    df["_fy"]  = np.where(ok, y + 543 + (m >= 10), -1).astype(np.int32)
+    df["_wd"]  = np.where(ok, d.dt.weekday.fillna(0).to_numpy(dtype=np.int32), -1).astype(np.int8)
+    df["_day"] = np.where(ok, d.dt.day.fillna(0).to_numpy(dtype=np.int32), -1).astype(np.int8)
+    return df
+
+HOT_FISCAL_YEARS = 2   # [FY] ปีงบในไฟล์หลัก/cache: ปีปัจจุบัน + ปีก่อน (ครอบคลุมปีปฏิทินปัจจุบันทั้งปี)
+
+def fiscal_year_be(d) -> int:
+    """ปีงบประมาณ (พ.ศ.) ของวันที่ — ต.ค. ขึ้นปีงบใหม่ (เหมือน _fy)"""
+    d = pd.Timestamp(d)
+    return d.year + 543 + (d.month >= 10)
+
+def fiscal_years_be(dates) -> np.ndarray:
+    """ปีงบ (พ.ศ.) รายแถว — วันที่ว่าง/อ่านไม่ได้ → -1"""
+    d = pd.to_datetime(pd.Series(dates), errors="coerce")
+    y, m = d.dt.year.fillna(0).to_numpy(dtype=np.int32), d.dt.month.fillna(0).to_numpy(dtype=np.int32)
+    return np.where(d.notna().to_numpy(), y + 543 + (m >= 10), -1).astype(np.int32)
+
+def hot_fiscal_year_min(today: Optional[dt.date] = None) -> int:
+    """ปีงบเก่าสุดที่ยังอยู่ในไฟล์หลัก — เก่ากว่านี้อยู่ในคลัง _FY_ARCHIVE"""
+    return fiscal_year_be(today or dt.date.today()) - (HOT_FISCAL_YEARS - 1)
+
+def _hot_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """[FY] เฉพาะแถวของปีงบร้อน (ต้องมี _fy แล้ว; วันที่ว่าง _fy=-1 เก็บไว้)"""
+    if df.empty or "_fy" not in df.columns: return df
+    return df[(df["_fy"] < 0) | (df["_fy"] >= hot_fiscal_year_min())].reset_index(drop=True)
+
 @st.cache_data(ttl=900, show_spinner=False)
 def preprocess_dataframes(df_leave, df_travel, df_att):
     # [I6] pre-cast low-cardinality columns เป็น category ลด RAM ~30%
@@ -918,16 +1433,6 @@ def preprocess_dataframes(df_leave, df_travel, df_att):
     gc.collect()  # [I6] คืน memory หลัง preprocess
     return df_leave, df_travel, df_att
 
-def count_weekdays(start_date, end_date, extra_holidays: Optional[List[dt.date]] = None) -> int:
-    if not start_date or not end_date: return 0
-    if isinstance(start_date, dt.datetime): start_date=start_date.date()
-    if isinstance(end_date, dt.datetime): end_date=end_date.date()
-    base = int(np.busday_count(start_date, end_date+dt.timedelta(days=1)))
-    if extra_holidays:
-        overlap = sum(1 for h in extra_holidays if start_date<=h<=end_date and h.weekday()<5)
-        base = max(0, base-overlap)
-    return base
-
 def parse_time(val) -> Optional[dt.time]:
     if val is None or val == "": return None
     if isinstance(val, float):
@@ -972,19 +1477,23 @@ def read_attendance_report() -> pd.DataFrame:
     รูปแบบ C — ไฟล์เครื่องสแกน ZKTeco/Fingertec: No | ชื่อ | Department | Date | Time | ...
     รูปแบบ D — ชื่อ column ภาษาอังกฤษ: Name/Employee | Date | Check In | Check Out
     """
-    fid = get_file_id(FILE_ATTEND)
-    if not fid:
+    return read_attendance_versioned()[0]
+
+def read_attendance_versioned() -> Tuple[pd.DataFrame, Optional[str], Optional[str]]:
+    """(ข้อมูลสแกน, file id, modifiedTime ของข้อมูลชุดนั้น) — ไม่ผ่าน cache ใช้เป็น base_version ตอนเขียนทับ (ตัดเดือนเข้าคลัง)"""
+    meta = get_file_meta(FILE_ATTEND)
+    if not meta:
         logger.warning("read_attendance_report: ไม่พบไฟล์ %s ใน Drive", FILE_ATTEND)
-        return pd.DataFrame()
+        return pd.DataFrame(), None, None
+    try: fh = _download_bytes(meta["id"])
+    except Exception as e:
+        logger.error("read_attendance_report: %s", e)
+        return pd.DataFrame(), meta["id"], None
+    return parse_attendance_report(fh), meta["id"], meta.get("modifiedTime")
 
+def parse_attendance_report(fh: io.BytesIO) -> pd.DataFrame:
+    """แปลงไฟล์สแกน (bytes) เป็นตารางมาตรฐาน ชื่อ-สกุล | วันที่ | เวลาเข้า | เวลาออก | หมายเหตุ | เดือน"""
     try:
-        req  = get_drive_service().files().get_media(fileId=fid, supportsAllDrives=True)
-        fh   = io.BytesIO()
-        dl   = MediaIoBaseDownload(fh, req)
-        done = False
-        while not done:
-            _, done = dl.next_chunk()
-        fh.seek(0)
         # อ่าน dtype=str ทั้งหมดเพื่อป้องกัน pandas auto-cast วันที่/เวลาผิด
         df_raw = pd.read_excel(fh, engine="openpyxl", header=0, dtype=str)
     except Exception as e:
@@ -1186,77 +1695,330 @@ def read_attendance_report() -> pd.DataFrame:
     df_out = df_out.sort_values(["ชื่อ-สกุล","วันที่"]).reset_index(drop=True)
     return df_out
 
+# ---------------------------
+# 🧊 Attendance cold storage (เดือนที่ปิดแล้ว)
+# ---------------------------
+# [Cold] เดือนก่อนเดือนปัจจุบันไม่ถูกแก้ในเครื่องสแกนอีก → ย้ายแถวที่ parse แล้วไป _ATT_ARCHIVE/att_<YYYY-MM>.parquet (อ่านอย่างเดียว)
+# attendance_report.xlsx เหลือเฉพาะเดือนที่เปิดอยู่ (ไฟล์เล็ก parse เร็ว); อัปโหลดไฟล์เต็มมาใหม่ → เดือนในไฟล์แทนของคลังแล้วย้ายซ้ำ
+# att_month_index.parquet: 1 แถว/เดือน; att_kpi_archive.parquet: cube (ชื่อ, เดือน) × สถานะ สรุปไว้ให้ Dashboard ไม่ต้องคำนวณใหม่
+ATT_ARCHIVE_FOLDER_NAME = "_ATT_ARCHIVE"
+ATT_MONTH_INDEX_FILE = "att_month_index.parquet"
+ATT_KPI_ARCHIVE_FILE = "att_kpi_archive.parquet"
+ATT_ARCHIVE_COLS = ["ชื่อ-สกุล","วันที่","เวลาเข้า","เวลาออก","หมายเหตุ","เดือน"]
+ATT_INDEX_COLS = ["เดือน","file","rows","persons","first_date","last_date","archived_at"]
+
+@st.cache_resource(show_spinner=False)
+def _att_archive_state() -> dict:
+    """lock กัน compaction ซ้อน + id โฟลเดอร์คลัง"""
+    return {"lock": threading.Lock(), "folder": None}
+
+def _att_archive_folder_id() -> Optional[str]:
+    state = _att_archive_state()
+    if state["folder"] is None: state["folder"] = get_or_create_folder(ATT_ARCHIVE_FOLDER_NAME, FOLDER_ID)
+    return state["folder"]
+
+def att_archive_file(month: str) -> str:
+    return f"att_{month}.parquet"
+
+def att_archive() -> Tuple[pd.DataFrame, Dict[str, dict]]:
+    """(index รายเดือน, {ชื่อไฟล์: meta}) — list โฟลเดอร์ครั้งเดียว + อ่าน index ตามเวอร์ชัน"""
+    folder = _att_archive_folder_id()
+    files = {f["name"]: f for f in (list_all_files_in_folder(folder, mime=None) if folder else [])}
+    meta = files.get(ATT_MONTH_INDEX_FILE)
+    idx = _read_file_version(meta["id"], meta.get("modifiedTime", ""), "parquet") if meta else pd.DataFrame()
+    if idx.empty: idx = pd.DataFrame(columns=ATT_INDEX_COLS)
+    return idx.astype({"เดือน": str}).sort_values("เดือน").reset_index(drop=True), files
+
+def read_att_archive(exclude_months=()) -> Tuple[pd.DataFrame, Tuple[str, ...]]:
+    """แถวสแกนของเดือนในคลัง (ยกเว้นเดือนที่ไฟล์ร้อนมีอยู่ — ไฟล์ที่อัปโหลดใหม่ชนะ) → (ตาราง, เดือนที่ใช้)"""
+    idx, files = att_archive()
+    months = [m for m in idx["เดือน"] if m not in set(exclude_months) and att_archive_file(m) in files]
+    frames = [_read_file_version(files[att_archive_file(m)]["id"], files[att_archive_file(m)].get("modifiedTime", ""), "parquet")
+              for m in months]
+    frames = [f for f in frames if not f.empty]
+    return (pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=ATT_ARCHIVE_COLS)), tuple(months)
+
+def _att_inputs_version(df_staff: pd.DataFrame, df_manual: pd.DataFrame, months) -> str:
+    """ลายนิ้วมือของสิ่งที่ cube ในคลังขึ้นกับ: ทะเบียน staff (ชื่อมาตรฐาน) + manual ของเดือนในคลัง"""
+    months = set(months)
+    man = df_manual
+    if not man.empty and "วันที่" in man.columns:
+        man = man[pd.to_datetime(man["วันที่"], errors="coerce").dt.strftime("%Y-%m").isin(months)]
+    cols = [c for c in MANUAL_SCAN_COLS if c in man.columns]
+    man_v = f"{len(man)}:{int(pd.util.hash_pandas_object(man[cols].astype(str), index=False).sum())}" if not man.empty else "empty"
+    return f"{_staff_version(df_staff)}|{man_v}"
+
+def load_att_kpi_archive() -> Tuple[pd.DataFrame, str]:
+    """(cube เดือนในคลัง index=(ชื่อ-สกุล, เดือน), inputs version ตอนสรุป) — ไม่มี → (ว่าง, "")"""
+    folder = _att_archive_folder_id()
+    meta = get_file_meta(ATT_KPI_ARCHIVE_FILE, folder) if folder else None
+    if not meta: return pd.DataFrame(columns=KPI_STATUSES), ""
+    df = _read_file_version(meta["id"], meta.get("modifiedTime", ""), "parquet")
+    if df.empty: return pd.DataFrame(columns=KPI_STATUSES), ""
+    version = str(df["_inputs"].iloc[0]) if "_inputs" in df.columns else ""
+    cube = df.astype({"ชื่อ-สกุล": str, "เดือน": str}).set_index(["ชื่อ-สกุล","เดือน"]).reindex(columns=KPI_STATUSES, fill_value=0)
+    return cube, version
+
+def compact_attendance_archive(force_cube: bool = False) -> Optional[List[str]]:
+    """
+    [Cold] ย้ายเดือนที่ปิดแล้วจากไฟล์สแกนร้อนเข้าคลัง parquet + สรุป cube ใหม่เมื่อ staff/manual ของเดือนในคลังเปลี่ยน
+    ลำดับ: เขียนเดือนในคลัง → index → cube → ตัดไฟล์ร้อน (ล้มกลางทาง: ไฟล์ร้อนยังครบ รอบหน้าย้ายซ้ำแบบเขียนทับ)
+    คืนเดือนที่ย้าย ([] = ไม่มีงาน) / None = มี compaction อื่นทำอยู่หรือเขียนไม่สำเร็จ
+    """
+    state = _att_archive_state()
+    if not state["lock"].acquire(blocking=False): return None
+    folder = None
+    try:
+        folder = _att_archive_folder_id()
+        if not folder: return None
+        list_all_files_in_folder.clear(folder, mime=None)   # index/เดือนในคลังล่าสุด (ไม่ใช้ cache ttl) ก่อนย้าย/สรุป cube
+        df_hot, hot_fid, hot_ver = read_attendance_versioned()   # ไม่ผ่าน cache: base_version ต้องตรงกับข้อมูลที่จะตัด
+        open_month = dt.date.today().strftime("%Y-%m")
+        closed = df_hot["เดือน"].astype(str) < open_month if not df_hot.empty else pd.Series(dtype=bool)
+        idx, files = att_archive()
+        moved: List[str] = []
+        now = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        idx = idx.set_index("เดือน")
+        for month, grp in (df_hot[closed].groupby("เดือน", observed=True) if closed.any() else ()):
+            month, name = str(month), att_archive_file(str(month))
+            write_parquet_to_drive(name, grp[ATT_ARCHIVE_COLS], folder, (files.get(name) or {}).get("id"))
+            idx.loc[month] = [name, len(grp), grp["ชื่อ-สกุล"].nunique(), str(grp["วันที่"].min().date()),
+                              str(grp["วันที่"].max().date()), now]
+            moved.append(month)
+        idx = idx.reset_index().rename(columns={"index": "เดือน"})
+        if moved: write_parquet_to_drive(ATT_MONTH_INDEX_FILE, idx[ATT_INDEX_COLS], folder, (files.get(ATT_MONTH_INDEX_FILE) or {}).get("id"))
+        # cube ต้องใช้ staff/manual ของ snapshot (worker ไม่โหลดเอง) — ยังไม่มี → รอรอบหน้า
+        snap = _latest_snapshot()
+        df_staff, df_manual = (snap.get("cache_staff"), snap.get("cache_manual")) if snap is not None else (None, None)
+        if df_staff is not None and df_manual is not None and not idx.empty:
+            months = idx["เดือน"].tolist()
+            inputs = _att_inputs_version(df_staff, df_manual, months)
+            if force_cube or moved or load_att_kpi_archive()[1] != inputs:
+                df_scan, _ = read_att_archive()
+                _, _, df_scan = preprocess_dataframes(pd.DataFrame(), pd.DataFrame(), df_scan)
+                man = df_manual[pd.to_datetime(df_manual["วันที่"], errors="coerce").dt.strftime("%Y-%m").isin(months)] \
+                      if not df_manual.empty and "วันที่" in df_manual.columns else df_manual
+                df_att = _build_attendance(apply_staff_ids(df_scan, get_staff_resolver(df_staff)), man)
+                df_work = df_att[df_att["สถานะสแกน"] != "วันหยุด"] if not df_att.empty else df_att
+                cube = attendance_kpi_cube(df_work).reset_index().assign(_inputs=inputs)
+                write_parquet_to_drive(ATT_KPI_ARCHIVE_FILE, cube, folder, (files.get(ATT_KPI_ARCHIVE_FILE) or {}).get("id"))
+        if moved and hot_fid and hot_ver:
+            pin_revision(FILE_ATTEND, hot_fid)   # [Rev] ไฟล์ export เต็มก่อนตัดยังย้อนคืนได้
+            # ไม่ merge เมื่อชน (มีคนอัปโหลดไฟล์ใหม่หลังอ่าน) → ไฟล์ใหม่ถูกย้ายในรอบหน้า
+            if write_excel_to_drive(FILE_ATTEND, df_hot[~closed][ATT_ARCHIVE_COLS[:-1]], known_file_id=hot_fid,
+                                    write_through=True, base_version=hot_ver, sidecar=False):
+                read_attendance_report.clear()   # เนื้อหารวม (ร้อน + คลัง) เท่าเดิม → ไม่ต้องโหลด att ใหม่
+            logger.info("Attendance cold storage: archived %s", ",".join(moved))
+        return moved
+    except Exception as e:
+        logger.warning("compact_attendance_archive: %s", e); return None
+    finally:
+        if folder: list_all_files_in_folder.clear(folder, mime=None)   # โหลด att รอบถัดไปเห็นเดือนที่เพิ่งย้ายเข้าคลัง
+        state["lock"].release()
+
+def attendance_trend_cube(df_work: pd.DataFrame, cold_months=()) -> pd.DataFrame:
+    """
+    [Cold] cube (ชื่อ, เดือน) × สถานะของ Dashboard: เดือนในคลังอ่าน cube ที่สรุปไว้ (ถ้า staff/manual ยังตรงเวอร์ชัน)
+    เดือนร้อนคำนวณจาก df_work — cube ในคลังเก่า/ไม่มี → คำนวณจาก df_work ทั้งหมดเหมือนเดิม
+    """
+    if not cold_months: return attendance_kpi_cube(df_work)
+    cube, version = load_att_kpi_archive()
+    if cube.empty or version != _att_inputs_version(_dc("cache_staff"), _dc("cache_manual"), cold_months):
+        return attendance_kpi_cube(df_work)
+    cube = cube[cube.index.get_level_values("เดือน").isin(set(cold_months))]
+    hot = df_work[~df_work["เดือน"].astype(str).isin(set(cold_months))] if not df_work.empty else df_work
+    if hot.empty: return cube.astype(int)   # concat กับตารางว่างทำชื่อ level ของ index หาย
+    return pd.concat([cube, attendance_kpi_cube(hot)]).fillna(0).astype(int)
+
 # ===========================
 # 🚗 Travel Data
 # ===========================
+def _split_person_tokens(values: pd.Series) -> pd.Series:
+    """แตกสตริงรายชื่อ (คั่นด้วย , หรือขึ้นบรรทัดใหม่) เป็น Series ยาว 1 ชื่อ/แถว — index คงเดิมของแถวต้นทาง"""
+    if values.empty: return pd.Series(dtype=object)
+    tok = values.fillna("").astype(str).str.replace("\n", ",", regex=False).str.split(",").explode()
+    tok = tok.str.replace(r"\d+\.\s*", "", regex=True).str.replace(r"\s+", " ", regex=True).str.strip()
+    return tok[(tok.str.len() >= 3) & (tok.str.lower() != "nan") & ~tok.str.contains("และอีก", regex=False)]
+
 def _extract_travel_from_activity_log(df_log: pd.DataFrame) -> pd.DataFrame:
     if df_log.empty or "ประเภท" not in df_log.columns: return pd.DataFrame()
-    df_tr = df_log[df_log["ประเภท"]=="ไปราชการ"].copy()
+    df_tr = df_log[df_log["ประเภท"]=="ไปราชการ"]
     if df_tr.empty: return pd.DataFrame()
-    rows=[]
-    for _,row in df_tr.iterrows():
-        try:
-            ts=pd.to_datetime(row.get("Timestamp"),errors="coerce")
-            if pd.isna(ts): continue
-            d=ts.normalize(); detail=str(row.get("รายละเอียด",""))
-            project=detail.split("@")[0].strip() if "@" in detail else detail
-            names=[n.strip() for n in str(row.get("ผู้เกี่ยวข้อง","")).split(",") if n.strip() and "และอีก" not in n]
-            for name in names: rows.append({"ชื่อ-สกุล":name,"วันที่เริ่ม":d,"วันที่สิ้นสุด":d,"เรื่อง/กิจกรรม":project})
-        except Exception: continue
-    return pd.DataFrame(rows) if rows else pd.DataFrame()
+    d = pd.to_datetime(df_tr["Timestamp"] if "Timestamp" in df_tr.columns else pd.Series(pd.NaT, index=df_tr.index), errors="coerce").dt.normalize()
+    detail = df_tr["รายละเอียด"].fillna("").astype(str) if "รายละเอียด" in df_tr.columns else pd.Series("", index=df_tr.index)
+    project = detail.str.split("@").str[0].str.strip()
+    names = _split_person_tokens(df_tr.loc[d.notna(), "ผู้เกี่ยวข้อง"] if "ผู้เกี่ยวข้อง" in df_tr.columns else pd.Series(dtype=object))
+    if names.empty: return pd.DataFrame()
+    return pd.DataFrame({"ชื่อ-สกุล": names.values, "วันที่เริ่ม": d.loc[names.index].values,
+                         "วันที่สิ้นสุด": d.loc[names.index].values,
+                         "เรื่อง/กิจกรรม": project.loc[names.index].values})
+
+# ---------------------------
+# 🗂️ Travel-source manifest
+# ---------------------------
+# บันทึกผลการตรวจไฟล์ใน FOLDER_ID ต่อ (fileId, modifiedTime): เป็นไฟล์ไปราชการหรือไม่, column mapping
+# และแถวที่ normalize แล้ว → โหลดรอบถัดไปดาวน์โหลดเฉพาะไฟล์ใหม่/ที่ถูกแก้ไข
+_NAME_ALIASES = ["ชื่อพนักงาน","ชื่อ","fullname"]
+
+def _read_travel_manifest_file() -> Dict[str, dict]:
+    try:
+        data = pd.read_pickle(TRAVEL_MANIFEST_PATH)
+        if isinstance(data, dict) and data.get("version") == _TRAVEL_MANIFEST_VERSION:
+            return data.get("entries", {})
+    except FileNotFoundError: pass
+    except Exception as e: logger.warning(f"travel manifest unreadable, rebuilding: {e}")
+    return {}
+
+def _save_travel_manifest(entries: Dict[str, dict]) -> None:
+    try:
+        os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+        tmp = TRAVEL_MANIFEST_PATH + ".tmp"
+        pd.to_pickle({"version": _TRAVEL_MANIFEST_VERSION, "entries": entries}, tmp)
+        os.replace(tmp, TRAVEL_MANIFEST_PATH)
+    except Exception as e: logger.warning(f"travel manifest save failed: {e}")
+
+@st.cache_resource(show_spinner=False)
+def _travel_manifest() -> dict:
+    """manifest ระดับ process (แชร์ทุก session) — โหลดจากดิสก์ครั้งเดียว"""
+    return {"lock": threading.Lock(), "entries": _read_travel_manifest_file()}
+
+def _classify_travel_source(fname: str, df_raw: pd.DataFrame) -> Tuple[Optional[str], Dict[str, str], pd.DataFrame]:
+    """
+    ตรวจ 1 ไฟล์ → (kind, mapping, rows)
+    kind: "sheet" = ตารางไปราชการ, "log" = activity log, None = ไม่ใช่ไฟล์ไปราชการ
+    """
+    if df_raw.empty: return None, {}, pd.DataFrame()
+    has_name=any(c in df_raw.columns for c in ["ชื่อ-สกุล","ชื่อพนักงาน","ชื่อ"])
+    if not (has_name and "วันที่เริ่ม" in df_raw.columns and "วันที่สิ้นสุด" in df_raw.columns): return None, {}, pd.DataFrame()
+    mapping={}
+    if "ชื่อ-สกุล" not in df_raw.columns:
+        alt=next((a for a in _NAME_ALIASES if a in df_raw.columns),None)
+        if alt: mapping={alt:"ชื่อ-สกุล"}
+    df_norm=df_raw.rename(columns=mapping)
+    df_norm["วันที่เริ่ม"]=pd.to_datetime(df_norm["วันที่เริ่ม"],errors="coerce").dt.normalize()
+    df_norm["วันที่สิ้นสุด"]=pd.to_datetime(df_norm["วันที่สิ้นสุด"],errors="coerce").dt.normalize()
+    if fname==FILE_NOTIFY or ("ประเภท" in df_norm.columns and "รายละเอียด" in df_norm.columns):
+        df_tl=_extract_travel_from_activity_log(df_norm)
+        if not df_tl.empty: df_tl["_source_file"]=fname
+        return "log", mapping, df_tl
+    df_norm["_source_file"]=fname
+    if "เรื่อง/กิจกรรม" not in df_norm.columns: df_norm["เรื่อง/กิจกรรม"]=fname.replace(".xlsx","")
+    df_norm=df_norm.dropna(subset=["ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด"])
+    df_norm["ชื่อ-สกุล"]=df_norm["ชื่อ-สกุล"].astype(str).str.strip()
+    df_norm=df_norm[df_norm["ชื่อ-สกุล"].str.lower()!="nan"]
+    keep=TRAVEL_REQUIRED_COLS+["_source_file"]+([TRAVEL_COMPANION_COL] if TRAVEL_COMPANION_COL in df_norm.columns else [])
+    return "sheet", mapping, df_norm[keep].reset_index(drop=True)
+
+def _travel_frames_from_manifest() -> List[pd.DataFrame]:
+    """ไล่ไฟล์ใน FOLDER_ID — ใช้ผลใน manifest ถ้า modifiedTime ตรง, ดาวน์โหลดเฉพาะไฟล์ใหม่/เปลี่ยน"""
+    listed=list_all_files_in_folder()
+    store=_travel_manifest(); entries=store["entries"]
+    frames: List[pd.DataFrame]=[]; seen=set(); changed=False; n_dl=0
+    with store["lock"]:
+        for f in listed:
+            fid=f.get("id"); fname=f.get("name",""); mtime=f.get("modifiedTime","")
+            if not fid or fname in _NON_TRAVEL_FILES or fname.startswith("BAK_"): continue
+            seen.add(fid)
+            ent=entries.get(fid)
+            if ent is None or ent.get("modifiedTime")!=mtime or ent.get("name")!=fname:
+                try:
+                    df_raw=_download_excel(fid); n_dl+=1   # ไม่ผ่าน cache ตาม id (ttl) — ไฟล์ที่เพิ่งแก้ต้องได้เนื้อหาใหม่ก่อนจดลง manifest
+                    if df_raw.empty: continue   # อ่านไม่ได้/ไฟล์ว่าง → ไม่บันทึก ลองใหม่รอบหน้า
+                    kind,mapping,rows=_classify_travel_source(fname,df_raw)
+                except Exception as e: logger.warning(f"load_all_travel skip {fname}: {e}"); continue
+                ent={"name":fname,"modifiedTime":mtime,"kind":kind,"mapping":mapping,"rows":rows}
+                entries[fid]=ent; changed=True
+            if ent["kind"] and not ent["rows"].empty: frames.append(ent["rows"])
+        if listed:
+            for fid in [k for k in entries if k not in seen]: entries.pop(fid); changed=True
+        if changed: _save_travel_manifest(entries)
+    logger.info("travel manifest: %d files listed, %d downloaded, %d travel sources",
+                len(seen), n_dl, sum(1 for e in entries.values() if e.get("kind")))
+    return frames
+
+def _normalize_travel_rows(df: pd.DataFrame, source: str) -> pd.DataFrame:
+    """แถวแบบ travel_report (backup / delta journal) → คอลัมน์มาตรฐานของ travel_all"""
+    for alt in ["ชื่อพนักงาน","ชื่อ"]:
+        if alt in df.columns and "ชื่อ-สกุล" not in df.columns: df=df.rename(columns={alt:"ชื่อ-สกุล"})
+    df["วันที่เริ่ม"]=pd.to_datetime(df.get("วันที่เริ่ม"),errors="coerce").dt.normalize()
+    df["วันที่สิ้นสุด"]=pd.to_datetime(df.get("วันที่สิ้นสุด"),errors="coerce").dt.normalize()
+    if "เรื่อง/กิจกรรม" not in df.columns: df["เรื่อง/กิจกรรม"]="ไปราชการ"
+    df=df.dropna(subset=["ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด"])
+    df["ชื่อ-สกุล"]=df["ชื่อ-สกุล"].astype(str).str.strip()
+    df=df[df["ชื่อ-สกุล"].str.lower()!="nan"]
+    df["_source_file"]=source
+    return df[[c for c in TRAVEL_REQUIRED_COLS+["_source_file"] if c in df.columns]]
 
 @st.cache_data(ttl=900)
 def load_all_travel() -> pd.DataFrame:
-    frames: List[pd.DataFrame]=[]
-    for f in list_all_files_in_folder():
-        fname=f.get("name","")
-        if fname in _NON_TRAVEL_FILES or fname.startswith("BAK_"): continue
-        try:
-            df_raw=read_excel_from_drive(fname)
-            if df_raw.empty: continue
-            has_name=any(c in df_raw.columns for c in ["ชื่อ-สกุล","ชื่อพนักงาน","ชื่อ"])
-            if not (has_name and "วันที่เริ่ม" in df_raw.columns and "วันที่สิ้นสุด" in df_raw.columns): continue
-            df_norm=df_raw.copy()
-            for alt in ["ชื่อพนักงาน","ชื่อ","fullname"]:
-                if alt in df_norm.columns and "ชื่อ-สกุล" not in df_norm.columns: df_norm.rename(columns={alt:"ชื่อ-สกุล"},inplace=True)
-            df_norm["วันที่เริ่ม"]=pd.to_datetime(df_norm["วันที่เริ่ม"],errors="coerce").dt.normalize()
-            df_norm["วันที่สิ้นสุด"]=pd.to_datetime(df_norm["วันที่สิ้นสุด"],errors="coerce").dt.normalize()
-            if fname==FILE_NOTIFY or ("ประเภท" in df_norm.columns and "รายละเอียด" in df_norm.columns):
-                df_tl=_extract_travel_from_activity_log(df_norm)
-                if not df_tl.empty: df_tl["_source_file"]=fname; frames.append(df_tl)
-                continue
-            df_norm["_source_file"]=fname
-            if "เรื่อง/กิจกรรม" not in df_norm.columns: df_norm["เรื่อง/กิจกรรม"]=fname.replace(".xlsx","")
-            df_norm=df_norm.dropna(subset=["ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด"])
-            df_norm["ชื่อ-สกุล"]=df_norm["ชื่อ-สกุล"].astype(str).str.strip()
-            df_norm=df_norm[df_norm["ชื่อ-สกุล"].str.lower()!="nan"]
-            if not df_norm.empty: frames.append(df_norm[TRAVEL_REQUIRED_COLS+["_source_file"]])
-        except Exception as e: logger.warning(f"load_all_travel skip {fname}: {e}")
+    frames: List[pd.DataFrame]=_travel_frames_from_manifest()
+    # [FY] ปีงบเก่าของ travel_report.xlsx ที่ย้ายเข้าคลังแล้ว
     try:
-        backup_root=get_or_create_folder(BACKUP_FOLDER_NAME,FOLDER_ID)
-        if backup_root:
-            bak_sub=get_or_create_folder(f"BAK_{FILE_TRAVEL}",backup_root)
-            bak_fid=get_file_id(f"BAK_{FILE_TRAVEL}",bak_sub) if bak_sub else None
-            if bak_fid:
-                df_bak=_read_file_by_id(bak_fid)
-                if not df_bak.empty:
-                    for alt in ["ชื่อพนักงาน","ชื่อ"]:
-                        if alt in df_bak.columns and "ชื่อ-สกุล" not in df_bak.columns: df_bak.rename(columns={alt:"ชื่อ-สกุล"},inplace=True)
-                    df_bak["วันที่เริ่ม"]=pd.to_datetime(df_bak.get("วันที่เริ่ม"),errors="coerce").dt.normalize()
-                    df_bak["วันที่สิ้นสุด"]=pd.to_datetime(df_bak.get("วันที่สิ้นสุด"),errors="coerce").dt.normalize()
-                    if "เรื่อง/กิจกรรม" not in df_bak.columns: df_bak["เรื่อง/กิจกรรม"]="ไปราชการ"
-                    df_bak=df_bak.dropna(subset=["ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด"])
-                    df_bak["ชื่อ-สกุล"]=df_bak["ชื่อ-สกุล"].astype(str).str.strip()
-                    df_bak=df_bak[df_bak["ชื่อ-สกุล"].str.lower()!="nan"]
-                    df_bak["_source_file"]=f"[Backup] {FILE_TRAVEL}"
-                    valid_cols=[c for c in TRAVEL_REQUIRED_COLS+["_source_file"] if c in df_bak.columns]
-                    if not df_bak.empty: frames.append(df_bak[valid_cols])
-    except Exception as e: logger.warning(f"Backup travel read failed: {e}")
+        df_arc=read_fy_archives(FILE_TRAVEL)
+        if not df_arc.empty:
+            df_arc=_normalize_travel_rows(df_arc.copy(),f"[Archive] {FILE_TRAVEL}")
+            if not df_arc.empty: frames.append(df_arc)
+    except Exception as e: logger.warning(f"Archive travel read failed: {e}")
+    # [Journal] บันทึกไปราชการที่ยังไม่ถูกรวมเข้า travel_report.xlsx นับเป็นของไฟล์หลัก
+    df_delta=[_normalize_travel_rows(d.copy(),FILE_TRAVEL) for d in read_delta_frames(list_delta_files()[FILE_TRAVEL])]
+    frames.extend(d for d in df_delta if not d.empty)
     if not frames: return pd.DataFrame(columns=TRAVEL_REQUIRED_COLS+["_source_file"])
     df_all=pd.concat(frames,ignore_index=True)
-    df_all["_rank"]=df_all["_source_file"].apply(lambda s:0 if s==FILE_TRAVEL else(1 if s.startswith("[Backup]") else 2))
+    df_all["_rank"]=(df_all["_source_file"]!=FILE_TRAVEL).astype(int)   # แถวซ้ำ: ไฟล์หลัก (+ delta) ชนะไฟล์อื่น
     return df_all.sort_values(["ชื่อ-สกุล","วันที่เริ่ม","_rank"]).drop_duplicates(subset=["ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด"],keep="first").drop(columns=["_rank"]).reset_index(drop=True)
 
+# ---------------------------
+# 🧳 Travel participants (long format)
+# ---------------------------
+TravelIndex = Dict[str, List[Tuple[dt.date, dt.date, str]]]
+
+def build_travel_participants(df_travel_all: pd.DataFrame, resolver: Optional["StaffResolver"] = None) -> pd.DataFrame:
+    """
+    ตารางผู้เดินทางแบบ long format (trip_id, ชื่อ-สกุล, วันที่เริ่ม, วันที่สิ้นสุด, เรื่อง/กิจกรรม)
+    สร้างครั้งเดียวต่อการโหลดข้อมูล: ผู้เดินทางหลัก + ผู้ร่วมเดินทาง (แตกสตริงแบบ vectorized)
+    trip_id = ลำดับแถวใน cache_travel_all, ชื่อผูกกับ staff_id ผ่าน StaffResolver (-1 = ไม่พบในทะเบียน)
+    """
+    if df_travel_all.empty or not {"วันที่เริ่ม","วันที่สิ้นสุด"} <= set(df_travel_all.columns):
+        return pd.DataFrame(columns=TRAVEL_PARTICIPANT_COLS)
+    df = df_travel_all.reset_index(drop=True)
+    df = df[df["วันที่เริ่ม"].notna() & df["วันที่สิ้นสุด"].notna()]
+    lead = df["ชื่อ-สกุล"].astype(str).str.strip() if "ชื่อ-สกุล" in df.columns else pd.Series(dtype=object)
+    lead = lead[(lead != "") & (lead.str.lower() != "nan")]
+    comp = _split_person_tokens(df[TRAVEL_COMPANION_COL]) if TRAVEL_COMPANION_COL in df.columns else pd.Series(dtype=object)
+    people = pd.concat([lead, comp])
+    if people.empty: return pd.DataFrame(columns=TRAVEL_PARTICIPANT_COLS)
+    proj = (df["เรื่อง/กิจกรรม"].astype(str).str.strip() if "เรื่อง/กิจกรรม" in df.columns
+            else pd.Series("ไปราชการ", index=df.index))
+    people = people.astype(str)
+    out = pd.DataFrame({
+        "trip_id":        people.index.to_numpy(),
+        "staff_id":       resolver.ids(people) if resolver else np.full(len(people), -1, dtype=np.int32),
+        "ชื่อ-สกุล":       resolver.canonical(people) if resolver else people.to_numpy(),
+        "วันที่เริ่ม":      df.loc[people.index, "วันที่เริ่ม"].to_numpy(),
+        "วันที่สิ้นสุด":    df.loc[people.index, "วันที่สิ้นสุด"].to_numpy(),
+        "เรื่อง/กิจกรรม":   proj.loc[people.index].to_numpy(),
+    })
+    return out.drop_duplicates(subset=["trip_id","ชื่อ-สกุล"]).sort_values(["ชื่อ-สกุล","วันที่เริ่ม"]).reset_index(drop=True)
+
+def travel_index_from_participants(df_part: pd.DataFrame) -> TravelIndex:
+    """ชื่อ → [(เริ่ม, สิ้นสุด, เรื่อง)] สำหรับ _get_day_status / build_day_status_table"""
+    if df_part.empty: return {}
+    starts = pd.to_datetime(df_part["วันที่เริ่ม"]).dt.date
+    ends   = pd.to_datetime(df_part["วันที่สิ้นสุด"]).dt.date
+    idx: TravelIndex = {}
+    for name, ts, te, proj in zip(df_part["ชื่อ-สกุล"], starts, ends, df_part["เรื่อง/กิจกรรม"]):
+        idx.setdefault(name, []).append((ts, te, proj))
+    return idx
+
+def get_travel_participants() -> pd.DataFrame:
+    """ตารางผู้เดินทางของ snapshot ปัจจุบัน — สร้างครั้งเดียวต่อการโหลดข้อมูล"""
+    df_all  = get_data("cache_travel_all")   # [Lazy] โหลด travel_all ครั้งแรกสร้างตารางผู้เดินทางไปด้วย
+    df_part = _cache_value("cache_travel_people")
+    if df_part is None:
+        df_part = build_travel_participants(df_all, get_staff_resolver())
+        _publish({"cache_travel_people": df_part})
+    return df_part
+
 # ===========================
 # 🏖️ Holidays
 # ===========================
@@ -1283,13 +2045,13 @@ def load_holidays_raw() -> pd.DataFrame:
             if col not in df.columns: df[col]=""
     return df
 
-def load_holidays_with_id() -> Tuple[pd.DataFrame, Optional[str]]:
-    df,fid=read_excel_with_backup(FILE_HOLIDAYS,dedup_cols=["วันที่","ชื่อวันหยุด"])
+def load_holidays_with_id() -> Tuple[pd.DataFrame, Optional[str], Optional[str]]:
+    df,fid,ver=read_excel_dedup(FILE_HOLIDAYS,dedup_cols=["วันที่","ชื่อวันหยุด"])
     if not df.empty:
         df["วันที่"]=pd.to_datetime(df["วันที่"],errors="coerce"); df=df.dropna(subset=["วันที่"])
         for col in HOLIDAY_COLS:
             if col not in df.columns: df[col]=""
-    return df,fid
+    return df,fid,ver
 
 def load_holidays_all(year: Optional[int]=None) -> pd.DataFrame:
     df_custom=load_holidays_raw(); frames=[]
@@ -1298,10 +2060,82 @@ def load_holidays_all(year: Optional[int]=None) -> pd.DataFrame:
     if not frames: return pd.DataFrame(columns=HOLIDAY_COLS)
     return pd.concat(frames,ignore_index=True).drop_duplicates(subset=["วันที่"]).sort_values("วันที่").reset_index(drop=True)
 
+# ---------------------------
+# 📆 Business-day calendar
+# ---------------------------
+_BUSCAL_YEARS_BACK, _BUSCAL_YEARS_AHEAD = 10, 5
+
+class BusinessCalendar:
+    """
+    ปฏิทินวันทำการ (จ.-ศ. หักวันหยุดราชการ + วันหยุดพิเศษ)
+    คอมไพล์ครั้งเดียวต่อเวอร์ชันไฟล์วันหยุด — นับวันทำการด้วย np.busdaycalendar
+    และหาชื่อวันหยุดด้วย dict O(1)
+    """
+    def __init__(self, df_custom: pd.DataFrame, years: range):
+        names: Dict[dt.date, str] = {}
+        for y in years:  # วันหยุดตายตัวก่อน → ชนะเมื่อวันที่ซ้ำ (เหมือน load_holidays_all)
+            for month, day, name in FIXED_THAI_HOLIDAYS:
+                if _can_make_date(y, month, day): names.setdefault(dt.date(y, month, day), name)
+        self.custom_dates: List[dt.date] = []
+        if not df_custom.empty:
+            d_custom = pd.to_datetime(df_custom["วันที่"], errors="coerce")
+            h_names  = df_custom["ชื่อวันหยุด"] if "ชื่อวันหยุด" in df_custom.columns else pd.Series("", index=df_custom.index)
+            for d, n in zip(d_custom, h_names):
+                if pd.isna(d): continue
+                self.custom_dates.append(d.date())
+                names.setdefault(d.date(), str(n) if str(n).strip() and str(n) != "nan" else "วันหยุดพิเศษ")
+        self.years = years
+        self.names = names
+        self.by_year: Dict[int, List[dt.date]] = {}
+        for d in sorted(names): self.by_year.setdefault(d.year, []).append(d)
+        self.cal = np.busdaycalendar(weekmask="1111100",
+                                     holidays=np.array(sorted(names), dtype="datetime64[D]"))
+
+    def count(self, start_date, end_date) -> int:
+        """จำนวนวันทำการ start..end (รวมปลายทั้งสองด้าน)"""
+        if not start_date or not end_date: return 0
+        s, e = np.datetime64(pd.Timestamp(start_date).date(), "D"), np.datetime64(pd.Timestamp(end_date).date(), "D")
+        return max(0, int(np.busday_count(s, e + 1, busdaycal=self.cal)))
+
+    def count_many(self, starts, ends) -> np.ndarray:
+        """นับวันทำการของหลายช่วงพร้อมกัน (vectorized) — ช่วงที่วันที่ว่างคืน 0"""
+        s = pd.to_datetime(pd.Series(starts), errors="coerce").to_numpy(dtype="datetime64[D]")
+        e = pd.to_datetime(pd.Series(ends),   errors="coerce").to_numpy(dtype="datetime64[D]")
+        ok = ~(np.isnat(s) | np.isnat(e))
+        out = np.zeros(len(s), dtype=np.int64)
+        if ok.any():
+            out[ok] = np.maximum(0, np.busday_count(s[ok], e[ok] + 1, busdaycal=self.cal))
+        return out
+
+    def holiday_name(self, d) -> str:
+        return self.names.get(pd.Timestamp(d).date(), "") if d is not None and not pd.isna(d) else ""
+
+    def holiday_dates(self, year: Optional[int] = None) -> List[dt.date]:
+        if year is None: return sorted(set(self.custom_dates))
+        return list(self.by_year.get(int(year), []))
+
+def _holidays_version(df_custom: pd.DataFrame) -> str:
+    """ลายนิ้วมือของไฟล์วันหยุด — เปลี่ยนเมื่อเพิ่ม/ลบวันหยุด"""
+    if df_custom.empty: return "empty"
+    cols = [c for c in ["วันที่","ชื่อวันหยุด"] if c in df_custom.columns]
+    return f"{len(df_custom)}:{int(pd.util.hash_pandas_object(df_custom[cols], index=False).sum())}"
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _compile_business_calendar(version: str, _df_custom: pd.DataFrame) -> BusinessCalendar:
+    this_year = dt.date.today().year
+    years = [this_year - _BUSCAL_YEARS_BACK, this_year + _BUSCAL_YEARS_AHEAD]
+    if not _df_custom.empty:
+        yrs = pd.to_datetime(_df_custom["วันที่"], errors="coerce").dt.year.dropna()
+        if not yrs.empty: years += [int(yrs.min()), int(yrs.max())]
+    logger.info("BusinessCalendar compiled (version=%s)", version)
+    return BusinessCalendar(_df_custom, range(min(years), max(years) + 1))
+
+def get_business_calendar() -> BusinessCalendar:
+    df_custom = load_holidays_raw()
+    return _compile_business_calendar(_holidays_version(df_custom), df_custom)
+
 def get_holiday_dates(year: Optional[int]=None) -> List[dt.date]:
-    df_h=load_holidays_all(year)
-    if df_h.empty: return []
-    return pd.to_datetime(df_h["วันที่"],errors="coerce").dropna().dt.date.tolist()
+    return get_business_calendar().holiday_dates(year)
 
 # ===========================
 # 👥 Staff & Scan
@@ -1309,7 +2143,115 @@ def get_holiday_dates(year: Optional[int]=None) -> List[dt.date]:
 def get_active_staff(df_staff: pd.DataFrame) -> List[str]:
     if df_staff.empty or "ชื่อ-สกุล" not in df_staff.columns: return []
     df_active=df_staff[df_staff["สถานะ"]=="ปฏิบัติงาน"] if "สถานะ" in df_staff.columns else df_staff
-    return sorted(df_active["ชื่อ-สกุล"].dropna().astype(str).str.strip().unique().tolist())
+    return sorted(clean_person_names(df_active["ชื่อ-สกุล"].dropna()).unique().tolist())
+
+# ---------------------------
+# 🪪 Staff identity resolver
+# ---------------------------
+# ทุกแหล่งข้อมูล (สแกนนิ้ว, ลา, ไปราชการ, คีย์แทน) สะกดชื่อไม่ตรงกัน (คำนำหน้า, ช่องว่าง)
+# → normalize เป็น key แล้วผูกกับ staff_id (ลำดับชื่อในทะเบียน) ครั้งเดียวต่อเวอร์ชันของ staff_master
+_TITLE_PREFIX_RE = (r"^(?:(?:นางสาว|นาง|นาย|น\.ส\.|ว่าที่\s*ร\.ต\.|ดร\.|นพ\.|พญ\.|ทพญ\.|ทพ\.|ภญ\.|ภก\."
+                    r"|mrs\.?|mr\.?|ms\.?|miss)\s*)+")
+
+def clean_person_names(values) -> pd.Index:
+    """strip + ยุบช่องว่างซ้ำ (รูปแบบชื่อที่แสดงผล)"""
+    return pd.Index(values).astype(str).str.strip().str.replace(r"\s+", " ", regex=True)
+
+def staff_name_key(values) -> pd.Index:
+    """key สำหรับจับคู่: ตัดคำนำหน้า, ช่องว่าง, จุด และไม่สนตัวพิมพ์"""
+    return (clean_person_names(values).str.lower()
+            .str.replace(_TITLE_PREFIX_RE, "", regex=True).str.replace(r"[\s.]", "", regex=True))
+
+class StaffResolver:
+    """
+    ชื่อดิบ → staff_id (int, -1 = ไม่อยู่ในทะเบียน)
+    alias table: ชื่อเต็ม + STAFF_ALIAS_COL (exact หลัง clean) และ key ที่ normalize แล้ว (เฉพาะ key ที่ไม่กำกวม)
+    """
+    def __init__(self, df_staff: pd.DataFrame):
+        names = pd.Series(dtype=object)
+        if not df_staff.empty and "ชื่อ-สกุล" in df_staff.columns:
+            names = pd.Series(clean_person_names(df_staff["ชื่อ-สกุล"].astype(object).fillna("")), index=df_staff.index)
+            names = names[(names != "") & (names.str.lower() != "nan")]
+        first = names[~names.duplicated()]
+        self.names = np.array(sorted(first.tolist()), dtype=object)
+        sid = {n: i for i, n in enumerate(self.names)}
+        self.records: Dict[int, dict] = {sid[n]: df_staff.loc[ix].to_dict() for ix, n in first.items()}
+        variants = [(n, sid[n]) for n in self.names]
+        if STAFF_ALIAS_COL in df_staff.columns:
+            for ix, n in first.items():
+                for a in str(df_staff.at[ix, STAFF_ALIAS_COL] or "").replace("\n", ",").split(","):
+                    if a.strip() and a.strip().lower() != "nan": variants.append((a, sid[n]))
+        raw = pd.DataFrame(variants, columns=["name", "sid"])
+        raw["name"] = clean_person_names(raw["name"]) if len(raw) else raw["name"]
+        self.exact: Dict[str, int] = dict(zip(raw["name"], raw["sid"]))
+        raw["key"] = staff_name_key(raw["name"]) if len(raw) else raw["name"]
+        uniq = raw.drop_duplicates(["key", "sid"])
+        uniq = uniq[~uniq["key"].duplicated(keep=False)]
+        self.by_key: Dict[str, int] = dict(zip(uniq["key"], uniq["sid"]))
+
+    def __len__(self) -> int: return len(self.names)
+
+    def _resolve_unique(self, uniq) -> Tuple[pd.Index, np.ndarray]:
+        cleaned = clean_person_names(uniq)
+        ids = pd.Series(cleaned.map(self.exact), dtype="float64")
+        miss = ids.isna().to_numpy()
+        if miss.any():
+            ids[miss] = pd.Series(staff_name_key(cleaned[miss]).map(self.by_key), dtype="float64").to_numpy()
+        return cleaned, ids.fillna(-1).to_numpy(dtype=np.int32)
+
+    def ids(self, values) -> np.ndarray:
+        """vectorized: resolve เฉพาะค่า unique แล้วกระจายกลับ"""
+        codes, uniq = pd.factorize(pd.Series(values, dtype=object))
+        if len(uniq) == 0: return np.full(len(codes), -1, dtype=np.int32)
+        _, u_ids = self._resolve_unique(uniq)
+        return np.where(codes >= 0, u_ids[np.maximum(codes, 0)], -1).astype(np.int32)
+
+    def canonical(self, values) -> np.ndarray:
+        """ชื่อมาตรฐานจากทะเบียน — ไม่พบคืนชื่อที่ clean แล้ว"""
+        codes, uniq = pd.factorize(pd.Series(values, dtype=object))
+        if len(uniq) == 0: return np.full(len(codes), None, dtype=object)
+        cleaned, u_ids = self._resolve_unique(uniq)
+        u_names = np.where(u_ids >= 0, self.names[np.maximum(u_ids, 0)] if len(self.names) else None, cleaned.to_numpy(dtype=object))
+        return np.where(codes >= 0, u_names[np.maximum(codes, 0)], None)
+
+    def resolve(self, name: str) -> int:
+        return int(self.ids([name])[0])
+
+    def info(self, name: str) -> dict:
+        """แถวใน staff_master ของชื่อนี้ ({} ถ้าไม่พบ)"""
+        return self.records.get(self.resolve(name), {})
+
+def _staff_version(df_staff: pd.DataFrame) -> str:
+    if df_staff.empty: return "empty"
+    cols = [c for c in STAFF_MASTER_COLS + [STAFF_ALIAS_COL] if c in df_staff.columns]
+    return f"{len(df_staff)}:{int(pd.util.hash_pandas_object(df_staff[cols].astype(str), index=False).sum())}"
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _compile_staff_resolver(version: str, _df_staff: pd.DataFrame) -> StaffResolver:
+    logger.info("StaffResolver compiled (version=%s)", version)
+    return StaffResolver(_df_staff)
+
+def get_staff_resolver(df_staff: Optional[pd.DataFrame] = None) -> StaffResolver:
+    if df_staff is None: df_staff = get_data("cache_staff")
+    return _compile_staff_resolver(_staff_version(df_staff), df_staff)
+
+def apply_staff_ids(df: pd.DataFrame, resolver: StaffResolver, col: str = "ชื่อ-สกุล") -> pd.DataFrame:
+    """เพิ่ม staff_id + ชื่อมาตรฐาน (STAFF_NAME_COL) แบบ in place — ไม่แตะคอลัมน์ชื่อเดิม (ตารางที่เขียนกลับ Drive ต้องคงชื่อดิบ)"""
+    if df.empty or col not in df.columns: return df
+    raw = df[col]
+    df["staff_id"] = resolver.ids(raw)
+    df[STAFF_NAME_COL] = resolver.canonical(raw)
+    return df
+
+def person_names(df: pd.DataFrame, col: str = "ชื่อ-สกุล") -> pd.Series:
+    """ชื่อสำหรับจับคู่/รวมยอดรายคน: ชื่อมาตรฐานถ้าผูกทะเบียนแล้ว ไม่งั้นชื่อดิบที่ตัดช่องว่าง"""
+    if STAFF_NAME_COL in df.columns: return df[STAFF_NAME_COL].astype(str)
+    return df[col].astype(str).str.strip()
+
+def _with_display_names(df: pd.DataFrame, col: str = "ชื่อ-สกุล") -> pd.DataFrame:
+    """สำเนาที่คอลัมน์ชื่อเป็นชื่อมาตรฐาน — ใช้กับตารางคำนวณที่ไม่เขียนกลับ Drive เท่านั้น (attendance)"""
+    if df.empty or STAFF_NAME_COL not in df.columns: return df
+    return df.assign(**{col: df[STAFF_NAME_COL]})
 
 def get_all_names_fallback(df_leave,df_travel,df_att) -> List[str]:
     all_names=set()
@@ -1343,55 +2285,173 @@ def _parse_delete_scan_detail(detail: str, person: str) -> Optional[tuple]:
         except Exception: return None
     return (person.strip(),d)
 
+# ---------------------------
+# 👆 Manual-scan store (append-only)
+# ---------------------------
+# manual_scan.xlsx เป็น log แบบ append-only: ทุกการคีย์/ลบคือ 1 แถว (_op = add/del, _ts = เวลาบันทึก)
+# สถานะจริง = op ล่าสุดต่อ (ชื่อ-สกุล, วันที่) — ไม่พึ่ง activity_log (ซึ่งเก็บแค่ 500 แถว) อีกต่อไป
+_MANUAL_COMPACT_MIN_DEAD = 50   # compact เมื่อมีแถวที่ถูกแทนที่/tombstone ≥ 50 และ ≥ 25% ของไฟล์
+
+def _coerce_manual_store(df: pd.DataFrame) -> pd.DataFrame:
+    """บังคับ schema ของ store — แถวเก่าที่ไม่มี _op ถือเป็น add"""
+    if df.empty: return pd.DataFrame(columns=MANUAL_SCAN_STORE_COLS)
+    df=df.copy()
+    for col in MANUAL_SCAN_STORE_COLS:
+        if col not in df.columns: df[col]=""
+    df["วันที่"]=pd.to_datetime(df["วันที่"],errors="coerce").dt.normalize()
+    df["ชื่อ-สกุล"]=df["ชื่อ-สกุล"].astype(str).str.strip().str.replace(r"\s+"," ",regex=True)
+    df["_op"]=df["_op"].fillna("").astype(str).str.strip().replace("",MANUAL_OP_ADD)
+    df["_ts"]=df["_ts"].fillna("").astype(str)
+    for col in ["เวลาเข้า","เวลาออก","หมายเหตุ"]: df[col]=df[col].fillna("").astype(str)
+    df=df.dropna(subset=["วันที่"])
+    return df[df["ชื่อ-สกุล"].str.lower()!="nan"][MANUAL_SCAN_STORE_COLS].reset_index(drop=True)
+
+def _latest_manual_ops(df_store: pd.DataFrame) -> pd.DataFrame:
+    """op ล่าสุดต่อ (ชื่อ-สกุล, วันที่) — ลำดับตาม _ts แล้วตามลำดับแถวในไฟล์"""
+    if df_store.empty: return df_store
+    order=np.lexsort((np.arange(len(df_store)),df_store["_ts"].to_numpy()))
+    return df_store.iloc[order].drop_duplicates(subset=["ชื่อ-สกุล","วันที่"],keep="last")
+
+def resolve_manual_scans(df_store: pd.DataFrame) -> pd.DataFrame:
+    """store → รายการสแกนนิ้วที่ยังมีผล (ตัด tombstone)"""
+    last=_latest_manual_ops(df_store)
+    if last.empty: return pd.DataFrame(columns=MANUAL_SCAN_COLS)
+    live=last[last["_op"]!=MANUAL_OP_DEL]
+    return live[MANUAL_SCAN_COLS].sort_values(["ชื่อ-สกุล","วันที่"]).reset_index(drop=True)
+
+def compact_manual_store(df_store: pd.DataFrame) -> pd.DataFrame:
+    """เขียนใหม่เหลือเฉพาะ add ล่าสุดที่ยังมีผล (ตัดแถวที่ถูกแทนที่และ tombstone)"""
+    last=_latest_manual_ops(df_store)
+    return last[last["_op"]!=MANUAL_OP_DEL].sort_values(["ชื่อ-สกุล","วันที่"]).reset_index(drop=True)
+
+@st.cache_data(ttl=900)
+def load_manual_scan_store() -> pd.DataFrame:
+    return _coerce_manual_store(read_excel_versioned(FILE_MANUAL_SCAN)[0])   # sidecar parquet ถ้าตรงเวอร์ชัน
+
 @st.cache_data(ttl=900)
 def load_manual_scans() -> pd.DataFrame:
-    frames: List[pd.DataFrame]=[]
-    df_ms=read_excel_from_drive(FILE_MANUAL_SCAN)
-    if not df_ms.empty:
-        df_ms["วันที่"]=pd.to_datetime(df_ms["วันที่"],errors="coerce").dt.normalize()
-        df_ms["ชื่อ-สกุล"]=df_ms["ชื่อ-สกุล"].astype(str).str.strip()
-        for col in MANUAL_SCAN_COLS:
-            if col not in df_ms.columns: df_ms[col]=""
-        frames.append(df_ms[MANUAL_SCAN_COLS])
-    df_log=read_excel_from_drive(FILE_NOTIFY)
-    if not df_log.empty and "ประเภท" in df_log.columns:
-        deleted_keys=set()
-        for _,row in df_log[df_log["ประเภท"].astype(str).str.strip()=="ลบสแกนนิ้ว"].iterrows():
-            result=_parse_delete_scan_detail(str(row.get("รายละเอียด","")),str(row.get("ผู้เกี่ยวข้อง","")))
-            if result: deleted_keys.add(f"{result[0]}|{result[1]}")
-        log_rows=[]
-        for _,row in df_log[df_log["ประเภท"].astype(str).str.strip()=="คีย์สแกนนิ้ว"].iterrows():
-            rec=_parse_manual_scan_detail(str(row.get("รายละเอียด","")),str(row.get("ผู้เกี่ยวข้อง","")))
-            if rec and f"{rec['ชื่อ-สกุล']}|{rec['วันที่']}" not in deleted_keys: log_rows.append(rec)
-        if log_rows:
-            df_fl=pd.DataFrame(log_rows)
-            for col in MANUAL_SCAN_COLS:
-                if col not in df_fl.columns: df_fl[col]=""
-            frames.append(df_fl[MANUAL_SCAN_COLS])
-    if not frames: return pd.DataFrame(columns=MANUAL_SCAN_COLS)
-    df_all=pd.concat(frames,ignore_index=True)
-    df_all["วันที่"]=pd.to_datetime(df_all["วันที่"],errors="coerce").dt.normalize()
-    df_all["ชื่อ-สกุล"]=df_all["ชื่อ-สกุล"].astype(str).str.strip()
-    df_all=df_all.dropna(subset=["วันที่"]); df_all=df_all[df_all["ชื่อ-สกุล"].str.lower()!="nan"]
-    return df_all.drop_duplicates(subset=["ชื่อ-สกุล","วันที่"],keep="first").sort_values(["ชื่อ-สกุล","วันที่"]).reset_index(drop=True)
+    return resolve_manual_scans(load_manual_scan_store())
+
+def append_manual_scan_ops(ops: List[dict]) -> bool:
+    """
+    ต่อท้าย op (add/del) ลง manual_scan.xlsx — อ่านไฟล์ล่าสุดก่อนเขียนเพื่อไม่ทับของคนอื่น
+    compact อัตโนมัติเมื่อแถวที่ไม่มีผลสะสมเกินเกณฑ์
+    """
+    if not ops: return True
+    df_store,fid,ver=read_excel_versioned(FILE_MANUAL_SCAN)
+    ts=dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    df_new=_coerce_manual_store(pd.DataFrame([{**op,"_ts":op.get("_ts") or ts} for op in ops]))
+    df_upd=pd.concat([_coerce_manual_store(df_store),df_new],ignore_index=True)
+    n_dead=len(df_upd)-int((_latest_manual_ops(df_upd)["_op"]!=MANUAL_OP_DEL).sum())
+    if n_dead>=_MANUAL_COMPACT_MIN_DEAD and n_dead*4>=len(df_upd):
+        logger.info("manual_scan compaction: %d → %d rows",len(df_upd),len(df_upd)-n_dead)
+        df_upd=compact_manual_store(df_upd)
+    ok=write_excel_to_drive(FILE_MANUAL_SCAN,df_upd[MANUAL_SCAN_STORE_COLS],known_file_id=fid,write_through=True,
+                            base_version=ver,merge_key=MANUAL_SCAN_STORE_COLS)
+    if ok:
+        load_manual_scan_store.clear(); load_manual_scans.clear()
+        cache_replace_dataset("manual",resolve_manual_scans(df_upd))
+    return ok
+
+def manual_scans_from_activity_log(df_log: pd.DataFrame) -> List[dict]:
+    """
+    ย้ายข้อมูลเก่า (ครั้งเดียว): แปลงแถว คีย์สแกนนิ้ว/ลบสแกนนิ้ว ใน activity_log เป็น op ของ store
+    ใช้ Timestamp ของ log เป็น _ts เพื่อคงลำดับเดิม
+    """
+    if df_log.empty or "ประเภท" not in df_log.columns: return []
+    ops=[]
+    kind=df_log["ประเภท"].astype(str).str.strip()
+    for _,row in df_log[kind.isin(["คีย์สแกนนิ้ว","ลบสแกนนิ้ว"])].iterrows():
+        detail,person=str(row.get("รายละเอียด","")),str(row.get("ผู้เกี่ยวข้อง",""))
+        ts=pd.to_datetime(row.get("Timestamp"),errors="coerce"); ts="" if pd.isna(ts) else str(ts)
+        if str(row["ประเภท"]).strip()=="ลบสแกนนิ้ว":
+            res=_parse_delete_scan_detail(detail,person)
+            if res: ops.append({"ชื่อ-สกุล":res[0],"วันที่":res[1],"_op":MANUAL_OP_DEL,"_ts":ts})
+        else:
+            rec=_parse_manual_scan_detail(detail,person)
+            if rec: ops.append({**rec,"_op":MANUAL_OP_ADD,"_ts":ts})
+    return ops
+
+MANUAL_MIGRATED_PROP = "legacy_migrated"   # appProperties ของ manual_scan.xlsx: ย้าย op จาก activity_log แล้ว (ถาวร ข้าม restart)
+
+@st.cache_resource(show_spinner=False)
+def _manual_migration_state() -> dict:
+    return {"lock": threading.Lock(), "done": False}
+
+def _mark_manual_migrated(file_id: str) -> None:
+    try: _drive_execute(lambda: get_drive_service().files().update(fileId=file_id, body={"appProperties": {MANUAL_MIGRATED_PROP: "1"}},
+                                                                  supportsAllDrives=True, fields="id"))
+    except Exception as e: logger.warning("manual_scan: mark migrated: %s", e)   # ไม่ได้ → process หน้าเทียบ store ซ้ำ (ไม่เกิดแถวซ้ำ)
+
+def migrate_legacy_manual_scans() -> int:
+    """
+    ย้าย op คีย์/ลบสแกนนิ้วที่ยังเหลือใน activity_log.xlsx เดิมเข้า store อัตโนมัติ (ครั้งเดียว, ก่อนโหลด manual)
+    เทียบทั้ง (ชื่อ, วันที่, _op, _ts) กับ store → รันซ้ำ/ต่อจากการย้ายด้วยมือไม่เกิดแถวซ้ำ → คืนจำนวน op ที่ต่อเพิ่ม
+    ย้ายเสร็จ → จด MANUAL_MIGRATED_PROP บนไฟล์ store: compaction ตัด add ที่ถูกลบทิ้งไปแล้ว ถ้าย้ายซ้ำ scan ที่ลบจะกลับมา
+    """
+    state=_manual_migration_state()
+    if state["done"] or not state["lock"].acquire(blocking=False): return 0
+    try:
+        meta=get_file_meta(FILE_MANUAL_SCAN, sidecar=_wants_sidecar(FILE_MANUAL_SCAN))
+        if meta and (meta.get("appProperties") or {}).get(MANUAL_MIGRATED_PROP): state["done"]=True; return 0
+        ops=manual_scans_from_activity_log(read_excel_from_drive(FILE_NOTIFY))
+        if not ops: state["done"]=True; return 0
+        fid,ver=(meta or {}).get("id"),(meta or {}).get("modifiedTime")
+        df_store=_coerce_manual_store(read_file_meta(meta, meta.get("sidecar")) if meta else pd.DataFrame())
+        df_ops=_coerce_manual_store(pd.DataFrame(ops))
+        key=["ชื่อ-สกุล","วันที่","_op","_ts"]
+        df_new=df_ops[~df_ops.set_index(key).index.isin(df_store.set_index(key).index)]
+        if not df_new.empty and not write_excel_to_drive(FILE_MANUAL_SCAN,pd.concat([df_store,df_new],ignore_index=True)[MANUAL_SCAN_STORE_COLS],
+                                                         known_file_id=fid,write_through=True,base_version=ver,merge_key=MANUAL_SCAN_STORE_COLS):
+            return 0   # เขียนไม่ผ่าน → ลองใหม่ตอนโหลด manual รอบหน้า
+        if not df_new.empty: logger.info("manual_scan: migrated %d legacy ops from %s", len(df_new), FILE_NOTIFY)
+        fid=fid or (get_file_meta(FILE_MANUAL_SCAN) or {}).get("id")   # store เพิ่งถูกสร้างจากการย้าย
+        if fid: _mark_manual_migrated(fid)
+        state["done"]=True
+        return len(df_new)
+    finally:
+        state["lock"].release()
+
+def _name_day_keys(names: pd.Series, days: pd.Series, vocab: pd.Index) -> np.ndarray:
+    """(ชื่อ, วันที่) → int64 key = staff_code<<32 | day — normalize ชื่อเฉพาะค่า unique"""
+    codes, uniq = pd.factorize(names.astype(object), use_na_sentinel=True)
+    clean = pd.Index(uniq).astype(str).str.strip().str.replace(r"\s+", " ", regex=True)
+    staff = np.where(codes >= 0, vocab.get_indexer(clean)[np.maximum(codes, 0)], -1).astype(np.int64)
+    day = pd.to_datetime(days, errors="coerce").to_numpy(dtype="datetime64[ns]").astype("datetime64[D]").view(np.int64)
+    return (staff << 32) | (day & 0xFFFFFFFF)
+
+def _unique_clean_names(names: pd.Series) -> np.ndarray:
+    return pd.Index(pd.unique(names.astype(object))).astype(str).str.strip().str.replace(r"\s+"," ",regex=True).to_numpy()
+
+def _with_scan_source(df: pd.DataFrame, codes: np.ndarray) -> pd.DataFrame:
+    df=df.copy(); df["_source"]=pd.Categorical.from_codes(codes,categories=["scan","manual"])
+    return df
 
 @st.cache_data(ttl=900, show_spinner=False)
 def merge_attendance_with_manual(df_att: pd.DataFrame, df_manual: pd.DataFrame) -> pd.DataFrame:
-    if df_manual.empty: return df_att
-    if df_att.empty: df_manual_out=df_manual.copy(); df_manual_out["_source"]="manual"; return df_manual_out
-    df_att_work=df_att.copy(); df_manual_work=df_manual.copy()
-    att_name_col=next((c for c in ["ชื่อ-สกุล","ชื่อพนักงาน","ชื่อ"] if c in df_att_work.columns),None)
-    if att_name_col is None: return df_att_work
-    if att_name_col!="ชื่อ-สกุล": df_att_work=df_att_work.rename(columns={att_name_col:"ชื่อ-สกุล"})
-    df_att_work["วันที่"]=pd.to_datetime(df_att_work["วันที่"],errors="coerce").dt.normalize()
-    df_manual_work["วันที่"]=pd.to_datetime(df_manual_work["วันที่"],errors="coerce").dt.normalize()
-    df_att_work["ชื่อ-สกุล"]=df_att_work["ชื่อ-สกุล"].astype(str).str.strip().str.replace(r"\s+"," ",regex=True)
-    df_manual_work["ชื่อ-สกุล"]=df_manual_work["ชื่อ-สกุล"].astype(str).str.strip().str.replace(r"\s+"," ",regex=True)
-    att_keys=set(df_att_work["ชื่อ-สกุล"].astype(str)+"|"+df_att_work["วันที่"].astype(str))
-    df_manual_new=df_manual_work[~(df_manual_work["ชื่อ-สกุล"].astype(str)+"|"+df_manual_work["วันที่"].astype(str)).isin(att_keys)].copy()
-    if df_manual_new.empty: return df_att_work
-    df_manual_new["_source"]="manual"; df_att_work["_source"]="scan"
-    return pd.concat([df_att_work,df_manual_new],ignore_index=True).sort_values(["ชื่อ-สกุล","วันที่"]).reset_index(drop=True)
+    """
+    รวมสแกนนิ้วจริง + รายการคีย์แทน (anti-join): ใช้ manual เฉพาะ (ชื่อ, วัน) ที่ไม่มีในสแกนจริง
+    key เป็น int64 (staff_code, day) แทนการต่อสตริงทุกแถว; _source เป็น category scan/manual
+    ผลลัพธ์มีคอลัมน์ ชื่อ-สกุล + _source เสมอ ไม่ว่าจะมี manual หรือไม่
+    """
+    att_name_col=next((c for c in ["ชื่อ-สกุล","ชื่อพนักงาน","ชื่อ"] if c in df_att.columns),None)
+    if att_name_col not in (None,"ชื่อ-สกุล"): df_att=df_att.rename(columns={att_name_col:"ชื่อ-สกุล"})
+    has_names=att_name_col is not None and not df_att.empty
+    if df_manual.empty: return _with_scan_source(df_att,np.zeros(len(df_att),dtype=np.int8))
+    vocab=pd.Index(np.unique(np.concatenate([_unique_clean_names(df_att["ชื่อ-สกุล"]) if has_names else np.array([],dtype=object),
+                                             _unique_clean_names(df_manual["ชื่อ-สกุล"])])))   # เรียงตามชื่อ → staff_code เรียงตามชื่อด้วย
+    att_keys=_name_day_keys(df_att["ชื่อ-สกุล"],df_att["วันที่"],vocab) if has_names else np.array([],dtype=np.int64)
+    man_keys=_name_day_keys(df_manual["ชื่อ-สกุล"],df_manual["วันที่"],vocab)
+    is_new=~np.isin(man_keys,att_keys)
+    if not is_new.any(): return _with_scan_source(df_att,np.zeros(len(df_att),dtype=np.int8))
+    df_manual_new=df_manual.loc[is_new].copy()
+    df_manual_new["วันที่"]=pd.to_datetime(df_manual_new["วันที่"],errors="coerce").dt.normalize()
+    out=pd.concat([df_att,df_manual_new],ignore_index=True) if not df_att.empty else df_manual_new.reset_index(drop=True)
+    n_att=len(out)-len(df_manual_new)
+    out=_with_scan_source(out,np.r_[np.zeros(n_att,dtype=np.int8),np.ones(len(df_manual_new),dtype=np.int8)])
+    if not has_names: return out
+    order=np.argsort(np.r_[att_keys,man_keys[is_new]],kind="stable")   # = sort (ชื่อ, วันที่)
+    return out.take(order).reset_index(drop=True)
 
 # ===========================
 # 🔔 Notifications & Audit
@@ -1414,15 +2474,337 @@ def format_travel_notify(persons: List[str], project: str, location: str, d_star
     names_str=", ".join(persons[:5])+(f" และอีก {len(persons)-5} คน" if len(persons)>5 else "")
     return f"\n✈️ แจ้งไปราชการ — สคร.9\n👥 {names_str}\n📌 {project}\n📍 {location}\n📅 {d_start.strftime('%d/%m/%Y')} ถึง {d_end.strftime('%d/%m/%Y')} ({days} วันทำการ)"
 
+# ---------------------------
+# 📝 Activity log writer (batched, async)
+# ---------------------------
+_LOG_FLUSH_MAX = 20   # event ค้างครบเท่านี้ → ปลุก writer ทันที
+_LOG_FLUSH_SEC = 30   # ไม่งั้น flush ทุกกี่วินาที
+
 def log_activity(action_type: str, detail: str, persons: str = "") -> None:
+    """[Async log] ต่อ event ลง spool ในเครื่อง (ไม่แตะ Drive ไม่บล็อกฟอร์ม) — writer เบื้องหลัง flush เป็นชุด"""
+    new_row={"Timestamp":dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"ประเภท":action_type,"รายละเอียด":str(detail).replace("\n"," ")[:500],"ผู้เกี่ยวข้อง":persons}
     try:
-        df_log,_notify_fid=read_excel_with_backup(FILE_NOTIFY)
-        if df_log.empty: df_log=pd.DataFrame(columns=ACTIVITY_LOG_COLS)
-        new_row={"Timestamp":dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"ประเภท":action_type,"รายละเอียด":str(detail).replace("\n"," ")[:500],"ผู้เกี่ยวข้อง":persons}
-        df_log=pd.concat([df_log,pd.DataFrame([new_row])],ignore_index=True).tail(500).reset_index(drop=True)
-        write_excel_to_drive(FILE_NOTIFY,df_log,known_file_id=_notify_fid)
+        state=_activity_writer()
+        with state["lock"]:
+            os.makedirs(LOCAL_CACHE_DIR,exist_ok=True)
+            with open(ACTIVITY_SPOOL_PATH,"a",encoding="utf-8") as f: f.write(json.dumps(new_row,ensure_ascii=False)+"\n")
+            state["pending"]+=1
+            if state["pending"]>=_LOG_FLUSH_MAX: state["wake"].set()
     except Exception as e: logger.warning(f"log_activity failed: {e}")
 
+def _spool_batches() -> List[str]:
+    """ชุดที่ถูกตัดออกจาก spool แล้วแต่ยังส่งไม่สำเร็จ (*.flushing) เรียงตามเวลาตัด"""
+    folder,base=os.path.split(ACTIVITY_SPOOL_PATH)
+    try: names=os.listdir(folder)
+    except OSError: return []
+    return sorted(os.path.join(folder,n) for n in names if n.startswith(base+".") and n.endswith(".flushing"))
+
+def _read_spool(path: str) -> List[dict]:
+    rows: List[dict]=[]
+    try:
+        with open(path,encoding="utf-8") as f:
+            for line in f:
+                try: rows.append(json.loads(line))
+                except ValueError: pass   # บรรทัดที่เขียนไม่ครบตอน process ตาย
+    except OSError: pass
+    return rows
+
+def pending_activity_rows() -> pd.DataFrame:
+    """event ที่ยังรอ flush (ให้หน้ากิจกรรมล่าสุดแสดงได้ทันที)"""
+    rows=[r for p in _spool_batches()+[ACTIVITY_SPOOL_PATH] for r in _read_spool(p)]
+    return pd.DataFrame(rows,columns=ACTIVITY_LOG_COLS)
+
+# คลัง log แยกไฟล์รายเดือน (ไม่จำกัดจำนวนแถว) + index ช่วงเวลา/ประเภท/ผู้เกี่ยวข้องของแต่ละเดือน
+# activity_log.xlsx เดิมถูกย้ายเข้าคลังครั้งเดียวตอน flush แรก (ไฟล์เดิมไม่ถูกแก้)
+ACTIVITY_FOLDER_NAME = "_ACTIVITY_LOG"
+ACTIVITY_INDEX_FILE  = "activity_log_index.xlsx"
+ACTIVITY_INDEX_COLS  = ["segment","first_ts","last_ts","rows","types","persons"]
+
+def _activity_segment_file(segment: str) -> str:
+    return f"activity_log_{segment}.xlsx"
+
+def _activity_segment_keys(df_log: pd.DataFrame) -> pd.Series:
+    return pd.to_datetime(df_log["Timestamp"], errors="coerce").dt.strftime("%Y-%m").fillna("unknown")
+
+def _activity_folder_id() -> Optional[str]:
+    state = _activity_writer()
+    if state.get("folder") is None: state["folder"] = get_or_create_folder(ACTIVITY_FOLDER_NAME, FOLDER_ID)
+    return state["folder"]
+
+def _activity_index_row(segment: str, df_seg: pd.DataFrame) -> dict:
+    ts = df_seg["Timestamp"].astype(str)
+    persons = _split_person_tokens(df_seg["ผู้เกี่ยวข้อง"])
+    return {"segment": segment, "first_ts": ts.min(), "last_ts": ts.max(), "rows": len(df_seg),
+            "types": "|".join(sorted(df_seg["ประเภท"].dropna().astype(str).unique())),
+            "persons": "|".join(sorted(set(persons.astype(str))))}
+
+def activity_archive() -> Tuple[pd.DataFrame, Dict[str, dict]]:
+    """(index เรียงเดือนใหม่→เก่า, {ชื่อไฟล์: meta}) — list โฟลเดอร์ครั้งเดียว + อ่าน index ตามเวอร์ชัน"""
+    folder = _activity_folder_id()
+    files = {f["name"]: f for f in (list_all_files_in_folder(folder, mime=None) if folder else [])}   # xlsx + sidecar
+    meta = files.get(ACTIVITY_INDEX_FILE)
+    idx = _read_file_version(meta["id"], meta.get("modifiedTime", "")) if meta else pd.DataFrame()
+    if idx.empty: idx = pd.DataFrame(columns=ACTIVITY_INDEX_COLS)
+    idx = idx.fillna("").astype({"segment": str, "types": str, "persons": str})
+    return idx.sort_values("segment", ascending=False).reset_index(drop=True), files
+
+def append_activity_archive(df_new: pd.DataFrame) -> bool:
+    """
+    ต่อ event เข้าไฟล์เดือนของมัน (อ่าน/เขียนเฉพาะเดือนที่มี event ใหม่) แล้วอัปเดต index
+    list โฟลเดอร์ใหม่ทุกครั้ง (ไม่ใช้ cache ttl): meta ที่ค้างทำให้เขียนทับเดือน/ย้าย log เดิมซ้ำโดยไม่มี base_version
+    """
+    folder = _activity_folder_id()
+    if not folder: return False
+    list_all_files_in_folder.clear(folder, mime=None)
+    try: return _append_activity_archive(folder, df_new)
+    finally: list_all_files_in_folder.clear(folder, mime=None)   # ผู้อ่าน (read_activity_feed) เห็นเดือน/index ใหม่ทันที
+
+def _append_activity_archive(folder: str, df_new: pd.DataFrame) -> bool:
+    idx, files = activity_archive()
+    if idx.empty and not any(n.startswith("activity_log_") and n.endswith(".xlsx") and n != ACTIVITY_INDEX_FILE for n in files):
+        df_legacy = read_excel_from_drive(FILE_NOTIFY)   # ย้าย log เดิมเข้าคลังครั้งแรก
+        if not df_legacy.empty: df_new = pd.concat([df_legacy.reindex(columns=ACTIVITY_LOG_COLS), df_new], ignore_index=True)
+    idx = idx.set_index("segment")
+    for seg, grp in df_new.groupby(_activity_segment_keys(df_new)):
+        name = _activity_segment_file(seg); meta = files.get(name)
+        df_seg = read_file_meta(meta, files.get(_sidecar_name(name))) if meta else pd.DataFrame(columns=ACTIVITY_LOG_COLS)
+        # retry หลัง flush ล้มเหลวกลางทาง → event เดิมไม่ซ้ำ
+        df_seg = pd.concat([df_seg, grp], ignore_index=True).drop_duplicates(subset=ACTIVITY_LOG_COLS)
+        if not write_excel_to_drive(name, df_seg, known_file_id=meta["id"] if meta else None, write_through=True,
+                                    parent_id=folder, base_version=(meta or {}).get("modifiedTime"),
+                                    merge_key=ACTIVITY_LOG_COLS): return False
+        idx.loc[seg] = pd.Series(_activity_index_row(seg, df_seg)).drop("segment")
+    meta = files.get(ACTIVITY_INDEX_FILE)
+    return write_excel_to_drive(ACTIVITY_INDEX_FILE, idx.reset_index()[ACTIVITY_INDEX_COLS],
+                                known_file_id=meta["id"] if meta else None, write_through=True, parent_id=folder,
+                                base_version=(meta or {}).get("modifiedTime"), merge_key=["segment"])
+
+def read_activity_feed(limit: int = 50, action_type: str = "", person: str = "", segment: str = "") -> pd.DataFrame:
+    """
+    event ล่าสุดจากคลัง — อ่านเฉพาะไฟล์เดือนที่ index บอกว่าอาจตรงเงื่อนไข (ใหม่→เก่า จนครบ limit)
+    segment: ระบุเดือน (YYYY-MM) → อ่านเดือนเดียว; ยังไม่มีคลัง → อ่าน activity_log.xlsx เดิม
+    """
+    idx, files = activity_archive()
+    if idx.empty:
+        frames = [read_excel_from_drive(FILE_NOTIFY)]
+    else:
+        cand = idx
+        if segment:     cand = cand[cand["segment"] == segment]
+        if action_type: cand = cand[cand["types"].str.split("|").apply(lambda t: action_type in t)]
+        if person:      cand = cand[cand["persons"].str.contains(person, regex=False)]
+        frames, n = [], 0
+        for seg in cand["segment"]:
+            name = _activity_segment_file(seg); meta = files.get(name)
+            if not meta: continue
+            frames.append(read_file_meta(meta, files.get(_sidecar_name(name))))
+            n += len(frames[-1])
+            if n >= limit and not (action_type or person): break
+    frames.append(pending_activity_rows())
+    if segment: frames[-1] = frames[-1][_activity_segment_keys(frames[-1]) == segment]
+    df = pd.concat([f for f in frames if not f.empty], ignore_index=True) if any(not f.empty for f in frames) else pd.DataFrame(columns=ACTIVITY_LOG_COLS)
+    if df.empty: return df
+    if action_type: df = df[df["ประเภท"] == action_type]
+    if person:      df = df[df["ผู้เกี่ยวข้อง"].astype(str).str.contains(person, regex=False, na=False)]
+    return df.sort_values("Timestamp", ascending=False).head(limit)
+
+def flush_activity_log(state: Optional[dict] = None) -> int:
+    """
+    ส่ง event ที่ค้างเข้าคลัง log รายเดือนในครั้งเดียว → คืนจำนวน event
+    spool ปัจจุบันถูกเปลี่ยนชื่อเป็นชุด .flushing ก่อน (event ใหม่ไปไฟล์ใหม่) — ส่งไม่สำเร็จ ชุดยังอยู่ ลองใหม่รอบหน้า/หลัง restart
+    """
+    state=state or _activity_writer()
+    with state["lock"]:
+        if os.path.exists(ACTIVITY_SPOOL_PATH):
+            os.replace(ACTIVITY_SPOOL_PATH,f"{ACTIVITY_SPOOL_PATH}.{time.time_ns()}.flushing")
+        state["pending"]=0
+    batches=_spool_batches()
+    rows=[r for p in batches for r in _read_spool(p)]
+    if rows and not append_activity_archive(pd.DataFrame(rows,columns=ACTIVITY_LOG_COLS)): return 0
+    for p in batches:
+        try: os.remove(p)
+        except OSError: pass
+    if rows: logger.info("Activity log flushed: %d events", len(rows))
+    return len(rows)
+
+def _activity_flush_loop(state: dict) -> None:
+    _refresh_local.background=True   # ไม่มี session — เขียน snapshot ได้แต่ไม่ผูก session
+    while True:
+        try: flush_activity_log(state)   # รอบแรก: ส่งของค้างจาก process ก่อนหน้า
+        except Exception as e: logger.warning(f"activity log flush failed: {e}")
+        state["wake"].wait(timeout=_LOG_FLUSH_SEC); state["wake"].clear()
+
+@st.cache_resource(show_spinner=False)
+def _activity_writer() -> dict:
+    """[Async log] writer 1 ตัวต่อ process: flush เมื่อค้างครบ _LOG_FLUSH_MAX หรือทุก _LOG_FLUSH_SEC วินาที"""
+    state={"lock":threading.Lock(),"wake":threading.Event(),"pending":0}
+    state["thread"]=threading.Thread(target=_activity_flush_loop,args=(state,),name="activity-log-writer",daemon=True)
+    state["thread"].start()
+    return state
+
+# ---------------------------
+# 📎 Attachment upload pipeline (spool + background resumable upload)
+# ---------------------------
+# [Attach] ฟอร์มเขียน PDF ลงเครื่อง + บันทึกแถวด้วยลิงก์ pending แล้วตอบทันที — uploader เบื้องหลังอัปโหลดแบบ resumable ทีละ chunk
+# เสร็จ → เติมลิงก์จริงในไฟล์ delta ของแถวนั้น (หรือไฟล์หลักถ้ารวมไปแล้ว) + snapshot; ล้มเหลว → ลองใหม่แบบ backoff
+ATTACHMENT_PENDING_PREFIX = "⏳ pending:"
+_ATTACH_CHUNK_SIZE   = 2 * 1024 * 1024   # พหุคูณของ 256 KB ตามข้อกำหนด resumable upload
+_ATTACH_MAX_ATTEMPTS = 8                 # ครบแล้วหยุดรอ admin กดลองใหม่
+_ATTACH_POLL_SEC     = 60
+_ATTACH_ORPHAN_SEC   = 24 * 3600         # PDF ที่ไม่เคยเข้าคิว (บันทึกแถวไม่สำเร็จ/process ตาย) เก่ากว่านี้ → ลบ
+
+def pending_attachment_link(upload_id: str) -> str:
+    return f"{ATTACHMENT_PENDING_PREFIX}{upload_id}"
+
+def _attachment_path(upload_id: str, ext: str) -> str:
+    return os.path.join(ATTACHMENT_SPOOL_DIR, f"{upload_id}.{ext}")
+
+def spool_attachment(uploaded_file) -> str:
+    """เขียน PDF ลงเครื่อง → upload id (ยังไม่อัปโหลดจนกว่า queue_attachment — แถวบันทึกไม่สำเร็จก็ไม่มีไฟล์ค้างบน Drive)"""
+    os.makedirs(ATTACHMENT_SPOOL_DIR, exist_ok=True)
+    upload_id = f"{dt.datetime.now().strftime('%Y%m%dT%H%M%S')}_{os.urandom(4).hex()}"
+    with open(_attachment_path(upload_id, "pdf"), "wb") as f: f.write(uploaded_file.getvalue())
+    return upload_id
+
+def _write_attachment_job(job: dict) -> None:
+    tmp = _attachment_path(job["id"], "json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f: json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp, _attachment_path(job["id"], "json"))
+
+def queue_attachment(upload_id: str, name: str, target: str, delta_id: Optional[str]) -> None:
+    """แถวที่มีลิงก์ pending บันทึกแล้ว → เข้าคิว + ปลุก uploader (target = ไฟล์หลัก, delta_id = ไฟล์ delta ของแถว)"""
+    _write_attachment_job({"id": upload_id, "name": name, "target": target, "delta_id": delta_id,
+                           "attempts": 0, "next_try": 0.0, "failed": False, "file_id": None, "link": None, "error": ""})
+    _attachment_uploader()["wake"].set()
+
+def discard_attachment(upload_id: str) -> None:
+    for ext in ("pdf", "json"):
+        try: os.remove(_attachment_path(upload_id, ext))
+        except OSError: pass
+
+def list_attachment_jobs() -> List[dict]:
+    """งานในคิว เรียงตามเวลาส่ง (upload id ขึ้นต้นด้วยเวลา)"""
+    try: names = sorted(os.listdir(ATTACHMENT_SPOOL_DIR))
+    except OSError: return []
+    jobs: List[dict] = []
+    for n in names:
+        if not n.endswith(".json"): continue
+        try:
+            with open(os.path.join(ATTACHMENT_SPOOL_DIR, n), encoding="utf-8") as f: jobs.append(json.load(f))
+        except (OSError, ValueError): pass
+    return jobs
+
+def retry_attachment_jobs() -> int:
+    """admin: งานที่หยุดไปแล้วกลับเข้าคิวทันที → จำนวนงาน"""
+    jobs = [j for j in list_attachment_jobs() if j.get("failed") or j.get("attempts")]
+    for job in jobs:
+        job.update(failed=False, attempts=0, next_try=0.0); _write_attachment_job(job)
+    _attachment_uploader()["wake"].set()
+    return len(jobs)
+
+def _attachment_folder_id(state: dict) -> Optional[str]:
+    if state.get("folder") is None: state["folder"] = get_or_create_folder(ATTACHMENT_FOLDER_NAME, FOLDER_ID)
+    return state["folder"]
+
+def upload_pdf_resumable(path: str, name: str, folder_id: str) -> dict:
+    """อัปโหลดแบบ resumable ทีละ _ATTACH_CHUNK_SIZE — chunk ที่ล้ม (5xx/429/เครือข่าย) ส่งซ้ำต่อจากเดิม → {id, webViewLink}"""
+    media = MediaFileUpload(path, mimetype="application/pdf", chunksize=_ATTACH_CHUNK_SIZE, resumable=True)
+    req = get_drive_service().files().create(body={"name": name, "parents": [folder_id]}, media_body=media,
+                                             supportsAllDrives=True, fields="id,webViewLink")
+    res = None
+    while res is None: _, res = req.next_chunk(num_retries=5)
+    return res
+
+def cache_backfill_value(dataset: str, col: str, old: str, new: str) -> None:
+    """แทนค่าในคอลัมน์ของ snapshot ล่าสุด (dataset + <dataset>_all ถ้าโหลดไว้) — เรียกจาก thread เบื้องหลังได้ (ไม่แตะ session)"""
+    store = _snapshot_store()
+    with store["lock"]:
+        snap = store["snap"]
+        if snap is None: return
+        upd, versions = {}, dict(snap.ds_version)
+        for name in (dataset, f"{dataset}_all"):
+            df = snap.get(f"cache_{name}")
+            if not isinstance(df, pd.DataFrame) or col not in df.columns: continue
+            hit = df[col].astype(str) == old
+            if not hit.any(): continue
+            df = _thaw(df); df.loc[hit, col] = new
+            upd[f"cache_{name}"] = df; versions[name] = versions.get(name, 0) + 1
+        if upd: _publish(upd, ds_version=versions)
+
+def backfill_attachment_link(job: dict) -> bool:
+    """แทนลิงก์ pending ด้วยลิงก์จริงในแถวที่บันทึกไว้ → True เมื่อเสร็จ (หรือไม่พบแถวแล้ว) / False = ลองใหม่รอบหน้า"""
+    target, pending = job["target"], pending_attachment_link(job["id"])
+    state = _delta_state()
+    if not state["lock"].acquire(blocking=False): return False   # compaction / ย้ายปีงบเขียนไฟล์เดียวกันอยู่
+    try:
+        try:   # ถามตรงตาม id (รายการ delta ใน cache อาจยังมี delta ที่รวมไปแล้ว)
+            meta = _drive_execute(lambda: get_drive_service().files().get(fileId=job["delta_id"], fields="id,name,modifiedTime,trashed",
+                                                                         supportsAllDrives=True)) if job.get("delta_id") else None
+        except HttpError: meta = None
+        if meta and not meta.get("trashed"):
+            name, parent, df, fid, ver = meta["name"], _delta_folder_id(), _download_excel(meta["id"]), meta["id"], meta.get("modifiedTime")
+        else:   # delta ถูกรวมเข้าไฟล์หลักแล้ว
+            (df, fid, ver), name, parent = read_excel_versioned(target), target, FOLDER_ID
+        hit = df["ไฟล์แนบ"].astype(str) == pending if "ไฟล์แนบ" in df.columns else pd.Series(False, index=df.index)
+        if not hit.any():
+            logger.warning("backfill_attachment_link: ไม่พบแถวของ %s ใน %s", job["id"], name); return True
+        df = df.astype({"ไฟล์แนบ": object}); df.loc[hit, "ไฟล์แนบ"] = job["link"]
+        # ไม่ merge เมื่อชน: อ่าน/แทนใหม่รอบหน้าจากเวอร์ชันล่าสุด
+        if not write_excel_to_drive(name, df, known_file_id=fid, write_through=True, parent_id=parent, base_version=ver): return False
+        if name != target:   # แก้ delta ในที่ → ประกาศรุ่นใหม่ให้ fingerprint ของ process อื่นเปลี่ยน
+            try: _drive_execute(lambda: get_drive_service().files().update(fileId=fid, body={"appProperties": {DELTA_EDIT_PROP: str(time.time_ns())}},
+                                                                          supportsAllDrives=True, fields="id"))
+            except Exception as e: logger.warning("backfill_attachment_link: mark %s edited: %s", name, e)
+            list_all_files_in_folder.clear(parent)
+    finally:
+        state["lock"].release()
+    cache_backfill_value(DELTA_TARGETS[target][0], "ไฟล์แนบ", pending, job["link"])
+    return True
+
+def process_attachment_jobs(state: dict) -> int:
+    """งานที่ถึงรอบ: อัปโหลด (ถ้ายังไม่ขึ้น) → เติมลิงก์ → ลบไฟล์ในเครื่อง; ล้มเหลว → backoff 1 นาที..1 ชม. — คืนจำนวนงานที่เสร็จ"""
+    done, now = 0, time.time()
+    for job in list_attachment_jobs():
+        if job.get("failed") or job.get("next_try", 0) > now: continue
+        try:
+            if not job.get("link"):
+                folder = _attachment_folder_id(state)
+                if not folder: raise RuntimeError(f"สร้างโฟลเดอร์ {ATTACHMENT_FOLDER_NAME} ไม่ได้")
+                res = upload_pdf_resumable(_attachment_path(job["id"], "pdf"), job["name"], folder)
+                job.update(file_id=res.get("id"), link=res.get("webViewLink") or "-")
+                _write_attachment_job(job)   # ขึ้น Drive แล้ว → รอบหน้าไม่อัปซ้ำ แม้เติมลิงก์ไม่สำเร็จ
+            if not backfill_attachment_link(job): continue
+            discard_attachment(job["id"]); done += 1
+            logger.info("Attachment uploaded: %s → %s", job["name"], job["target"])
+        except Exception as e:
+            job["attempts"] = job.get("attempts", 0) + 1
+            job.update(error=str(e)[:300], next_try=now + min(30 * 2 ** job["attempts"], 3600),
+                       failed=job["attempts"] >= _ATTACH_MAX_ATTEMPTS)
+            logger.warning("attachment %s (attempt %d): %s", job["id"], job["attempts"], e)
+            _write_attachment_job(job)
+    queued = {j["id"] for j in list_attachment_jobs()}
+    try: names = os.listdir(ATTACHMENT_SPOOL_DIR)
+    except OSError: names = []
+    for n in names:
+        path = os.path.join(ATTACHMENT_SPOOL_DIR, n)
+        if n.endswith(".pdf") and n[:-4] not in queued and now - os.path.getmtime(path) > _ATTACH_ORPHAN_SEC:
+            discard_attachment(n[:-4])
+    return done
+
+def _attachment_upload_loop(state: dict) -> None:
+    _refresh_local.background = True   # ไม่มี session — เขียน snapshot ได้แต่ไม่ผูก session
+    while True:
+        try: process_attachment_jobs(state)   # รอบแรก: งานค้างจาก process ก่อนหน้า
+        except Exception as e: logger.warning("attachment uploader failed: %s", e)
+        state["wake"].wait(timeout=_ATTACH_POLL_SEC); state["wake"].clear()
+
+@st.cache_resource(show_spinner=False)
+def _attachment_uploader() -> dict:
+    """[Attach] uploader 1 ตัวต่อ process + id โฟลเดอร์ไฟล์แนบ (หาครั้งเดียว ไม่ต้องหาใหม่ทุกครั้งที่ส่งฟอร์ม)"""
+    state = {"wake": threading.Event(), "folder": None}
+    state["thread"] = threading.Thread(target=_attachment_upload_loop, args=(state,), name="attachment-uploader", daemon=True)
+    state["thread"].start()
+    return state
+
 # ===========================
 # ✅ Validation & Quota
 # ===========================
@@ -1432,9 +2814,7 @@ def validate_leave_data(name,start_date,end_date,reason,df_leave) -> List[str]:
     if start_date>end_date: errors.append("❌ วันที่เริ่มต้องน้อยกว่าหรือเท่ากับวันที่สิ้นสุด")
     if not reason or len(reason.strip())<5: errors.append("❌ กรุณาระบุเหตุผลอย่างน้อย 5 ตัวอักษร")
     if not df_leave.empty and name:
-        s,e=pd.to_datetime(start_date),pd.to_datetime(end_date)
-        overlap=df_leave[(df_leave["ชื่อ-สกุล"]==name)&(df_leave["วันที่เริ่ม"]<=e)&(df_leave["วันที่สิ้นสุด"]>=s)]
-        if not overlap.empty: errors.append("❌ มีการลาซ้ำในช่วงเวลานี้แล้ว")
+        if not person_ranges("leave",df_leave,[name],start_date,end_date).empty: errors.append("❌ มีการลาซ้ำในช่วงเวลานี้แล้ว")
     return errors
 
 def validate_travel_data(staff_list,project,location,start_date,end_date) -> List[str]:
@@ -1445,9 +2825,47 @@ def validate_travel_data(staff_list,project,location,start_date,end_date) -> Lis
     if start_date>end_date: errors.append("❌ วันที่เริ่มต้องน้อยกว่าหรือเท่ากับวันที่สิ้นสุด")
     return errors
 
-def get_leave_used(name:str,leave_type:str,df_leave:pd.DataFrame,year:int) -> int:
+QuotaLedger = Dict[Tuple[str, str, int], int]
+
+def build_quota_ledger(df_leave: pd.DataFrame) -> QuotaLedger:
+    """
+    [S4] สมุดโควต้า: groupby (ชื่อ-สกุล, ประเภทการลา, ปี) ครั้งเดียว
+    → dict {(ชื่อ, ประเภท, ปี ค.ศ.): วันลารวม} ให้ทุกหน้า lookup O(1) แทนการ scan df_leave
+    """
+    need = {"ชื่อ-สกุล","ประเภทการลา","วันที่เริ่ม","จำนวนวันลา"}
+    if df_leave.empty or not need.issubset(df_leave.columns): return {}
+    df_q = pd.DataFrame({
+        "name": person_names(df_leave),
+        "type": df_leave["ประเภทการลา"].astype(str).str.strip(),
+        "year": pd.to_datetime(df_leave["วันที่เริ่ม"], errors="coerce").dt.year,
+        "days": pd.to_numeric(df_leave["จำนวนวันลา"], errors="coerce").fillna(0),
+    }).dropna(subset=["year"])
+    if df_q.empty: return {}
+    used = df_q.groupby(["name","type","year"], sort=False)["days"].sum()
+    return {(n, t, int(y)): int(d) for (n, t, y), d in used.items()}
+
+def ledger_add(ledger: QuotaLedger, name: str, leave_type: str, year: int, days) -> None:
+    """อัปเดตสมุดโควต้าในที่ (in place) หลังบันทึกการลา 1 รายการ"""
+    key = (str(name).strip(), str(leave_type).strip(), int(year))
+    ledger[key] = ledger.get(key, 0) + int(days or 0)
+
+def get_quota_ledger(all_years: bool = False) -> QuotaLedger:
+    """
+    สมุดโควต้าของ snapshot ปัจจุบัน — สร้างครั้งเดียวต่อการโหลดข้อมูล (ห้ามแก้ในที่ ใช้สำเนา)
+    all_years=True → รวมปีงบในคลัง (โหลด leave_all ตอนขอครั้งแรก)
+    """
+    key      = "cache_quota_all" if all_years else "cache_quota"
+    df_leave = get_data("cache_leave_all" if all_years else "cache_leave")
+    ledger   = _cache_value(key)
+    if ledger is None:
+        ledger = build_quota_ledger(df_leave)
+        _publish({key: ledger})
+    return ledger
+
+def get_leave_used(name:str,leave_type:str,df_leave:pd.DataFrame,year:int,ledger:Optional[QuotaLedger]=None) -> int:
+    if ledger is not None: return ledger.get((str(name).strip(),str(leave_type).strip(),int(year)),0)
     if df_leave.empty or "ชื่อ-สกุล" not in df_leave.columns: return 0
-    mask=(df_leave["ชื่อ-สกุล"]==name)&(df_leave["ประเภทการลา"]==leave_type)&(df_leave["วันที่เริ่ม"].dt.year==year)
+    mask=(person_names(df_leave)==str(name).strip())&(df_leave["ประเภทการลา"]==leave_type)&(df_leave["วันที่เริ่ม"].dt.year==year)
     return int(df_leave.loc[mask,"จำนวนวันลา"].sum())
 
 def quota_bar_html(used:int,quota:int) -> str:
@@ -1455,8 +2873,8 @@ def quota_bar_html(used:int,quota:int) -> str:
     color="#22c55e" if pct<0.8 else ("#f59e0b" if pct<1.0 else "#ef4444")
     return f'<div class="quota-bar-wrap"><div class="quota-bar-fill" style="width:{pct*100:.0f}%;background:{color};"></div></div>'
 
-def check_leave_quota(name:str,leave_type:str,days_req:int,df_leave:pd.DataFrame,year:int) -> Optional[str]:
-    quota=LEAVE_QUOTA.get(leave_type,9999); used=get_leave_used(name,leave_type,df_leave,year); remaining=quota-used
+def check_leave_quota(name:str,leave_type:str,days_req:int,df_leave:pd.DataFrame,year:int,ledger:Optional[QuotaLedger]=None) -> Optional[str]:
+    quota=LEAVE_QUOTA.get(leave_type,9999); used=get_leave_used(name,leave_type,df_leave,year,ledger); remaining=quota-used
     if days_req>remaining: return f"❌ ลาเกินสิทธิ์! คงเหลือ {remaining} วัน (ขอ {days_req} วัน, ใช้ไปแล้ว {used}/{quota} วัน)"
     if (used+days_req)/quota>=0.8: return f"⚠️ เตือน: จะใช้สิทธิ์ลา{leave_type}ไปแล้ว {used+days_req}/{quota} วัน (ใกล้หมดสิทธิ์)"
     return None
@@ -1468,130 +2886,693 @@ def check_admin_password(password:str) -> bool:
 # 🚀 DataCache System
 # ===========================
 _CACHE_TTL_SEC = 300
+_REFRESH_AHEAD_SEC = 60   # [SWR] worker เบื้องหลังรีเฟรชก่อน TTL หมดเท่านี้ — ผู้ใช้ไม่เจอ cache หมดอายุ
+_SNAPSHOT_KEEP = 3   # snapshot ย้อนหลังที่เก็บไว้ให้ session ที่ยัง render เวอร์ชันเดิมอยู่
+
+_refresh_local = threading.local()   # .background=True ภายใน worker เบื้องหลัง (ไม่มี ScriptRunContext/session)
 
-def _cache_is_fresh() -> bool:
-    ts=st.session_state.get("_data_loaded_at")
-    return ts is not None and (dt.datetime.now()-ts).total_seconds()<_CACHE_TTL_SEC
+class DataSnapshot:
+    """
+    [Shared] ข้อมูลทั้งชุด 1 เวอร์ชัน — แชร์ทุก session ใน process ห้ามแก้ในที่
+    การเปลี่ยนแปลงสร้าง snapshot ใหม่ด้วย evolve(): key ที่ไม่เปลี่ยนชี้ object เดิม (copy-on-write ระดับ key)
+    session เก็บแค่เลขเวอร์ชัน (_snap_version) ไม่เก็บ DataFrame
+    """
+    __slots__ = ("version", "data", "loaded_at", "remote_versions", "ds_version")
+
+    def __init__(self, version: int, data: Dict[str, object], loaded_at: Optional[dt.datetime] = None,
+                 remote_versions: Optional[Dict[str, str]] = None, ds_version: Optional[Dict[str, int]] = None):
+        self.version, self.data, self.loaded_at = version, data, loaded_at
+        self.remote_versions, self.ds_version   = remote_versions or {}, ds_version or {}
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def evolve(self, updates: Dict[str, object], **meta) -> "DataSnapshot":
+        fields = {"loaded_at": self.loaded_at, "remote_versions": self.remote_versions, "ds_version": self.ds_version}
+        fields.update(meta)
+        return DataSnapshot(self.version + 1, {**self.data, **updates}, **fields)
+
+@st.cache_resource(show_spinner=False)
+def _snapshot_store() -> dict:
+    """ที่เก็บระดับ process: snapshot ล่าสุด + ย้อนหลัง, dataset ที่รอโหลดใหม่, lock กันโหลดซ้อนหลาย session"""
+    return {"lock": threading.RLock(), "snap": None, "history": {}, "stale": set()}
+
+def _latest_snapshot() -> Optional[DataSnapshot]:
+    return _snapshot_store()["snap"]
+
+def _snap() -> Optional[DataSnapshot]:
+    """snapshot ที่ session นี้ผูกไว้ — หลุดจาก history แล้ว → ใช้ล่าสุด"""
+    store = _snapshot_store()
+    return store["history"].get(st.session_state.get("_snap_version")) or store["snap"]
+
+def _pin_latest_snapshot() -> None:
+    snap = _latest_snapshot()
+    if snap is not None: st.session_state["_snap_version"] = snap.version
+
+def _publish(updates: Dict[str, object], **meta) -> DataSnapshot:
+    """สร้าง snapshot ใหม่จากล่าสุด + updates (meta: loaded_at / remote_versions / ds_version) แล้วผูก session นี้"""
+    store = _snapshot_store()
+    with store["lock"]:
+        cur = store["snap"]
+        new = cur.evolve(updates, **meta) if cur is not None else DataSnapshot(1, dict(updates), **meta)
+        store["snap"] = new; store["history"][new.version] = new
+        for v in sorted(store["history"])[:-_SNAPSHOT_KEEP]: store["history"].pop(v, None)
+    if not getattr(_refresh_local, "background", False):   # worker เบื้องหลังไม่มี session ให้ผูก
+        st.session_state["_snap_version"] = new.version
+    return new
+
+def _thaw(df: pd.DataFrame) -> pd.DataFrame:
+    """สำเนาที่แก้ไขได้ของตารางใน snapshot (category → object เพื่อรับค่าใหม่)"""
+    df = df.copy()
+    for col in df.select_dtypes(include=["category"]).columns: df[col] = df[col].astype(object)
+    return df
+
+def _cache_is_fresh(margin: float = 0) -> bool:
+    snap = _latest_snapshot()
+    ts = snap.loaded_at if snap is not None else None
+    return ts is not None and (dt.datetime.now()-ts).total_seconds()<_CACHE_TTL_SEC-margin
+
+# dataset ใน session cache ← ไฟล์ต้นทาง (เขียนไฟล์ไหน → โหลดใหม่เฉพาะ dataset นั้น + ตารางที่คำนวณต่อจากมัน)
+CACHE_DATASETS: Tuple[str, ...] = ("staff", "leave", "leave_all", "travel", "travel_all", "manual", "att", "att_hot")
+FILE_DATASETS: Dict[str, Tuple[str, ...]] = {
+    FILE_LEAVE:       ("leave", "leave_all"),     # leave = ปีงบร้อน, leave_all = + คลังปีงบเก่า
+    FILE_TRAVEL:      ("travel", "travel_all"),   # travel_report.xlsx เป็นหนึ่งในแหล่งของ travel_all
+    FILE_STAFF:       ("staff",),                 # staff → resolver ใหม่ → ผูก staff_id ของทุกตารางใหม่ (ไม่โหลดซ้ำ)
+    FILE_ATTEND:      ("att", "att_hot"),         # att = ร้อน + เดือนในคลัง (แถวดิบ), att_hot = เฉพาะไฟล์ร้อน (Dashboard ใช้ cube คลัง)
+    FILE_MANUAL_SCAN: ("manual",),                # manual → merge เข้า att ใหม่ (ไม่อ่านไฟล์สแกนซ้ำ)
+    FILE_NOTIFY:      (),
+    FILE_HOLIDAYS:    (),                         # BusinessCalendar ผูกกับเวอร์ชันไฟล์วันหยุดอยู่แล้ว
+}
+
+# [Lazy] เมนูประกาศ dataset ที่ใช้ → โหลดเฉพาะที่ยังไม่มีใน snapshot (ทุกตารางต้องมี staff เพื่อผูก staff_id)
+_EAGER_DATASETS: Tuple[str, ...] = ("staff", "leave", "travel")   # เบา — pre-warm/หน้าหลัก/ฟอร์ม
+DATASET_DEPS: Dict[str, Tuple[str, ...]] = {
+    "leave": ("staff",), "leave_all": ("staff",), "travel": ("staff",), "travel_all": ("staff",),
+    "manual": ("staff",), "att": ("staff", "manual"), "att_hot": ("staff", "manual"),
+}
+_KEY_DATASETS: Dict[str, str] = {
+    "cache_staff": "staff", "cache_leave": "leave", "cache_quota": "leave", "cache_travel": "travel",
+    "cache_leave_all": "leave_all", "cache_quota_all": "leave_all",
+    "cache_travel_all": "travel_all", "cache_travel_people": "travel_all",
+    "cache_manual": "manual", "cache_att": "att", "cache_att_hot": "att_hot",
+}
+
+def _with_deps(names) -> set:
+    out = set()
+    for n in names: out.add(n); out.update(DATASET_DEPS.get(n, ()))
+    return out
+
+def _loaded_datasets(snap: Optional["DataSnapshot"] = None) -> set:
+    """dataset ที่มีอยู่ใน snapshot (ค่าเริ่มต้น: ล่าสุด)"""
+    snap = snap if snap is not None else _latest_snapshot()
+    return {n for n in CACHE_DATASETS if snap is not None and f"cache_{n}" in snap.data}
+
+def _optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """แปลง string columns เป็น category เพื่อลด memory"""
+    if df.empty: return df
+    for col in df.select_dtypes(include=['object']).columns:
+        # category เหมาะกับ column ที่มีค่าซ้ำมาก
+        if df[col].nunique() / max(len(df), 1) < 0.5:  # category threshold
+            try: df[col] = df[col].astype('category')
+            except Exception: pass
+    return df
+
+def _optimize_att_dtypes(df_att: pd.DataFrame) -> pd.DataFrame:
+    # attendance ใหญ่มาก — optimize เฉพาะ string cols
+    for col in ["ชื่อ-สกุล", "เดือน", "สถานะสแกน", "_source"]:
+        if col in df_att.columns:
+            try: df_att[col] = df_att[col].astype('category')
+            except Exception: pass
+    return df_att
+
+def _build_attendance(df_scan: pd.DataFrame, df_manual: pd.DataFrame) -> pd.DataFrame:
+    """สแกนจริง (ผูก staff_id แล้ว) + manual → derived columns ครบ — attendance ไม่ถูกเขียนกลับ จึงแสดงชื่อมาตรฐาน"""
+    df_att = merge_attendance_with_manual(_with_display_names(df_scan), _with_display_names(df_manual))
+    add_derived_columns(df_att, "วันที่")
+    if not df_att.empty:
+        df_att["เดือน"]      = month_label(df_att["_ym"])
+        df_att["สถานะสแกน"] = attendance_scan_status(df_att)
+    return _optimize_att_dtypes(df_att)
+
+def _manual_outside_months(df_manual: pd.DataFrame, months) -> pd.DataFrame:
+    """manual ของเดือนที่ไม่อยู่ในคลัง — เดือนในคลังนับรวมใน cube ที่สรุปไว้แล้ว"""
+    if not months or df_manual.empty or "วันที่" not in df_manual.columns: return df_manual
+    return df_manual[~pd.to_datetime(df_manual["วันที่"], errors="coerce").dt.strftime("%Y-%m").isin(set(months))]
+
+def _refresh_datasets(datasets, ph=None, provided: Optional[Dict[str, pd.DataFrame]] = None,
+                      meta: Optional[dict] = None) -> None:
+    """
+    โหลด/คำนวณใหม่เฉพาะ dataset ที่ระบุ แล้ว publish เป็น snapshot ใหม่ (key อื่นแชร์ object เดิม)
+    dataset ที่ไม่ถูกระบุใช้ของเดิมใน cache (เช่น บันทึกการลา ไม่ parse ไฟล์สแกนนิ้วใหม่)
+    provided: {"staff"/"manual": DataFrame ที่เพิ่งเขียนลง Drive} → ใช้แทนการอ่านไฟล์ซ้ำ (write-through)
+    meta: loaded_at / remote_versions ของ snapshot ใหม่ (โหลดเต็ม)
+    staff/manual เปลี่ยน → คำนวณใหม่เฉพาะตารางที่โหลดไว้แล้ว ที่ยังไม่เคยโหลดรอเมนูขอ (lazy)
+    """
+    provided = provided or {}
+    ds   = set(datasets)
+    snap = _latest_snapshot()
+    touch = set(ds)
+    if "staff" in ds: touch |= _loaded_datasets(snap)
+    if "manual" in ds: touch |= {"att", "att_hot"} & _loaded_datasets(snap)
+    upd: Dict[str, object] = {}
+    say = ph.caption if ph is not None else (lambda _m: None)
+    # ตารางเดิมถูกแชร์ข้าม session → ผูก staff_id ใหม่บนสำเนาเสมอ
+    cached  = lambda k: snap.get(k) if snap is not None and snap.get(k) is not None else pd.DataFrame()
+    rebound = lambda k: apply_staff_ids(cached(k).copy(), resolver) if "staff" in ds else cached(k)
+
+    if "staff" in provided:
+        df_staff = provided["staff"]
+    elif "staff" in ds:
+        say("⏳ กำลังโหลด staff_master...")
+        df_staff, upd["_fid_staff"], upd[_read_version_key(FILE_STAFF)] = read_excel_dedup(FILE_STAFF, dedup_cols=["ชื่อ-สกุล"])
+    else:
+        df_staff = cached("cache_staff")
+    resolver = get_staff_resolver(df_staff)
+
+    if "leave" in ds:
+        say("⏳ กำลังโหลด leave_report...")
+        df_leave, upd["_fid_leave"], upd[_read_version_key(FILE_LEAVE)], upd["_delta_ids_leave"] = _read_journaled(FILE_LEAVE)
+        df_leave, _, _ = preprocess_dataframes(df_leave, pd.DataFrame(), pd.DataFrame())
+        df_leave = _hot_rows(add_derived_columns(apply_staff_ids(df_leave, resolver), "วันที่เริ่ม"))
+    else:
+        df_leave = rebound("cache_leave")
+
+    if "leave_all" in ds:
+        say("⏳ กำลังโหลดประวัติการลาทุกปีงบ (คลัง)...")
+        df_leave_all = pd.concat([_read_journaled(FILE_LEAVE)[0], read_fy_archives(FILE_LEAVE)], ignore_index=True)
+        cols = [c for c in DELTA_TARGETS[FILE_LEAVE][1] if c in df_leave_all.columns]
+        if cols: df_leave_all = df_leave_all.drop_duplicates(subset=cols, keep="first")
+        df_leave_all, _, _ = preprocess_dataframes(df_leave_all.reset_index(drop=True), pd.DataFrame(), pd.DataFrame())
+        add_derived_columns(apply_staff_ids(df_leave_all, resolver), "วันที่เริ่ม")
+    else:
+        df_leave_all = rebound("cache_leave_all")
+
+    if "travel" in ds:
+        say("⏳ กำลังโหลด travel_report...")
+        df_travel, upd["_fid_travel"], upd[_read_version_key(FILE_TRAVEL)], upd["_delta_ids_travel"] = _read_journaled(FILE_TRAVEL)
+        _, df_travel, _ = preprocess_dataframes(pd.DataFrame(), df_travel, pd.DataFrame())
+        df_travel = _hot_rows(add_derived_columns(apply_staff_ids(df_travel, resolver), "วันที่เริ่ม"))
+    else:
+        df_travel = rebound("cache_travel")
+
+    if "travel_all" in ds:
+        say("⏳ กำลังโหลดข้อมูลไปราชการทั้งหมด...")
+        load_all_travel.clear()
+        _, df_travel_all, _ = preprocess_dataframes(pd.DataFrame(), load_all_travel(), pd.DataFrame())
+        add_derived_columns(apply_staff_ids(df_travel_all, resolver), "วันที่เริ่ม")
+    else:
+        df_travel_all = rebound("cache_travel_all")
+
+    if "manual" in provided:
+        df_manual = apply_staff_ids(provided["manual"].copy(), resolver)
+    elif "manual" in ds:
+        say("⏳ กำลังโหลดข้อมูลสแกนนิ้ว (manual)...")
+        migrate_legacy_manual_scans()   # รายการเก่าที่มีแค่ใน activity_log ไม่หายจาก attendance
+        load_manual_scan_store.clear(); load_manual_scans.clear()
+        df_manual = apply_staff_ids(load_manual_scans(), resolver)
+    else:
+        df_manual = rebound("cache_manual")
+
+    if "att" in ds:
+        say("⏳ กำลังโหลดข้อมูลสแกนนิ้ว...")
+        read_attendance_report.clear()
+        df_hot_scan = read_attendance_report()
+        # [Cold] เดือนที่ปิดแล้วอ่านจาก parquet ในคลัง (ไม่ parse xlsx ซ้ำ) — เดือนที่ไฟล์ร้อนมีอยู่ใช้ของไฟล์ร้อน
+        df_cold, upd["_att_cold_months"] = read_att_archive(
+            df_hot_scan["เดือน"].astype(str).unique() if not df_hot_scan.empty else ())
+        if not df_cold.empty:
+            df_hot_scan = pd.concat([df_cold, df_hot_scan], ignore_index=True).sort_values(["ชื่อ-สกุล","วันที่"]).reset_index(drop=True)
+        _, _, df_scan = preprocess_dataframes(pd.DataFrame(), pd.DataFrame(), df_hot_scan)
+        df_att = _build_attendance(apply_staff_ids(df_scan, resolver), df_manual)
+    elif "att" in touch:
+        # ตัดแถว manual เดิมออกแล้ว merge ใหม่ — ไม่อ่าน/parse ไฟล์สแกนนิ้วซ้ำ
+        df_att = cached("cache_att")
+        df_att = (df_att[df_att["_source"].astype(str) != "manual"].drop(columns=["_source"])
+                  if "_source" in df_att.columns else df_att.copy())
+        df_att = _build_attendance(apply_staff_ids(df_att, resolver), df_manual)
+    else:
+        df_att = cached("cache_att")
+
+    # [Cold] Dashboard: เฉพาะไฟล์ร้อน + manual ของเดือนนอกคลัง — เดือนในคลังอ่าน cube ที่สรุปไว้ ไม่โหลดแถวดิบ
+    if "att_hot" in ds:
+        say("⏳ กำลังโหลดข้อมูลสแกนนิ้ว (เดือนปัจจุบัน)...")
+        if "att" not in ds: read_attendance_report.clear()
+        df_hot_only = read_attendance_report()
+        hot_months = set(df_hot_only["เดือน"].astype(str)) if not df_hot_only.empty else set()
+        _att_idx, _att_files = att_archive()
+        cold = upd["_att_hot_cold_months"] = tuple(m for m in _att_idx["เดือน"] if m not in hot_months and att_archive_file(m) in _att_files)
+        _, _, df_scan_hot = preprocess_dataframes(pd.DataFrame(), pd.DataFrame(), df_hot_only)
+        df_att_hot = _build_attendance(apply_staff_ids(df_scan_hot, resolver), _manual_outside_months(df_manual, cold))
+    elif "att_hot" in touch:
+        df_att_hot = cached("cache_att_hot")
+        df_att_hot = (df_att_hot[df_att_hot["_source"].astype(str) != "manual"].drop(columns=["_source"])
+                      if "_source" in df_att_hot.columns else df_att_hot.copy())
+        cold = (snap.get("_att_hot_cold_months") if snap is not None else None) or ()
+        df_att_hot = _build_attendance(apply_staff_ids(df_att_hot, resolver), _manual_outside_months(df_manual, cold))
+    else:
+        df_att_hot = cached("cache_att_hot")
+
+    say("⏳ กำลังประมวลผลข้อมูล...")
+    if "staff" in touch: upd["cache_staff"] = _optimize_dtypes(df_staff)
+    if "leave" in touch:
+        upd["cache_leave"] = _optimize_dtypes(df_leave); upd["cache_quota"] = build_quota_ledger(df_leave)
+    if "leave_all" in touch:
+        upd["cache_leave_all"] = _optimize_dtypes(df_leave_all); upd["cache_quota_all"] = build_quota_ledger(df_leave_all)
+    if "travel" in touch: upd["cache_travel"] = _optimize_dtypes(df_travel)
+    if "travel_all" in touch:
+        upd["cache_travel_all"] = _optimize_dtypes(df_travel_all)
+        upd["cache_travel_people"] = build_travel_participants(df_travel_all, resolver)
+    if "manual" in touch: upd["cache_manual"] = df_manual
+    if "att" in touch: upd["cache_att"] = df_att
+    if "att_hot" in touch: upd["cache_att_hot"] = df_att_hot
+
+    versions = dict(snap.ds_version if snap is not None else {})
+    for name in touch: versions[name] = versions.get(name, 0) + 1
+    _publish(upd, ds_version=versions, **(meta or {}))
+    _local_store()["wake"].set()   # [Store] ซิงก์ตารางที่เปลี่ยนเบื้องหลัง
+    logger.info("Cache refreshed: %s", ",".join(sorted(touch)))
+
+def dataset_version(name: str) -> int:
+    """เลขเวอร์ชันของ dataset ใน snapshot ที่ session ผูกไว้ — เพิ่มทุกครั้งที่ dataset นั้นถูกโหลด/คำนวณใหม่"""
+    snap = _snap()
+    return snap.ds_version.get(name, 0) if snap is not None else 0
+
+# ---------------------------
+# 🗄️ Local store (SQLite mirror)
+# ---------------------------
+# [Store] xlsx บน Drive ยังเป็นต้นฉบับ (หลาย replica ไม่มีดิสก์ร่วมกัน) — Drive → snapshot (SWR worker) → SQLite (worker นี้)
+# การเขียนจากฟอร์มขึ้น Drive ก่อน (delta journal) แล้วต่อเข้า store เป็น INSERT; หน้าเว็บ query ผ่าน index (_person, _d0)
+_STORE_SYNC_SEC = 60
+_STORE_STALE_SEC = 7 * 86400   # ไฟล์ store ของ process อื่นที่ไม่ถูกแตะนานเกินนี้ = process จบไปแล้ว → ลบ
+# ตาราง ← (key ใน snapshot, คอลัมน์ชื่อ, คอลัมน์วันเริ่ม, คอลัมน์วันสิ้นสุด)
+LOCAL_STORE_TABLES: Dict[str, Tuple[str, Optional[str], Optional[str], Optional[str]]] = {
+    "staff":    ("cache_staff",  "ชื่อ-สกุล", "วันเริ่มงาน", None),
+    "leave":    ("cache_leave",  "ชื่อ-สกุล", "วันที่เริ่ม", "วันที่สิ้นสุด"),
+    "travel":   ("cache_travel", "ชื่อ-สกุล", "วันที่เริ่ม", "วันที่สิ้นสุด"),
+    "manual":   ("cache_manual", "ชื่อ-สกุล", "วันที่",      None),
+    "att":      ("cache_att",    "ชื่อ-สกุล", "วันที่",      None),
+    "holidays": ("",             None,        "วันที่",      None),   # ไม่อยู่ใน snapshot → load_holidays_raw()
+}
+_store_local = threading.local()   # sqlite3 connection ต่อ thread
+
+def _store_conn() -> sqlite3.Connection:
+    """connection ของ thread นี้ (sqlite3 ห้ามใช้ข้าม thread) — WAL: หน้าเว็บอ่านได้ระหว่าง worker เขียน"""
+    conn = getattr(_store_local, "conn", None)
+    if conn is None:
+        os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(LOCAL_STORE_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+        _store_local.conn = conn
+    return conn
+
+def _store_frame(name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """ตารางที่ SQLite รับได้: category → object, datetime → ข้อความ + คอลัมน์ index _person / _d0 / _d1 (YYYY-MM-DD)"""
+    _, pcol, c0, c1 = LOCAL_STORE_TABLES[name]
+    if STAFF_NAME_COL in df.columns: pcol = STAFF_NAME_COL   # _person = ชื่อมาตรฐาน (คอลัมน์ชื่อเก็บค่าดิบ)
+    out = pd.DataFrame(index=df.index)
+    for col in df.columns:
+        ser = df[col]
+        if isinstance(ser.dtype, pd.CategoricalDtype): ser = ser.astype(object)
+        if pd.api.types.is_datetime64_any_dtype(ser): ser = ser.dt.strftime("%Y-%m-%d %H:%M:%S")
+        elif ser.dtype == object: ser = ser.where(ser.isna(), ser.astype(str))
+        out[str(col)] = ser
+    iso = lambda c: (pd.to_datetime(df[c], errors="coerce").dt.strftime("%Y-%m-%d")
+                     if c and c in df.columns else None)
+    out["_person"] = df[pcol].astype(str).str.strip() if pcol and pcol in df.columns else ""
+    out["_d0"] = iso(c0)
+    out["_d1"] = iso(c1) if c1 else out["_d0"]
+    return out.reset_index(drop=True)
+
+def _store_write(name: str, df: pd.DataFrame, token, replace: bool, expect=None) -> bool:
+    """
+    replace=True → เขียนทั้งตารางใหม่ใน transaction เดียว (ผู้อ่านเห็นของเดิมจน commit)
+    replace=False → INSERT ต่อท้าย เฉพาะเมื่อ store อยู่ที่เวอร์ชัน expect (ไม่งั้น False ให้ซิงก์ทั้งตาราง)
+    """
+    state = _local_store(); frame = _store_frame(name, df)
+    with state["lock"]:
+        if not replace and state["tokens"].get(name) != expect: return False
+        conn = _store_conn()
+        with conn:
+            if replace: conn.execute("BEGIN"); conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+            frame.to_sql(name, conn, if_exists="append", index=False)
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{name}_person_date" ON "{name}"(_person, _d0)')
+        state["tokens"][name] = token
+        state["rows"][name] = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+    return True
+
+def sync_local_store(snap: Optional[DataSnapshot] = None) -> List[str]:
+    """เขียนใหม่เฉพาะตารางที่เวอร์ชันใน store ไม่ตรงกับ snapshot ล่าสุด (dataset ที่ยังไม่โหลดข้าม) → ชื่อตารางที่ซิงก์"""
+    state = _local_store(); snap = snap or _latest_snapshot()
+    if snap is None: return []
+    done = []
+    for name, (key, *_) in LOCAL_STORE_TABLES.items():
+        if name == "holidays":
+            df = load_holidays_raw(); token = _holidays_version(df)
+        else:
+            df = snap.get(key); token = snap.ds_version.get(name, 0)
+        if df is None or state["tokens"].get(name) == token: continue
+        _store_write(name, df, token, replace=True); done.append(name)
+    state["synced_at"] = dt.datetime.now()
+    return done
+
+def local_store_append(name: str, rows: pd.DataFrame, prev_token, token) -> None:
+    """[Store] write-through: แถวใหม่ของฟอร์ม → INSERT ต่อท้ายตาราง; store ไม่ตรงเวอร์ชัน/schema เปลี่ยน → ปลุก worker ซิงก์ทั้งตาราง"""
+    state = _local_store()
+    try:
+        if _store_write(name, rows, token, replace=False, expect=prev_token): return
+    except Exception as e:
+        logger.warning("Local store append %s failed: %s", name, e)
+        with state["lock"]: state["tokens"].pop(name, None)
+    state["wake"].set()
+
+def store_query(datasets: Tuple[str, ...], sql: str, params: tuple = ()) -> Optional[pd.DataFrame]:
+    """
+    query ตรงจาก store เมื่อทุกตารางที่ใช้ซิงก์ถึงเวอร์ชันที่ session ผูกไว้แล้ว
+    ไม่งั้น (ยังซิงก์ไม่ทัน / store เสีย) → None ให้ผู้เรียกคำนวณด้วย pandas บน snapshot แทน
+    """
+    tokens = _local_store()["tokens"]
+    if any(tokens.get(n) != dataset_version(n) for n in datasets): return None
+    try: return pd.read_sql_query(sql, _store_conn(), params=params)
+    except Exception as e:
+        logger.warning("Local store query failed: %s", e); return None
+
+def person_ranges(dataset: str, df: pd.DataFrame, names, start, end) -> pd.DataFrame:
+    """
+    ช่วง (p=ชื่อ, d0=วันเริ่ม, d1=วันสิ้นสุด) ของรายชื่อที่ทับช่วง [start, end] — leave / travel
+    store: index (_person, _d0) แทนการ filter ทั้งตาราง; fallback pandas บน df (ผลเหมือนกัน)
+    """
+    names = list(dict.fromkeys(str(n).strip() for n in names))
+    if not names: return pd.DataFrame(columns=["p","d0","d1"])
+    s_iso, e_iso = pd.Timestamp(start).strftime("%Y-%m-%d"), pd.Timestamp(end).strftime("%Y-%m-%d")
+    res = None
+    if len(names) <= 500:   # จำกัดจำนวนตัวแปรใน IN (...) ของ SQLite
+        res = store_query((dataset,), f'SELECT _person AS p, _d0 AS d0, _d1 AS d1 FROM "{dataset}" '
+                          f'WHERE _person IN ({",".join("?" * len(names))}) AND _d0 <= ? AND _d1 >= ?',
+                          (*names, e_iso, s_iso))
+    if res is not None:
+        res["d0"] = pd.to_datetime(res["d0"], errors="coerce"); res["d1"] = pd.to_datetime(res["d1"], errors="coerce")
+        return res
+    if df.empty or not {"ชื่อ-สกุล","วันที่เริ่ม","วันที่สิ้นสุด"}.issubset(df.columns):
+        return pd.DataFrame(columns=["p","d0","d1"])
+    p = person_names(df)
+    d0 = pd.to_datetime(df["วันที่เริ่ม"], errors="coerce").dt.normalize()
+    d1 = pd.to_datetime(df["วันที่สิ้นสุด"], errors="coerce").dt.normalize()
+    m = p.isin(names) & (d0 <= pd.Timestamp(e_iso)) & (d1 >= pd.Timestamp(s_iso))
+    return pd.DataFrame({"p": p[m], "d0": d0[m], "d1": d1[m]}).reset_index(drop=True)
+
+def _store_sync_loop(state: dict) -> None:
+    """ซิงก์ทุก _STORE_SYNC_SEC วินาที หรือทันทีเมื่อมี snapshot ใหม่ (_refresh_datasets ปลุก)"""
+    _refresh_local.background = True
+    while True:
+        try:
+            done = sync_local_store()
+            if done: logger.info("Local store synced: %s", ",".join(done))
+            if os.path.exists(LOCAL_STORE_PATH): os.utime(LOCAL_STORE_PATH)   # ยังมีชีวิต → process อื่นไม่ลบ (_remove_stale_stores)
+            state["error"] = ""
+        except Exception as e:
+            state["error"] = str(e); logger.warning("Local store sync failed: %s", e)
+        state["wake"].wait(timeout=_STORE_SYNC_SEC); state["wake"].clear()
+
+def _remove_stale_stores() -> None:
+    """ลบไฟล์ store (+ -wal/-shm) ของ process ที่จบไปแล้ว รวมไฟล์ร่วมแบบเดิม hr_store.sqlite3 — ไฟล์ที่ยังเปิดอยู่ลบไม่ได้ก็ข้าม"""
+    own, now = os.path.basename(LOCAL_STORE_PATH), time.time()
+    try: names = os.listdir(LOCAL_CACHE_DIR)
+    except OSError: return
+    for n in names:
+        if not n.startswith("hr_store.") or n.startswith(own): continue
+        path = os.path.join(LOCAL_CACHE_DIR, n)
+        try:
+            if n.startswith("hr_store.sqlite3") or now - os.path.getmtime(path) > _STORE_STALE_SEC: os.remove(path)
+        except OSError: pass
+
+@st.cache_resource(show_spinner=False)
+def _local_store() -> dict:
+    """
+    [Store] SQLite 1 ไฟล์ต่อ process (LOCAL_STORE_PATH มี pid) + worker ซิงก์จาก snapshot
+    tokens: เวอร์ชัน dataset ที่อยู่ในตาราง — เริ่ม process ใหม่ว่างเสมอ (ds_version นับใหม่) จึงซิงก์ทุกตารางก่อนใช้
+    """
+    _remove_stale_stores()
+    state = {"lock": threading.RLock(), "wake": threading.Event(), "tokens": {}, "rows": {}, "synced_at": None, "error": ""}
+    state["thread"] = threading.Thread(target=_store_sync_loop, args=(state,), name="local-store-sync", daemon=True)
+    state["thread"].start()
+    return state
+
+# ---------------------------
+# ✍️ Write-through + remote version check
+# ---------------------------
+_TRAVEL_SOURCES_KEY = "__travel_sources__"
+
+def _digest(parts) -> str:
+    """ลายนิ้วมือที่เหมือนกันทุก process (hash() ของ Python สุ่ม salt ต่อ process → เทียบข้าม process ไม่ได้)"""
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+def get_remote_versions() -> Dict[str, str]:
+    """modifiedTime ของทุกไฟล์ใน FOLDER_ID (list ครั้งเดียว) + ลายนิ้วมือของไฟล์ไปราชการอื่น ๆ"""
+    files = list_all_files_in_folder()
+    if not files: return {}
+    out: Dict[str, str] = {}
+    for f in files: out.setdefault(f.get("name",""), f.get("modifiedTime",""))   # เรียง modifiedTime desc → ตัวล่าสุด
+    src = sorted((f.get("id",""), f.get("modifiedTime","")) for f in files
+                 if f.get("name","") not in _NON_TRAVEL_FILES | {FILE_TRAVEL} and not f.get("name","").startswith("BAK_"))
+    out[_TRAVEL_SOURCES_KEY] = _digest(f"{i}@{m}" for i, m in src)
+    for fname, deltas in list_delta_files().items(): out[_delta_key(fname)] = _delta_fingerprint(_delta_fingerprint_part(f) for f in deltas)
+    return out
+
+def _note_remote_version(filename: str, modified_time: Optional[str], read_version: bool = True) -> None:
+    """
+    จดเวอร์ชันที่เราเขียนเอง → การตรวจรอบถัดไปไม่โหลดไฟล์นี้ซ้ำ
+    read_version: cache มีข้อมูลตรงกับที่เขียน → เลื่อน base_version ของ dataset (เขียนครั้งถัดไปไม่นับเป็น conflict)
+    """
+    if not modified_time: return
+    with _snapshot_store()["lock"]:
+        snap = _latest_snapshot()
+        if snap is None: return
+        vkey = _read_version_key(filename)
+        upd = {vkey: modified_time} if read_version and vkey in snap.data else {}
+        if upd or snap.remote_versions:
+            _publish(upd, remote_versions={**snap.remote_versions, filename: modified_time} if snap.remote_versions else {})
+
+def _note_compacted_deltas(filename: str, remaining: set) -> None:
+    """หลัง compaction: ตัด delta ที่ถูกรวมแล้วออกจาก snapshot — delta จาก process อื่นที่ยังไม่ replay ทำให้ fingerprint ต่าง → โหลดใหม่ตามปกติ"""
+    key = f"_delta_ids_{DELTA_TARGETS[filename][0]}"
+    with _snapshot_store()["lock"]:
+        snap = _latest_snapshot()
+        if snap is None: return
+        ids = tuple(i for i in (snap.get(key) or ()) if i in remaining)
+        _publish({key: ids})
+        _note_remote_version(_delta_key(filename), _delta_fingerprint(ids))
+
+def _revalidate_remote_versions() -> None:
+    """
+    cache หมดอายุ: เทียบ modifiedTime ใน Drive กับที่จดไว้ → ทำเครื่องหมายเฉพาะ dataset ที่ถูกแก้จากภายนอก
+    (list ไม่สำเร็จ → ปล่อยให้โหลดใหม่ทั้งหมดตามเดิม)
+    """
+    snap = _latest_snapshot()
+    list_all_files_in_folder.clear(); _clear_delta_listing()   # list ใหม่จริง (cache ttl 900 นานกว่ารอบตรวจ)
+    old, new = (snap.remote_versions if snap is not None else {}), get_remote_versions()
+    if not new: return
+    changed = set()
+    for fname, dss in FILE_DATASETS.items():
+        if old.get(fname) != new.get(fname) or old.get(_delta_key(fname)) != new.get(_delta_key(fname)): changed.update(dss)
+    if old.get(_TRAVEL_SOURCES_KEY) != new.get(_TRAVEL_SOURCES_KEY): changed.add("travel_all")
+    _publish({}, remote_versions=new, loaded_at=dt.datetime.now())
+    if changed: _invalidate_cache(tuple(changed))
+    logger.info("Remote revalidate: changed=%s", ",".join(sorted(changed)) or "-")
+
+def cache_apply_rows(dataset: str, rows: pd.DataFrame, delta_id: Optional[str] = None) -> None:
+    """
+    [Write-through] ต่อแถวใหม่ที่เพิ่งเขียนลง Drive เข้า snapshot ใหม่ทันที (leave / travel)
+    อัปเดตตารางที่คำนวณต่อด้วย: สมุดโควต้า (leave), travel_all + ตารางผู้เดินทาง (travel)
+    interval index / status cube ของเมนูตรวจสอบสร้างจาก cache นี้ทุก rerun จึงตามมาเอง
+    delta_id: ไฟล์ delta journal ของแถวนี้ — snapshot ที่ replay delta นี้แล้ว (โหลดเบื้องหลังแซง) ไม่ต่อซ้ำ
+    """
+    if rows.empty: return
+    with _snapshot_store()["lock"]:
+        _pin_latest_snapshot()   # ต่อจากเวอร์ชันล่าสุด ไม่ใช่เวอร์ชันที่ session นี้ render อยู่ (กันทับการเขียนของ session อื่น)
+        ids_key = f"_delta_ids_{dataset}"
+        if delta_id and delta_id in (_cache_value(ids_key) or ()): return
+        upd, resolver = {}, get_staff_resolver()
+        date_col = "วันที่เริ่ม"
+        if dataset == "leave": df_new, _, _ = preprocess_dataframes(rows, pd.DataFrame(), pd.DataFrame())
+        else:                  _, df_new, _ = preprocess_dataframes(pd.DataFrame(), rows, pd.DataFrame())
+        add_derived_columns(apply_staff_ids(df_new, resolver), date_col)
+        key = f"cache_{dataset}"
+        # ดึงก่อน concat — กันสร้างใหม่จากแถวที่รวมแล้วซ้ำ; สำเนา dict เพราะสมุดเดิมแชร์กับ snapshot อื่น
+        ledger = dict(get_quota_ledger()) if dataset == "leave" else None
+        upd[key] = _optimize_dtypes(pd.concat([_dc(key), df_new], ignore_index=True))
+        bumped = [dataset]
+        if ledger is not None:
+            for n, t, d, days in zip(person_names(df_new), df_new["ประเภทการลา"], df_new[date_col], df_new["จำนวนวันลา"]):
+                ledger_add(ledger, n, t, pd.Timestamp(d).year, days)
+            upd["cache_quota"] = ledger
+            if "leave_all" in _loaded_datasets():   # สมุดโควต้าทุกปีสร้างใหม่เมื่อถูกขอ
+                upd["cache_leave_all"] = _optimize_dtypes(pd.concat([_dc("cache_leave_all"), df_new], ignore_index=True))
+                upd["cache_quota_all"] = None
+                bumped.append("leave_all")
+        elif dataset == "travel" and "travel_all" in _loaded_datasets():   # ยังไม่เคยโหลด → รอโหลดเต็มตอนเมนูขอ
+            df_all = _dc("cache_travel_all")
+            df_src = df_new[[c for c in TRAVEL_REQUIRED_COLS + DERIVED_COLS if c in df_new.columns]].assign(_source_file=FILE_TRAVEL)
+            df_part = build_travel_participants(df_src, resolver)
+            df_part["trip_id"] += len(df_all)
+            upd["cache_travel_all"]    = _optimize_dtypes(pd.concat([df_all, df_src], ignore_index=True))
+            upd["cache_travel_people"] = pd.concat([get_travel_participants(), df_part], ignore_index=True)
+            bumped.append("travel_all")
+        if delta_id: upd[ids_key] = tuple(_cache_value(ids_key) or ()) + (delta_id,)
+        prev = dict(_latest_snapshot().ds_version)
+        versions = dict(prev)
+        for name in bumped: versions[name] = versions.get(name, 0) + 1
+        _publish(upd, ds_version=versions)
+        local_store_append(dataset, df_new, prev.get(dataset, 0), versions[dataset])   # [Store] INSERT แทนเขียนทั้งตาราง
+        if delta_id:   # delta ของเราเอง — การตรวจ remote รอบถัดไปไม่โหลดซ้ำ
+            fname = next(f for f, (d, _) in DELTA_TARGETS.items() if d == dataset)
+            _note_remote_version(_delta_key(fname), _delta_fingerprint(upd[ids_key]))
+
+def cache_replace_dataset(dataset: str, df: pd.DataFrame) -> None:
+    """[Write-through] แทนทั้ง dataset ด้วยตารางที่เพิ่งเขียนลง Drive (staff / manual) + คำนวณตารางที่ขึ้นกับมัน"""
+    with _snapshot_store()["lock"]:
+        _pin_latest_snapshot()
+        _refresh_datasets((dataset,), provided={dataset: df})
 
 def _load_all_data_to_cache(force: bool = False) -> None:
     """
-    โหลดข้อมูลทั้งหมดลง session_state
-    - ครั้งแรก: โหลดทุกไฟล์ แสดง progress รายไฟล์
-    - ครั้งต่อไป (cache ยังสด): return ทันที ไม่ยิง Drive เลย
+    โหลดข้อมูลลง snapshot กลางของ process แล้วผูก session นี้กับเวอร์ชันล่าสุด
+    - ครั้งแรก / cache หมดอายุ: โหลดทุก dataset แสดง progress รายไฟล์ (session เดียวโหลด ที่เหลือรอ lock แล้วใช้ร่วม)
+    - cache ยังสด: โหลดใหม่เฉพาะ dataset ที่ถูกเขียน (store["stale"]) — ไม่มีก็ return ทันที
     - force=True: โหลดใหม่ทุกไฟล์
+    - [SWR] หมดอายุตาม TTL: เสิร์ฟ snapshot เดิมต่อ แล้วปลุก worker ให้รีเฟรชเบื้องหลัง (ไม่บล็อกหน้า)
     """
-    if not force and _cache_is_fresh():
-        return
+    store = _snapshot_store()
+    if not force and not store["stale"]:
+        snap = store["snap"]
+        if _cache_is_fresh():
+            _pin_latest_snapshot(); return
+        if snap is not None and snap.loaded_at is not None:
+            _cache_refresher()["wake"].set()
+            _pin_latest_snapshot(); return
+    _refresh_snapshot(force)
+    _pin_latest_snapshot()
+
+def _refresh_snapshot(force: bool = False, margin: float = 0) -> None:
+    """ตรวจ/โหลดภายใต้ lock: revalidate → โหลดเฉพาะ dataset ที่เปลี่ยน หรือโหลดเต็ม (margin: รีเฟรชก่อนหมดอายุ)"""
+    store = _snapshot_store()
+    with store["lock"]:
+        # double-check: session/worker อื่นอาจโหลดเสร็จระหว่างรอ lock
+        snap = store["snap"]
+        if not force and not _cache_is_fresh(margin) and snap is not None and snap.remote_versions:
+            _revalidate_remote_versions()
+        if not force and _cache_is_fresh(margin):
+            stale, store["stale"] = set(store["stale"]) & _loaded_datasets(), set()
+            if stale: _refresh_datasets(stale)
+            return
+        _load_full_snapshot(force)
+
+def _cache_refresh_loop(wake: threading.Event) -> None:
+    """วนรีเฟรช snapshot ทุก TTL-_REFRESH_AHEAD_SEC วินาที หรือทันทีเมื่อถูกปลุก"""
+    _refresh_local.background = True
+    while True:
+        try:
+            _refresh_snapshot(margin=_REFRESH_AHEAD_SEC)
+            compact_due_journals()   # [Journal] รวม delta เข้าไฟล์หลักตามรอบ
+            archive_due_fiscal_years()   # [FY] ย้ายปีงบที่ปิดแล้วเข้าคลัง
+            compact_attendance_archive()   # [Cold] เดือนสแกนที่ปิดแล้ว → parquet + cube
+            pin_due_revisions()   # [Rev] ปัก revision รายวัน + retention
+        except Exception as e:
+            logger.warning("Background cache refresh failed: %s", e)
+        wake.wait(timeout=max(_CACHE_TTL_SEC - _REFRESH_AHEAD_SEC, 30)); wake.clear()
+
+@st.cache_resource(show_spinner=False)
+def _cache_refresher() -> dict:
+    """
+    [SWR] worker เบื้องหลัง 1 ตัวต่อ process: pre-warm ทันทีที่เริ่ม แล้วรีเฟรชก่อน TTL หมดทุกรอบ
+    session ที่เจอ cache หมดอายุแค่ปลุก (wake) — snapshot ใหม่ถูก publish ทีเดียว session สลับไปเองรอบ rerun ถัดไป
+    """
+    wake = threading.Event()
+    th = threading.Thread(target=_cache_refresh_loop, args=(wake,), name="leave-cache-refresher", daemon=True)
+    th.start()
+    return {"wake": wake, "thread": th}
+
+def _load_full_snapshot(force: bool) -> None:
+    """โหลดทุก dataset เป็น snapshot ใหม่ (เรียกภายใต้ lock ของ store)"""
 
     # ถ้า force → ล้าง @st.cache_data ของทุกฟังก์ชันอ่านไฟล์
     if force:
         for fn in [read_excel_from_drive, read_attendance_report,
-                   load_all_travel, load_manual_scans, _read_file_by_id]:
+                   load_all_travel, load_manual_scan_store, load_manual_scans,
+                   _read_file_by_id]:
             try:
                 fn.clear()
             except Exception:
                 pass
 
-    ph = st.empty()
-
-    # ── 1. ไฟล์หลัก 3 ไฟล์ (เบา) ─────────────────────────────
-    ph.caption("⏳ กำลังโหลด leave_report...")
-    df_leave, _fid_leave = read_excel_with_backup(
-        FILE_LEAVE, dedup_cols=["ชื่อ-สกุล","วันที่เริ่ม","ประเภทการลา"])
-
-    ph.caption("⏳ กำลังโหลด travel_report...")
-    df_travel, _fid_travel = read_excel_with_backup(
-        FILE_TRAVEL, dedup_cols=["ชื่อ-สกุล","วันที่เริ่ม","เรื่อง/กิจกรรม"])
-
-    ph.caption("⏳ กำลังโหลด staff_master...")
-    df_staff, _fid_staff = read_excel_with_backup(
-        FILE_STAFF, dedup_cols=["ชื่อ-สกุล"])
-
-    # ── 2. ไฟล์หนัก (attendance + manual + travel_all) ───────
-    ph.caption("⏳ กำลังโหลดข้อมูลสแกนนิ้ว...")
-    df_att    = read_attendance_report()
-
-    ph.caption("⏳ กำลังโหลดข้อมูลสแกนนิ้ว (manual)...")
-    df_manual = load_manual_scans()
-
-    ph.caption("⏳ กำลังโหลดข้อมูลไปราชการทั้งหมด...")
-    df_travel_all = load_all_travel()
-
-    # ── 3. Preprocess ─────────────────────────────────────────
-    ph.caption("⏳ กำลังประมวลผลข้อมูล...")
-    df_leave, df_travel, df_att = preprocess_dataframes(df_leave, df_travel, df_att)
-    _, df_travel_all, _         = preprocess_dataframes(pd.DataFrame(), df_travel_all, pd.DataFrame())
-    df_att = merge_attendance_with_manual(df_att, df_manual)
-
-    # ── 4. บันทึกลง session_state ครบทุกตัว ──────────────────
-    st.session_state.update({
-        "cache_leave":       df_leave,
-        "cache_travel":      df_travel,
-        "cache_travel_all":  df_travel_all,
-        "cache_att":         df_att,
-        "cache_staff":       df_staff,
-        "cache_manual":      df_manual,
-        "_fid_leave":        _fid_leave,
-        "_fid_travel":       _fid_travel,
-        "_fid_staff":        _fid_staff,
-        "_data_loaded_at":   dt.datetime.now(),
-    })
-
-    # ── dtype optimization: ลด RAM 30-50% ────────────────────
-    def _optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
-        """แปลง string columns เป็น category เพื่อลด memory"""
-        if df.empty: return df
-        for col in df.select_dtypes(include=['object']).columns:
-            # category เหมาะกับ column ที่มีค่าซ้ำมาก
-            if df[col].nunique() / max(len(df), 1) < 0.5:  # category threshold
-                try: df[col] = df[col].astype('category')
-                except Exception: pass
-        return df
-
-    df_leave      = _optimize_dtypes(df_leave)
-    df_travel     = _optimize_dtypes(df_travel)
-    df_staff      = _optimize_dtypes(df_staff)
-    df_travel_all = _optimize_dtypes(df_travel_all)
-
-    # attendance ใหญ่มาก — optimize เฉพาะ string cols
-    for col in ["ชื่อ-สกุล", "เดือน", "สถานะสแกน", "_source"]:
-        if col in df_att.columns:
-            try: df_att[col] = df_att[col].astype('category')
-            except Exception: pass
+    background = getattr(_refresh_local, "background", False)
+    ph = None if background else st.empty()
+    remote = get_remote_versions()
+    _snapshot_store()["stale"].clear()
+    # โหลดใหม่เฉพาะ dataset ที่เคยถูกขอ (ครั้งแรก: ชุดเบา) — attendance ฯลฯ รอเมนูที่ใช้
+    _refresh_datasets(tuple(_with_deps(_loaded_datasets() or _EAGER_DATASETS)), ph, meta={"remote_versions": remote, "loaded_at": dt.datetime.now()})
 
     # ล้าง memory หลังโหลดข้อมูลขนาดใหญ่
     gc.collect()
 
-    ph.empty()
+    if ph is not None: ph.empty()
+    snap = _latest_snapshot()
     logger.info(
-        "Cache loaded: leave=%d travel=%d att=%d staff=%d travel_all=%d",
-        len(df_leave), len(df_travel), len(df_att), len(df_staff), len(df_travel_all),
+        "Cache loaded%s: leave=%d travel=%d att=%d staff=%d travel_all=%d", " (background)" if background else "",
+        *(len(snap.get(k, ())) for k in ("cache_leave","cache_travel","cache_att","cache_staff","cache_travel_all")),
     )
 
 def _dc(key:str,default=None):
-    val=st.session_state.get(key,default)
+    snap=_snap(); val=snap.get(key,default) if snap is not None else default
     return val if val is not None else (pd.DataFrame() if default is None else default)
 
+def _cache_value(key: str, default=None):
+    """ค่าดิบใน snapshot ของ session (file id ฯลฯ) — ไม่แปลง None เป็น DataFrame"""
+    snap = _snap()
+    return snap.get(key, default) if snap is not None else default
+
 def get_data(key: str) -> pd.DataFrame:
     """
     [I1] Smart cache accessor — โหลดอัตโนมัติถ้ายังไม่มีใน cache
-    ใช้แทน _dc() ในทุกเมนูเพื่อไม่ต้อง read_excel_with_backup ซ้ำ
+    ใช้แทน _dc() ในทุกเมนูเพื่อไม่ต้อง read_excel_dedup ซ้ำ
     """
-    if key not in st.session_state or not _cache_is_fresh():
+    if _snap() is None or not _cache_is_fresh() or _snapshot_store()["stale"]:
         _load_all_data_to_cache()
-    val = st.session_state.get(key)
+    name = _KEY_DATASETS.get(key)
+    if name and name not in _loaded_datasets(_snap()): _load_datasets((name,))
+    val = _cache_value(key)
     return val if val is not None else pd.DataFrame()
 
-def _ensure_data_loaded() -> None:
-    """[I1] ตรวจและโหลดข้อมูลถ้ายังไม่ครบ — เรียกต้นเมนูแทน read_excel_with_backup ตรง"""
-    if not _cache_is_fresh():
+def _ensure_data_loaded(datasets: Tuple[str, ...] = ()) -> None:
+    """[I1] ตรวจและโหลดข้อมูลถ้ายังไม่ครบ — เรียกต้นเมนูแทน read_excel_dedup ตรง
+    datasets: ที่เมนูนี้ใช้ → ที่ยังไม่เคยโหลดถูกโหลดตอนนี้พร้อม dependency (lazy)"""
+    if _snap() is None or not _cache_is_fresh() or _snapshot_store()["stale"]:
         _load_all_data_to_cache()
+    if _with_deps(datasets) - _loaded_datasets(_snap()): _load_datasets(datasets)
+
+def _load_datasets(names) -> None:
+    """[Lazy] โหลด dataset ที่ยังไม่มีใน snapshot ภายใต้ lock — session อื่นที่ขอพร้อมกันรอแล้วใช้ร่วม"""
+    store = _snapshot_store()
+    with store["lock"]:
+        missing = _with_deps(names) - _loaded_datasets()
+        if missing:
+            ph = st.empty()
+            _refresh_datasets(tuple(missing), ph)
+            ph.empty()
+    _pin_latest_snapshot()
+
+def _invalidate_cache(datasets: Optional[Tuple[str, ...]] = None) -> None:
+    """datasets=None → โหลดใหม่ทั้งหมดรอบถัดไป, ไม่งั้นทำเครื่องหมายเฉพาะ dataset ที่ระบุ (มีผลทุก session)"""
+    store = _snapshot_store()
+    if datasets is None:
+        if store["snap"] is not None: _publish({}, loaded_at=None, remote_versions={})
+        return
+    if datasets:
+        with store["lock"]: store["stale"] |= set(datasets)
 
-def _invalidate_cache() -> None:
-    st.session_state.pop("_data_loaded_at",None)
-
-def get_holiday_name(d: dt.date, holiday_df: pd.DataFrame) -> str:
-    """หาชื่อวันหยุดจาก DataFrame — คืน '' ถ้าไม่ใช่วันหยุด"""
+def get_holiday_name(d: dt.date, holiday_df: Optional[pd.DataFrame] = None) -> str:
+    """หาชื่อวันหยุด — คืน '' ถ้าไม่ใช่วันหยุด (ค่าเริ่มต้น: lookup O(1) จาก BusinessCalendar)"""
+    if holiday_df is None:
+        return get_business_calendar().holiday_name(d)
     if holiday_df.empty:
         return ""
     match = holiday_df[pd.to_datetime(holiday_df["วันที่"], errors="coerce").dt.date == d]
@@ -1714,106 +3695,289 @@ def batch_get_attendance_status(
     return pd.DataFrame(rows)
 
 
+# ===========================
+# 📒 Batch Day-Status & Leave Register
+# ===========================
+LATE_CUTOFF_MIN = 8 * 60 + 31   # 08:31 เป็นต้นไป = มาสาย (นาทีนับจากเที่ยงคืน)
+
+# (ชื่อเดือน, เดือน, offset ปี ค.ศ. เทียบปีงบประมาณ) — ปีงบ ต.ค.–ก.ย.
+FISCAL_MONTHS: List[Tuple[str, int, int]] = [
+    ("ตุลาคม", 10, -1), ("พฤศจิกายน", 11, -1), ("ธันวาคม", 12, -1),
+    ("มกราคม", 1, 0), ("กุมภาพันธ์", 2, 0), ("มีนาคม", 3, 0),
+    ("เมษายน", 4, 0), ("พฤษภาคม", 5, 0), ("มิถุนายน", 6, 0),
+    ("กรกฎาคม", 7, 0), ("สิงหาคม", 8, 0), ("กันยายน", 9, 0),
+]
+REGISTER_ALL_MONTHS = "ทั้งหมด (12 เดือน)"
+REGISTER_SUMMARY_COLS: List[Tuple[str, str]] = [
+    ("ป่วย(วัน)", "ป"), ("กิจ(วัน)", "ก"), ("พักผ่อน(วัน)", "พ"),
+    ("ขาด(วัน)", "ข"), ("สาย(ครั้ง)", "ส"), ("ลืมสแกน(ครั้ง)", "-"),
+]
+DAY_STATUS_TEXT: Dict[str, str] = {
+    "weekend": "วันหยุด", "holiday": "วันหยุด", "travel": "ไปราชการ",
+    "absent": "ขาดงาน", "forgot": "ลืมสแกน", "late": "มาสาย", "ok": "มาปกติ",
+}
+DAY_STATUS_COLS = ["ชื่อพนักงาน", "วันที่", "_stype", "_sval", "เวลาเข้า", "เวลาออก"]
+
+def _time_minutes(values) -> np.ndarray:
+    """แปลงคอลัมน์เวลาเป็นนาทีนับจากเที่ยงคืน (NaN = ไม่มีเวลา) — parse_time เฉพาะค่า unique"""
+    codes, uniq = pd.factorize(pd.Series(values, dtype=object))
+    lut = np.full(len(uniq) + 1, np.nan)   # ช่องสุดท้าย = code -1 (NaN/None)
+    for i, u in enumerate(uniq):
+        t = parse_time(u)
+        if t is not None: lut[i] = t.hour * 60 + t.minute
+    return lut[codes]
+
+def _att_status_codes(min_in: np.ndarray, min_out: np.ndarray, late_min: int = LATE_CUTOFF_MIN) -> np.ndarray:
+    """สถานะสแกนแบบ vectorized — กติกาเดียวกับ _get_day_status (absent/forgot/late/ok)"""
+    has_in, has_out = ~np.isnan(min_in), ~np.isnan(min_out)
+    with np.errstate(invalid="ignore"):
+        return np.select(
+            [~has_in & ~has_out, (has_in ^ has_out) | (min_in == min_out), min_in >= late_min],
+            ["absent", "forgot", "late"], default="ok",
+        )
+
+def _fmt_minutes(m: float) -> str:
+    return f"{int(m)//60:02d}:{int(m)%60:02d}"
+
+def build_day_status_table(names: list, dates, holiday_set: set = None,
+                           df_att: Optional[pd.DataFrame] = None,
+                           leave_idx: Optional[dict] = None,
+                           travel_idx: Optional[dict] = None) -> pd.DataFrame:
+    """
+    [I3] ตารางสถานะรายวัน (คน × วัน) แบบ long สร้างครั้งเดียวด้วย numpy
+    ลำดับความสำคัญเหมือน _get_day_status:
+      ส.-อา. → วันหยุด → ลา → ไปราชการ → สแกนนิ้ว → ขาดงาน
+    คืน DataFrame คอลัมน์ DAY_STATUS_COLS (_stype/_sval = ผลแบบเดียวกับ _get_day_status)
+    """
+    names = list(dict.fromkeys(str(n).strip() for n in names))
+    days  = pd.DatetimeIndex(dates).normalize().unique().sort_values()
+    n_p, n_d = len(names), len(days)
+    if not n_p or not n_d:
+        return pd.DataFrame(columns=DAY_STATUS_COLS)
+    pos = {n: i for i, n in enumerate(names)}
+
+    stype = np.full((n_p, n_d), "absent", dtype=object)
+    sval  = np.full((n_p, n_d), "", dtype=object)
+    t_in  = np.full((n_p, n_d), "", dtype=object)
+    t_out = np.full((n_p, n_d), "", dtype=object)
+
+    # 5. ข้อมูลสแกนนิ้ว — วางลง grid ด้วย (row, col) index ทีเดียว
+    if df_att is not None and not df_att.empty and "วันที่" in df_att.columns:
+        name_col = next((c for c in ["ชื่อ-สกุล","ชื่อพนักงาน","ชื่อ"] if c in df_att.columns), None)
+        if name_col is not None:
+            pi = df_att[name_col].astype(str).str.strip().map(pos).to_numpy(dtype=float)
+            di = days.get_indexer(pd.to_datetime(df_att["วันที่"], errors="coerce").dt.normalize())
+            hit = ~np.isnan(pi) & (di >= 0)
+            if hit.any():
+                sub = df_att.loc[hit]
+                rows, cols = pi[hit].astype(int), di[hit]
+                raw_in  = sub["เวลาเข้า"].astype(object).to_numpy() if "เวลาเข้า" in sub.columns else np.full(len(sub), "", dtype=object)
+                raw_out = sub["เวลาออก"].astype(object).to_numpy()  if "เวลาออก"  in sub.columns else np.full(len(sub), "", dtype=object)
+                m_in, m_out = _time_minutes(raw_in), _time_minutes(raw_out)
+                codes = _att_status_codes(m_in, m_out)
+                manual = (sub["_source"].astype(str).str.strip() == "manual").to_numpy() if "_source" in sub.columns else np.zeros(len(sub), dtype=bool)
+                vals = np.full(len(sub), "", dtype=object)
+                late = codes == "late"
+                vals[late] = [_fmt_minutes(m) for m in m_in[late]]
+                vals[(codes == "ok") & manual] = "HR"
+                stype[rows, cols] = codes; sval[rows, cols] = vals
+                t_in[rows, cols] = raw_in; t_out[rows, cols] = raw_out
+
+    # 3-4. ช่วงลา/ไปราชการ — ทาทับเป็นช่วง (ไปราชการก่อน แล้วลาทับ; รายการแรกของแต่ละคนชนะ)
+    day_vals = days.values.astype("datetime64[D]")
+    def _paint(idx: Optional[dict], code: str) -> None:
+        for name, i in pos.items():
+            for s, e, label in reversed((idx or {}).get(name, [])):
+                lo = np.searchsorted(day_vals, np.datetime64(s, "D"))
+                hi = np.searchsorted(day_vals, np.datetime64(e, "D"), side="right")
+                if lo < hi: stype[i, lo:hi] = code; sval[i, lo:hi] = label
+    _paint(travel_idx, "travel")
+    _paint(leave_idx, "leave")
+
+    # 1-2. ส.-อา. และวันหยุดนักขัตฤกษ์ ทับทุกอย่าง
+    weekend = days.weekday >= 5
+    if holiday_set:
+        hol = days.isin(pd.DatetimeIndex(sorted(holiday_set))) & ~weekend
+        stype[:, hol] = "holiday"; sval[:, hol] = ""
+    stype[:, weekend] = "weekend"; sval[:, weekend] = ""
+
+    return pd.DataFrame({
+        "ชื่อพนักงาน": np.repeat(np.array(names, dtype=object), n_d),
+        "วันที่":       np.tile(days.values, n_p),
+        "_stype":       stype.ravel(),
+        "_sval":        sval.ravel(),
+        "เวลาเข้า":     t_in.ravel(),
+        "เวลาออก":      t_out.ravel(),
+    })
+
+def day_status_text(df_status: pd.DataFrame) -> np.ndarray:
+    """แปลง _stype/_sval เป็นข้อความสถานะ (เหมือน STATUS_MAP ในหน้าทะเบียนคุม)"""
+    if df_status.empty: return np.array([], dtype=object)
+    return np.where(df_status["_stype"] == "leave",
+                    "ลา (" + df_status["_sval"].astype(str) + ")",
+                    df_status["_stype"].map(DAY_STATUS_TEXT).fillna("ขาดงาน"))
+
+def _status_symbol(status) -> str:
+    """สัญลักษณ์ทะเบียนคุมจากข้อความสถานะ"""
+    s = str(status)
+    if "วันหยุด" in s: return "X"
+    if "ลาป่วย"  in s: return "ป"
+    if "ลากิจ"   in s: return "ก"
+    if "ลาพักผ่อน" in s: return "พ"
+    if "ลาคลอด"  in s: return "ค"
+    if "ไปราชการ" in s: return "มอ"
+    if "มาสาย"   in s: return "ส"
+    if "ขาดงาน"  in s: return "ข"
+    if "ลืมสแกน" in s: return "-"
+    return ""
+
+def generate_leave_registers_batch(df_daily: pd.DataFrame, persons: list,
+                                   fiscal_year_be: int, selected_months: list,
+                                   holiday_set: set = None) -> Dict[str, pd.DataFrame]:
+    """
+    สร้างตาราง matrix 1-31 ทะเบียนคุมวันลาของหลายคนพร้อมกัน
+    df_daily: ตารางสถานะ long (ชื่อพนักงาน | วันที่ | สถานะ) ของทุกคนรวมกัน
+    → pivot ครั้งเดียวได้ทุกคน × ทุกเดือน + crosstab คอลัมน์สรุป
+    คืน {ชื่อ: df_register (index = เดือน)}
+    """
+    fy_ad = fiscal_year_be - 543
+    months_data = [(m_name, m_num, fy_ad + off) for m_name, m_num, off in FISCAL_MONTHS]
+    if REGISTER_ALL_MONTHS not in selected_months:
+        months_data = [m for m in months_data if m[0] in selected_months]
+    persons = list(dict.fromkeys(str(p).strip() for p in persons))
+    if not months_data or not persons:
+        return {}
+
+    # ── grid เต็ม: ทุกคน × ทุกวันของเดือนที่เลือก ───────────
+    days = pd.DatetimeIndex(np.concatenate([
+        pd.date_range(dt.date(y, m, 1), periods=_cal.monthrange(y, m)[1], freq="D").values
+        for _, m, y in months_data
+    ]))
+    grid = pd.DataFrame({
+        "ชื่อพนักงาน": np.repeat(np.array(persons, dtype=object), len(days)),
+        "วันที่":       np.tile(days.values, len(persons)),
+    })
+
+    # ── สัญลักษณ์จากตารางสถานะ (map ต่อค่า unique ไม่ใช่ต่อแถว) ─
+    if df_daily is not None and not df_daily.empty:
+        df_s = df_daily[["ชื่อพนักงาน","วันที่","สถานะ"]].copy()
+        df_s["ชื่อพนักงาน"] = df_s["ชื่อพนักงาน"].astype(str).str.strip()
+        df_s["วันที่"] = pd.to_datetime(df_s["วันที่"], errors="coerce").dt.normalize()
+        df_s = df_s.dropna(subset=["วันที่"]).drop_duplicates(["ชื่อพนักงาน","วันที่"], keep="first")
+        status = df_s["สถานะ"].astype(str)
+        df_s["symbol"] = status.map({u: _status_symbol(u) for u in status.unique()})
+        grid = grid.merge(df_s[["ชื่อพนักงาน","วันที่","symbol"]], on=["ชื่อพนักงาน","วันที่"], how="left")
+        sym = grid["symbol"].fillna("").to_numpy(dtype=object)
+    else:
+        sym = np.full(len(grid), "", dtype=object)
+
+    # ✅ เสาร์-อาทิตย์ → X, วันหยุดนักขัตฤกษ์ → H
+    gd = pd.DatetimeIndex(grid["วันที่"])
+    weekend = gd.weekday >= 5
+    holiday = gd.isin(pd.DatetimeIndex(sorted(holiday_set))) if holiday_set else np.zeros(len(grid), dtype=bool)
+    sym = np.where(weekend, "X", np.where(holiday, "H", sym))
+
+    month_name = {(y, m): n for n, m, y in months_data}
+    grid["เดือน"]  = [month_name[k] for k in zip(gd.year, gd.month)]
+    grid["day"]    = gd.day.astype(str)
+    grid["symbol"] = sym
+
+    # ── pivot ครั้งเดียว: (คน, เดือน) × วันที่ 1-31 ────────────
+    day_cols = [str(d) for d in range(1, 32)]
+    mat = grid.pivot(index=["ชื่อพนักงาน","เดือน"], columns="day", values="symbol")
+    mat = mat.reindex(columns=day_cols).fillna("/")   # วันที่ไม่มีในเดือน → "/"
+    mat.columns.name = None
+
+    # ✅ นับเฉพาะวันทำการ — X/H ถูกแทนที่แล้วจึงไม่ถูกนับ
+    counts = pd.crosstab([grid["ชื่อพนักงาน"], grid["เดือน"]], grid["symbol"]).reindex(mat.index, fill_value=0)
+    for col, s in REGISTER_SUMMARY_COLS:
+        mat[col] = counts[s].astype(int) if s in counts.columns else 0
+
+    month_order = [m[0] for m in months_data]
+    registers = {}
+    for p, df_p in mat.groupby(level=0, sort=False):
+        registers[p] = df_p.droplevel(0).reindex(month_order).rename_axis("เดือน")
+    return {p: registers[p] for p in persons if p in registers}
+
 def generate_leave_register(df_daily: pd.DataFrame, person_name: str,
                             fiscal_year_be: int, selected_months: list,
                             holiday_set: set = None) -> pd.DataFrame:
-    """สร้างตาราง matrix 1-31 สำหรับทะเบียนคุมวันลา"""
-    fy_ad = fiscal_year_be - 543
-    all_months_data = [
-        ("ตุลาคม",    10, fy_ad - 1),
-        ("พฤศจิกายน", 11, fy_ad - 1),
-        ("ธันวาคม",   12, fy_ad - 1),
-        ("มกราคม",     1, fy_ad),
-        ("กุมภาพันธ์", 2, fy_ad),
-        ("มีนาคม",     3, fy_ad),
-        ("เมษายน",     4, fy_ad),
-        ("พฤษภาคม",    5, fy_ad),
-        ("มิถุนายน",   6, fy_ad),
-        ("กรกฎาคม",    7, fy_ad),
-        ("สิงหาคม",    8, fy_ad),
-        ("กันยายน",    9, fy_ad),
-    ]
-    months_data = all_months_data if "ทั้งหมด (12 เดือน)" in selected_months else [
-        m for m in all_months_data if m[0] in selected_months
-    ]
+    """สร้างตาราง matrix 1-31 สำหรับทะเบียนคุมวันลา (1 คน — ใช้ batch engine)"""
+    regs = generate_leave_registers_batch(df_daily, [person_name], fiscal_year_be,
+                                          selected_months, holiday_set=holiday_set)
+    return regs.get(str(person_name).strip(), pd.DataFrame())
+
+
+# ===========================
+# 📊 Attendance KPIs (vectorized)
+# ===========================
+KPI_STATUSES: List[str] = ["มาปกติ","มาสาย","ขาดงาน","ลืมสแกน"]
+_ATT_CODE_TEXT: Dict[str, str] = {"ok": "มาปกติ", "late": "มาสาย", "absent": "ขาดงาน", "forgot": "ลืมสแกน"}
+DAY_STATUS_PREFIXES: List[Tuple[str, str]] = [
+    ("มาปกติ","มาปกติ"), ("มาสาย","มาสาย"), ("ขาดงาน","ขาดงาน"), ("ลืมสแกน","ลืมสแกน"),
+    ("วันหยุด","วันหยุด"), ("ลา","ลา"), ("ไปราชการ","ราชการ"),
+]
 
-    df_p = df_daily[df_daily["ชื่อพนักงาน"] == person_name].copy()
-    if not df_p.empty:
-        df_p["วันที่"] = pd.to_datetime(df_p["วันที่"])
-        df_p["day"]   = df_p["วันที่"].dt.day
-        df_p["month"] = df_p["วันที่"].dt.month
-        df_p["year"]  = df_p["วันที่"].dt.year
-
-        def _sym(status):
-            s = str(status)
-            if "วันหยุด" in s: return "X"
-            if "ลาป่วย"  in s: return "ป"
-            if "ลากิจ"   in s: return "ก"
-            if "ลาพักผ่อน" in s: return "พ"
-            if "ลาคลอด"  in s: return "ค"
-            if "ไปราชการ" in s: return "มอ"
-            if "มาสาย"   in s: return "ส"
-            if "ขาดงาน"  in s: return "ข"
-            if "ลืมสแกน" in s: return "-"
-            return ""
-        df_p["symbol"] = df_p["สถานะ"].apply(_sym)
+def attendance_scan_status(df_att: pd.DataFrame) -> np.ndarray:
+    """
+    [Phase 2] สถานะสแกนรายแถวแบบ vectorized (แทน df.apply(_att_status, axis=1))
+    ส.-อา. → วันหยุด, ที่เหลือ np.select บนเวลาเข้า/ออกแบบนาที
+    """
+    if df_att.empty: return np.array([], dtype=object)
+    weekend = (df_att["_wd"].to_numpy() >= 5) if "_wd" in df_att.columns else \
+              (pd.to_datetime(df_att["วันที่"], errors="coerce").dt.weekday.to_numpy() >= 5)
+    m_in  = _time_minutes(df_att["เวลาเข้า"]) if "เวลาเข้า" in df_att.columns else np.full(len(df_att), np.nan)
+    m_out = _time_minutes(df_att["เวลาออก"])  if "เวลาออก"  in df_att.columns else np.full(len(df_att), np.nan)
+    codes = _att_status_codes(m_in, m_out)
+    text  = np.select([codes == k for k in _ATT_CODE_TEXT], list(_ATT_CODE_TEXT.values()), default="มาปกติ")
+    return np.where(weekend, "วันหยุด", text)
+
+def _kpi_totals(ct: pd.DataFrame) -> pd.DataFrame:
+    ct = ct.reindex(columns=KPI_STATUSES, fill_value=0)
+    ct["วันรวม"]   = ct[KPI_STATUSES].sum(axis=1)
+    ct["% มาปกติ"] = (ct["มาปกติ"] / ct["วันรวม"].replace(0, 1) * 100).round(1)
+    return ct
+
+def attendance_kpi_cube(df_work: pd.DataFrame) -> pd.DataFrame:
+    """crosstab ครั้งเดียว: (ชื่อ-สกุล, เดือน) × สถานะสแกน — ใช้ต่อได้ทั้งรายคนและรายเดือน"""
+    if df_work.empty: return pd.DataFrame(columns=KPI_STATUSES)
+    ct = pd.crosstab([df_work["ชื่อ-สกุล"].astype(str).rename("ชื่อ-สกุล"),
+                      df_work["เดือน"].astype(str).rename("เดือน")],
+                     df_work["สถานะสแกน"])
+    return ct.reindex(columns=KPI_STATUSES, fill_value=0).rename_axis(columns=None)
+
+def kpi_by_month(cube: pd.DataFrame) -> pd.DataFrame:
+    if cube.empty: return pd.DataFrame()
+    return _kpi_totals(cube.groupby(level="เดือน").sum()).reset_index().sort_values("เดือน")
+
+def kpi_by_person(cube: pd.DataFrame, month: Optional[str] = None) -> pd.DataFrame:
+    """สรุปรายบุคคล (ทั้งหมดหรือเฉพาะเดือน) พร้อม badge 🟢/🟡/🔴"""
+    if cube.empty: return pd.DataFrame()
+    if month:
+        if month not in cube.index.get_level_values("เดือน"): return pd.DataFrame()
+        ct = cube.xs(month, level="เดือน")
     else:
-        df_p = pd.DataFrame(columns=["day","month","year","symbol"])
-
-    matrix_data = []
-    for m_name, m_num, m_year in months_data:
-        max_days = _cal.monthrange(m_year, m_num)[1]
-        df_m = df_p[(df_p["month"] == m_num) & (df_p["year"] == m_year)]
-        row = {"เดือน": m_name}
-        for d in range(1, 32):
-            if d > max_days:
-                row[str(d)] = "/"
-            else:
-                # ✅ เสาร์-อาทิตย์ → X
-                try:
-                    d_obj = dt.date(m_year, m_num, d)
-                    day_of_week = d_obj.weekday()
-                    if day_of_week >= 5:
-                        row[str(d)] = "X"
-                        continue
-                    # ✅ วันหยุดนักขัตฤกษ์ → H
-                    if holiday_set and d_obj in holiday_set:
-                        row[str(d)] = "H"
-                        continue
-                except ValueError:
-                    row[str(d)] = "/"
-                    continue
-                vals = df_m[df_m["day"] == d]["symbol"].values
-                row[str(d)] = vals[0] if len(vals) > 0 else ""
-
-        # ✅ นับเฉพาะวันทำการ ไม่รวม ส.-อา. และวันหยุดนักขัตฤกษ์
-        def _count_workday_symbol(sym):
-            count = 0
-            for _, r in df_m[df_m["symbol"] == sym].iterrows():
-                try:
-                    d_obj = dt.date(m_year, m_num, int(r["day"]))
-                    if d_obj.weekday() >= 5:
-                        continue  # ส.-อา. ไม่นับ
-                    if holiday_set and d_obj in holiday_set:
-                        continue  # วันหยุดนักขัตฤกษ์ ไม่นับ
-                    count += 1
-                except (ValueError, TypeError):
-                    pass
-            return count
-
-        row.update({
-            "ป่วย(วัน)":      _count_workday_symbol("ป"),
-            "กิจ(วัน)":       _count_workday_symbol("ก"),
-            "พักผ่อน(วัน)":   _count_workday_symbol("พ"),
-            "ขาด(วัน)":       _count_workday_symbol("ข"),
-            "สาย(ครั้ง)":     _count_workday_symbol("ส"),
-            "ลืมสแกน(ครั้ง)": _count_workday_symbol("-"),
-        })
-        matrix_data.append(row)
-    df_mat = pd.DataFrame(matrix_data)
-    if not df_mat.empty:
-        df_mat = df_mat.set_index("เดือน")
-    return df_mat
+        ct = cube.groupby(level="ชื่อ-สกุล").sum()
+    df = _kpi_totals(ct)
+    df = df[df["วันรวม"] > 0].rename(columns={"วันรวม": "วันทำการ"}).reset_index()
+    df["สถานะ"] = np.select([df["% มาปกติ"] >= 80, df["% มาปกติ"] >= 60], ["🟢", "🟡"], default="🔴")
+    return df[["ชื่อ-สกุล","วันทำการ"] + KPI_STATUSES + ["% มาปกติ","สถานะ"]]
+
+def summarize_day_status(df: pd.DataFrame, name_col: str = "ชื่อ-นามสกุล",
+                         status_col: str = "สถานะ") -> pd.DataFrame:
+    """สรุปรายบุคคลจากตารางสถานะรายวัน (prefix ของข้อความสถานะ) ด้วย crosstab ครั้งเดียว"""
+    out_cols = [name_col, "วันทำการ"] + [c for _, c in DAY_STATUS_PREFIXES if c != "วันหยุด"] + ["% มาปกติ"]
+    if df.empty: return pd.DataFrame(columns=out_cols)
+    s   = df[status_col].astype(str)
+    cat = np.select([s.str.startswith(p).to_numpy() for p, _ in DAY_STATUS_PREFIXES],
+                    [c for _, c in DAY_STATUS_PREFIXES], default="")
+    ct  = pd.crosstab(df[name_col].astype(str).to_numpy(), cat)
+    ct  = ct.reindex(columns=[c for _, c in DAY_STATUS_PREFIXES] + [""], fill_value=0).rename_axis(columns=None)
+    out = ct.drop(columns=["", "วันหยุด"])
+    out.insert(0, "วันทำการ", ct.sum(axis=1) - ct["วันหยุด"])
+    out["% มาปกติ"] = (out["มาปกติ"] / out["วันทำการ"].replace(0, np.nan) * 100).round(1).fillna(0)
+    out = out.rename_axis(name_col).reset_index()
+    return out[out_cols].sort_values("% มาปกติ", ascending=False)
 
 
 def style_leave_register(df: pd.DataFrame):
@@ -1886,7 +4050,7 @@ with st.sidebar:
         "🧭 บันทึกไปราชการ","🕒 บันทึกการลา","📈 วันลาคงเหลือ","👤 จัดการบุคลากร","🔔 กิจกรรมล่าสุด","⚙️ ผู้ดูแลระบบ",
     ], label_visibility="collapsed")
     st.markdown("---")
-    loaded_at=st.session_state.get("_data_loaded_at")
+    _sidebar_snap=_snap(); loaded_at=_sidebar_snap.loaded_at if _sidebar_snap is not None else None
     if loaded_at:
         age_sec=int((dt.datetime.now()-loaded_at).total_seconds())
         st.caption(f"🗄️ Cache: {age_sec//60}:{age_sec%60:02d} นาที")
@@ -1895,8 +4059,12 @@ with st.sidebar:
     st.caption(f"v3.0 | {dt.date.today().strftime('%d/%m/%Y')}")
 
 # ✅ FIX: เรียก cache หลัง sidebar init ครบแล้ว
-# ตรวจ session_state ก่อน — ป้องกัน health check timeout ตอน startup
-if "cache_leave" not in st.session_state:
+_cache_refresher()   # [SWR] pre-warm ครั้งแรกของ process — session แรกรอ lock เดียวกับ worker ไม่โหลดซ้ำ
+_activity_writer()   # [Async log] เริ่ม writer ตั้งแต่ต้น → ส่ง event ที่ค้างจาก process ก่อนหน้า
+_attachment_uploader()   # [Attach] อัปโหลดไฟล์แนบที่ค้างจาก process ก่อนหน้า
+_local_store()       # [Store] worker ซิงก์ snapshot → SQLite
+# ตรวจ snapshot กลางก่อน — ป้องกัน health check timeout ตอน startup (session ใหม่ใช้ snapshot ที่โหลดไว้แล้ว)
+if _snap() is None:
     with st.spinner("⏳ โหลดข้อมูลเริ่มต้นระบบ..."):
         _load_all_data_to_cache()
 else:
@@ -1907,11 +4075,12 @@ else:
 # ===========================
 if menu == "🏠 หน้าหลัก":
     st.markdown('<div class="section-header">🏥 ระบบติดตามการลา ไปราชการ และการปฏิบัติงาน<br>สำนักงานป้องกันควบคุมโรคที่ 9</div>', unsafe_allow_html=True)
+    _ensure_data_loaded(("leave","travel"))   # [Lazy] ไม่แตะ attendance / ไฟล์ไปราชการอื่น
     df_leave,df_travel=_dc("cache_leave"),_dc("cache_travel")
     c1,c2,c3,c4=st.columns(4)
-    this_month=dt.date.today().strftime("%Y-%m")
-    leave_tm=len(df_leave[df_leave["วันที่เริ่ม"].dt.strftime("%Y-%m")==this_month]) if not df_leave.empty and "วันที่เริ่ม" in df_leave.columns else 0
-    travel_tm=len(df_travel[df_travel["วันที่เริ่ม"].dt.strftime("%Y-%m")==this_month]) if not df_travel.empty and "วันที่เริ่ม" in df_travel.columns else 0
+    this_month=month_key(dt.date.today())
+    leave_tm=int((df_leave["_ym"]==this_month).sum()) if "_ym" in df_leave.columns else 0
+    travel_tm=int((df_travel["_ym"]==this_month).sum()) if "_ym" in df_travel.columns else 0
     c1.metric("📋 ลาเดือนนี้",f"{leave_tm} ครั้ง"); c2.metric("🚗 ราชการเดือนนี้",f"{travel_tm} ครั้ง")
     c3.metric("📋 ลารวมทั้งหมด",f"{len(df_leave)} ครั้ง"); c4.metric("🚗 ราชการรวมทั้งหมด",f"{len(df_travel)} ครั้ง")
     st.markdown("---")
@@ -1930,40 +4099,24 @@ if menu == "🏠 หน้าหลัก":
 # ===========================
 elif menu == "📊 Dashboard & รายงาน":
     st.markdown('<div class="section-header">📊 Dashboard & วิเคราะห์ข้อมูล</div>', unsafe_allow_html=True)
-    df_att        = _dc("cache_att")
-    df_leave      = _dc("cache_leave")
+    # [Cold] att_hot = เฉพาะเดือนในไฟล์ร้อน — เดือนในคลังมาจาก cube ที่สรุปไว้ (ไม่โหลดแถวดิบของทุกเดือน)
+    _ensure_data_loaded(("att_hot","leave_all","travel_all"))   # [FY] รายงานหลายปี → รวมคลังปีงบเก่า
+    df_att        = _dc("cache_att_hot")
+    df_leave      = _dc("cache_leave_all")
     df_staff      = _dc("cache_staff")
     df_travel_all = _dc("cache_travel_all")
 
-    LATE_CUT = dt.time(8, 31)
-
-    # ── คำนวณ KPI ──────────────────────────────────────────────
-    def _att_status(row):
-        if pd.to_datetime(row["วันที่"], errors="coerce").weekday() >= 5: return "วันหยุด"
-        t_in  = parse_time(row.get("เวลาเข้า", ""))
-        t_out = parse_time(row.get("เวลาออก",  ""))
-        if not t_in and not t_out:                                      return "ขาดงาน"
-        if (t_in and not t_out) or (not t_in and t_out) or (t_in == t_out): return "ลืมสแกน"
-        if t_in >= LATE_CUT:                                            return "มาสาย"
-        return "มาปกติ"
-
-    if not df_att.empty:
-        df_att = df_att.copy()
-        df_att["วันที่"]       = pd.to_datetime(df_att["วันที่"], errors="coerce")
-        df_att["เดือน"]        = df_att["วันที่"].dt.strftime("%Y-%m")
-        df_att["สถานะสแกน"]   = df_att.apply(_att_status, axis=1)
-        df_work    = df_att[~df_att["สถานะสแกน"].isin(["วันหยุด"])]
-        total_work = len(df_work)
-        n_ok    = len(df_work[df_work["สถานะสแกน"] == "มาปกติ"])
-        n_late  = len(df_work[df_work["สถานะสแกน"] == "มาสาย"])
-        n_absent= len(df_work[df_work["สถานะสแกน"] == "ขาดงาน"])
-        n_forgot= len(df_work[df_work["สถานะสแกน"] == "ลืมสแกน"])
-        pct_ok  = n_ok / total_work * 100 if total_work else 0
-        pct_late= n_late / total_work * 100 if total_work else 0
-    else:
-        total_work = n_ok = n_late = n_absent = n_forgot = 0
-        pct_ok = pct_late = 0.0
-        df_work = pd.DataFrame()
+    # ── คำนวณ KPI จาก cube (คลัง + เดือนร้อน) — วันทำการ = ผลรวมทุกสถานะใน cube ──
+    df_work    = df_att[df_att["สถานะสแกน"] != "วันหยุด"] if not df_att.empty else pd.DataFrame()
+    _cold_months = _cache_value("_att_hot_cold_months") or ()
+    _kpi_cube  = attendance_trend_cube(df_work, _cold_months)
+    _kpi_tot   = _kpi_cube.sum() if not _kpi_cube.empty else pd.Series(0, index=KPI_STATUSES)
+    total_work = int(_kpi_tot.sum())
+    n_ok, n_late, n_absent, n_forgot = (int(_kpi_tot[c]) for c in KPI_STATUSES)
+    pct_ok  = n_ok / total_work * 100 if total_work else 0.0
+    pct_late= n_late / total_work * 100 if total_work else 0.0
+    if _cold_months and not _kpi_cube.empty and not set(_cold_months) <= set(_kpi_cube.index.get_level_values("เดือน")):
+        st.caption("🧊 cube ของเดือนในคลังกำลังสรุปใหม่ — ตอนนี้แสดงเฉพาะเดือนในไฟล์สแกนปัจจุบัน")
 
     # ── KPI Cards ──────────────────────────────────────────────
     kc1, kc2, kc3, kc4 = st.columns(4)
@@ -1975,19 +4128,8 @@ elif menu == "📊 Dashboard & รายงาน":
 
     st.divider()
 
-    # ── Phase 1a: คำนวณ monthly summary ครั้งเดียวก่อน tabs ──
-    if not df_work.empty:
-        _df_monthly_base = (
-            df_work.groupby("เดือน")["สถานะสแกน"]
-            .value_counts().unstack(fill_value=0).reset_index()
-        )
-        for _c in ["มาปกติ","มาสาย","ขาดงาน","ลืมสแกน"]:
-            if _c not in _df_monthly_base.columns: _df_monthly_base[_c] = 0
-        _df_monthly_base["วันรวม"]    = _df_monthly_base[["มาปกติ","มาสาย","ขาดงาน","ลืมสแกน"]].sum(axis=1)
-        _df_monthly_base["% มาปกติ"]  = (_df_monthly_base["มาปกติ"] / _df_monthly_base["วันรวม"].replace(0,1) * 100).round(1)
-        _df_monthly_base = _df_monthly_base.sort_values("เดือน")
-    else:
-        _df_monthly_base = pd.DataFrame()
+    # ── Phase 1a: monthly summary จาก cube เดียวกัน ไม่ groupby ซ้ำ ──
+    _df_monthly_base = kpi_by_month(_kpi_cube)
 
     # ── 5 Tabs ─────────────────────────────────────────────────
     tab_summary, tab_trend, tab_charts, tab_insight, tab_export = st.tabs([
@@ -1996,40 +4138,18 @@ elif menu == "📊 Dashboard & รายงาน":
 
     # ── Tab 1: สรุปรายบุคคล ───────────────────────────────────
     with tab_summary:
-        if df_work.empty:
+        if _kpi_cube.empty:
             st.info("ไม่มีข้อมูลการสแกนนิ้ว")
         else:
             # filter เดือน
-            months_avail = sorted(df_att["เดือน"].dropna().unique().tolist())
+            months_avail = sorted(_kpi_cube.index.get_level_values("เดือน").unique().tolist())
             sel_month = st.selectbox("เดือน", months_avail,
                                      index=len(months_avail)-1 if months_avail else 0,
                                      key="dash_month")
-            df_m = df_work[df_work["เดือน"] == sel_month] if sel_month else df_work
-
-            # สรุปรายบุคคล
-            summary_rows = []
-            for name, grp in df_m.groupby("ชื่อ-สกุล"):
-                total = len(grp)
-                ok    = len(grp[grp["สถานะสแกน"] == "มาปกติ"])
-                late  = len(grp[grp["สถานะสแกน"] == "มาสาย"])
-                absent= len(grp[grp["สถานะสแกน"] == "ขาดงาน"])
-                forgot= len(grp[grp["สถานะสแกน"] == "ลืมสแกน"])
-                pct   = ok / total * 100 if total else 0
-                if   pct >= 80: badge = "🟢"
-                elif pct >= 60: badge = "🟡"
-                else:           badge = "🔴"
-                summary_rows.append({
-                    "ชื่อ-สกุล":  name,
-                    "วันทำการ":   total,
-                    "มาปกติ":     ok,
-                    "มาสาย":      late,
-                    "ขาดงาน":     absent,
-                    "ลืมสแกน":    forgot,
-                    "% มาปกติ":   round(pct, 1),
-                    "สถานะ":       badge,
-                })
-            if summary_rows:
-                df_sum = pd.DataFrame(summary_rows).sort_values("% มาปกติ", ascending=False)
+            # สรุปรายบุคคล — slice จาก cube (ไม่วน groupby/filter ต่อคน)
+            df_sum = kpi_by_person(_kpi_cube, sel_month)
+            if not df_sum.empty:
+                df_sum = df_sum.sort_values("% มาปกติ", ascending=False)
                 st.dataframe(df_sum, use_container_width=True, height=450)
                 st.caption(f"🟢 ≥ 80%   🟡 60–79%   🔴 < 60%")
 
@@ -2105,7 +4225,7 @@ elif menu == "📊 Dashboard & รายงาน":
     # ── Tab 4: วิเคราะห์ ──────────────────────────────────────
     with tab_insight:
         st.subheader("🔍 ข้อวิเคราะห์จากข้อมูลจริง")
-        if df_work.empty:
+        if _kpi_cube.empty:
             st.info("ไม่มีข้อมูลเพียงพอสำหรับการวิเคราะห์")
         else:
             insights = []
@@ -2115,14 +4235,14 @@ elif menu == "📊 Dashboard & รายงาน":
                              + (" (✅ ผ่านเกณฑ์ 80%)" if pct_ok >= 80 else " (⚠️ ต่ำกว่าเกณฑ์ 80%)"))
 
             # 2. บุคลากรมาสายมากสุด
-            if "ชื่อ-สกุล" in df_work.columns:
-                late_by_name = df_work[df_work["สถานะสแกน"] == "มาสาย"].groupby("ชื่อ-สกุล").size().nlargest(3)
-                if not late_by_name.empty:
-                    top_late = ", ".join([f"{n} ({c} วัน)" for n, c in late_by_name.items()])
-                    insights.append(f"⏰ บุคลากรมาสายสูงสุด 3 อันดับ: {top_late}")
+            _by_name = _kpi_cube.groupby(level="ชื่อ-สกุล").sum() if not _kpi_cube.empty else pd.DataFrame(columns=KPI_STATUSES)
+            late_by_name = _by_name["มาสาย"][_by_name["มาสาย"] > 0].nlargest(3)
+            if not late_by_name.empty:
+                top_late = ", ".join([f"{n} ({c} วัน)" for n, c in late_by_name.items()])
+                insights.append(f"⏰ บุคลากรมาสายสูงสุด 3 อันดับ: {top_late}")
 
             # 3. บุคลากรขาดงานมากสุด
-            absent_by_name = df_work[df_work["สถานะสแกน"] == "ขาดงาน"].groupby("ชื่อ-สกุล").size().nlargest(3)
+            absent_by_name = _by_name["ขาดงาน"][_by_name["ขาดงาน"] > 0].nlargest(3)
             if not absent_by_name.empty:
                 top_abs = ", ".join([f"{n} ({c} วัน)" for n, c in absent_by_name.items()])
                 insights.append(f"❌ บุคลากรขาดงานสูงสุด 3 อันดับ: {top_abs}")
@@ -2169,7 +4289,10 @@ elif menu == "📊 Dashboard & รายงาน":
             m_end   = m_start + pd.offsets.MonthEnd(0)
             df_lm   = df_leave[(df_leave["วันที่เริ่ม"] >= m_start) & (df_leave["วันที่เริ่ม"] <= m_end)] \
                       if not df_leave.empty else pd.DataFrame()
-            df_wm   = df_work[df_work["เดือน"] == export_month] if not df_work.empty else pd.DataFrame()
+            if export_month in set(_cold_months):   # เดือนในคลัง → โหลดแถวดิบเฉพาะตอนสั่ง export
+                _ensure_data_loaded(("att",))
+                df_work = _dc("cache_att"); df_work = df_work[df_work["สถานะสแกน"] != "วันหยุด"] if not df_work.empty else df_work
+            df_wm   = df_work[df_work["เดือน"].astype(str) == export_month] if not df_work.empty else pd.DataFrame()
             output  = io.BytesIO()
             with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
                 pd.DataFrame({
@@ -2197,15 +4320,15 @@ elif menu == "📊 Dashboard & รายงาน":
 # ===========================
 elif menu == "📅 ตรวจสอบการปฏิบัติงาน":
     st.markdown('<div class="section-header">📅 ตรวจสอบการปฏิบัติงาน</div>', unsafe_allow_html=True)
+    _ensure_data_loaded(("att","leave_all","travel_all"))   # [FY] รายงานหลายปี → รวมคลังปีงบเก่า
     df_att        = _dc("cache_att")
-    df_leave      = _dc("cache_leave")
+    df_leave      = _dc("cache_leave_all")
     df_staff      = _dc("cache_staff")
     df_travel_all = _dc("cache_travel_all")
     all_names     = get_active_staff(df_staff) or get_all_names_fallback(df_leave, df_travel_all, df_att)
 
     if not df_att.empty:
-        df_att["วันที่"]  = pd.to_datetime(df_att["วันที่"], errors="coerce").dt.normalize()
-        months_att = sorted(df_att["วันที่"].dt.strftime("%Y-%m").dropna().unique().tolist())
+        months_att = [m for m in month_label(np.unique(df_att["_ym"])) if m]
     else:
         months_att = [dt.datetime.now().strftime("%Y-%m")]
 
@@ -2226,21 +4349,11 @@ elif menu == "📅 ตรวจสอบการปฏิบัติงาน"
     leave_index = {}
     if not df_leave.empty:
         for _, row in df_leave.dropna(subset=["วันที่เริ่ม","วันที่สิ้นสุด"]).iterrows():
-            leave_index.setdefault(str(row.get("ชื่อ-สกุล","")).strip(), []).append((
+            leave_index.setdefault(str(row.get(STAFF_NAME_COL, row.get("ชื่อ-สกุล",""))).strip(), []).append((
                 row["วันที่เริ่ม"].date(), row["วันที่สิ้นสุด"].date(),
                 str(row.get("ประเภทการลา","ลา"))))
 
-    travel_index = {}
-    if not df_travel_all.empty:
-        for _, row in df_travel_all.dropna(subset=["วันที่เริ่ม","วันที่สิ้นสุด"]).iterrows():
-            proj = str(row.get("เรื่อง/กิจกรรม","ไปราชการ")).strip()
-            names = [str(row.get("ชื่อ-สกุล","")).strip()]
-            for comp in str(row.get("ผู้ร่วมเดินทาง","")).replace("\n",",").split(","):
-                comp = re.sub(r"\d+\.\s*","",comp).strip()
-                if comp and len(comp) >= 3 and comp.lower() != "nan": names.append(comp)
-            for p in set(names):
-                travel_index.setdefault(p, []).append((
-                    row["วันที่เริ่ม"].date(), row["วันที่สิ้นสุด"].date(), proj))
+    travel_index = travel_index_from_participants(get_travel_participants())
 
     LATE_CUTOFF = dt.time(8, 31)
 
@@ -2392,40 +4505,17 @@ elif menu == "📅 ตรวจสอบการปฏิบัติงาน"
                 for yr in {fy_ad - 1, fy_ad}:
                     holiday_fy_set.update(get_holiday_dates(yr))
 
-                STATUS_MAP = {
-                    "leave":   lambda sv: f"ลา ({sv})",
-                    "travel":  lambda sv: "ไปราชการ",
-                    "weekend": lambda sv: "วันหยุด",
-                    "holiday": lambda sv: "วันหยุด",
-                    "absent":  lambda sv: "ขาดงาน",
-                    "forgot":  lambda sv: "ลืมสแกน",
-                    "late":    lambda sv: "มาสาย",
-                    "ok":      lambda sv: "มาปกติ",
-                }
-
-                prog = st.progress(0, text="กำลังสร้างทะเบียนคุม...")
-                all_registers = {}   # {name: df_register}
-
-                for idx, person in enumerate(reg_persons):
-                    prog.progress((idx + 1) / len(reg_persons),
-                                  text=f"กำลังประมวลผล {person} ({idx+1}/{len(reg_persons)})...")
-                    recs = []
-                    for d in fy_months_range:
-                        d_date  = d.date()
-                        stype, sval = _get_day_status(person, d_date, d.weekday(), holiday_fy_set)
-                        fn = STATUS_MAP.get(stype)
-                        status = fn(sval) if fn else "ขาดงาน"
-                        recs.append({"ชื่อพนักงาน": person, "วันที่": d_date, "สถานะ": status})
-
-                    df_r = pd.DataFrame(recs)
-                    df_reg = generate_leave_register(
-                        df_r, person, reg_year, reg_months,
-                        holiday_set=holiday_fy_set,
+                # ── batch: ตารางสถานะเดียวของทุกคน → pivot ครั้งเดียว ──
+                with st.spinner(f"กำลังสร้างทะเบียนคุม {n_sel} คน..."):
+                    df_r = build_day_status_table(
+                        reg_persons, fy_months_range, holiday_fy_set,
+                        df_att=df_att, leave_idx=leave_index, travel_idx=travel_index,
                     )
-                    if not df_reg.empty:
-                        all_registers[person] = df_reg
-
-                prog.empty()
+                    df_r["สถานะ"] = day_status_text(df_r)
+                    all_registers = generate_leave_registers_batch(
+                        df_r, reg_persons, reg_year, reg_months,
+                        holiday_set=holiday_fy_set,
+                    )   # {name: df_register}
 
                 if not all_registers:
                     st.warning("ไม่พบข้อมูลของบุคลากรที่เลือกในช่วงเวลานี้")
@@ -2456,11 +4546,7 @@ elif menu == "📅 ตรวจสอบการปฏิบัติงาน"
                         df_reg = all_registers[person]
 
                         # header
-                        p_info = {}
-                        if not df_staff.empty:
-                            nm = df_staff["ชื่อ-สกุล"].astype(str).str.strip()
-                            rs = df_staff[nm == person.strip()]
-                            if not rs.empty: p_info = rs.iloc[0].to_dict()
+                        p_info = get_staff_resolver(df_staff).info(person)
                         _pos = p_info.get("ตำแหน่ง","") or "—"
 
                         st.markdown(
@@ -2489,11 +4575,7 @@ elif menu == "📅 ตรวจสอบการปฏิบัติงาน"
                     else:
                         # ── หลายคน: expander แต่ละคน + ZIP ──
                         for person, df_reg in all_registers.items():
-                            p_info = {}
-                            if not df_staff.empty:
-                                nm = df_staff["ชื่อ-สกุล"].astype(str).str.strip()
-                                rs = df_staff[nm == person.strip()]
-                                if not rs.empty: p_info = rs.iloc[0].to_dict()
+                            p_info = get_staff_resolver(df_staff).info(person)
                             _pos = p_info.get("ตำแหน่ง","") or "—"
                             _grp = p_info.get("กลุ่มงาน","") or "—"
 
@@ -2631,10 +4713,7 @@ elif menu == "📅 ตรวจสอบการปฏิบัติงาน"
                 if exp_exclude_weekend:
                     df_exp = df_exp[~df_exp["สถานะ"].isin(["วันหยุด","วันหยุดพิเศษ"])]
                 if exp_status_filter:
-                    mask = df_exp["สถานะ"].apply(
-                        lambda s: any(str(s).startswith(f) for f in exp_status_filter)
-                    )
-                    df_exp = df_exp[mask]
+                    df_exp = df_exp[df_exp["สถานะ"].astype(str).str.startswith(tuple(exp_status_filter))]
 
                 months_str = "_".join(months_exp[:3]) + ("_..." if len(months_exp) > 3 else "")
 
@@ -2720,22 +4799,7 @@ elif menu == "📅 ตรวจสอบการปฏิบัติงาน"
                 # 3. Excel รายวัน + สรุป
                 with dl3:
                     # สรุปรายบุคคล
-                    summary_exp = []
-                    for person, grp in df_exp.groupby("ชื่อ-นามสกุล"):
-                        wd   = len(grp[~grp["สถานะ"].isin(["วันหยุด","วันหยุดพิเศษ"])])
-                        ok_  = grp["สถานะ"].str.startswith("มาปกติ").sum()
-                        summary_exp.append({
-                            "ชื่อ-นามสกุล": person,
-                            "วันทำการ":     wd,
-                            "มาปกติ":       int(ok_),
-                            "มาสาย":        int(grp["สถานะ"].str.startswith("มาสาย").sum()),
-                            "ขาดงาน":       int(grp["สถานะ"].str.startswith("ขาดงาน").sum()),
-                            "ลืมสแกน":      int(grp["สถานะ"].str.startswith("ลืมสแกน").sum()),
-                            "ลา":           int(grp["สถานะ"].str.startswith("ลา").sum()),
-                            "ราชการ":       int(grp["สถานะ"].str.startswith("ไปราชการ").sum()),
-                            "% มาปกติ":     round(ok_/wd*100, 1) if wd else 0,
-                        })
-                    df_sum_exp = pd.DataFrame(summary_exp).sort_values("% มาปกติ", ascending=False)
+                    df_sum_exp = summarize_day_status(df_exp, "ชื่อ-นามสกุล", "สถานะ")
 
                     buf_sum = io.BytesIO()
                     with pd.ExcelWriter(buf_sum, engine="xlsxwriter") as writer:
@@ -2796,7 +4860,7 @@ elif menu == "📅 ตรวจสอบการปฏิบัติงาน"
 elif menu == "📅 ปฏิทินกลาง":
     st.markdown('<div class="section-header">📅 ปฏิทินกลางหน่วยงาน</div>', unsafe_allow_html=True)
 
-    _ensure_data_loaded()  # [I1] ใช้ cache แทน direct Drive read
+    _ensure_data_loaded(("leave","travel"))  # [I1] ใช้ cache แทน direct Drive read
     df_leave  = get_data("cache_leave")
     df_travel = get_data("cache_travel")
     df_staff  = get_data("cache_staff")
@@ -2818,6 +4882,10 @@ elif menu == "📅 ปฏิทินกลาง":
     m_start = pd.to_datetime(cal_month + "-01")
     m_end   = m_start + pd.offsets.MonthEnd(0)
     date_range = pd.date_range(m_start, m_end, freq="D")
+    cal_ds = ("leave", "travel")
+    if fiscal_year_be(m_start) < hot_fiscal_year_min():   # [FY] เดือนในปีงบที่ย้ายเข้าคลังแล้ว → โหลดประวัติตอนนี้
+        cal_ds = ("leave_all", "travel_all")
+        df_leave, df_travel = get_data("cache_leave_all"), get_data("cache_travel_all")
 
     # Filter staff
     names_to_show = cal_names or all_names
@@ -2825,22 +4893,20 @@ elif menu == "📅 ปฏิทินกลาง":
         grp_names = df_staff[df_staff["กลุ่มงาน"] == cal_group]["ชื่อ-สกุล"].tolist()
         names_to_show = [n for n in names_to_show if n in grp_names]
 
+    # [Store] ช่วงลา/ไปราชการของเดือนนี้ query ครั้งเดียวต่อ dataset (index _person,_d0) แทน filter ทั้งตารางรายคน×รายวัน
+    busy: Dict[str, list] = {}
+    for span_status, ds_name, df_src in (("ลา", cal_ds[0], df_leave), ("ไปราชการ", cal_ds[1], df_travel)):
+        for p, d0, d1 in person_ranges(ds_name, df_src, names_to_show, m_start, m_end).itertuples(index=False):
+            busy.setdefault(p, []).append((d0, d1, span_status))
+
     cal_records = []
     for name in names_to_show:
+        spans = busy.get(str(name).strip(), [])
         for d in date_range:
             status = "วันหยุด" if d.weekday() >= 5 else "ปฏิบัติงาน"
-
-            ul = df_leave[df_leave["ชื่อ-สกุล"] == name] if not df_leave.empty else pd.DataFrame()
-            if not ul.empty:
-                ml = ul[(ul["วันที่เริ่ม"] <= d) & (ul["วันที่สิ้นสุด"] >= d)]
-                if not ml.empty:
-                    status = "ลา"
-
-            ut = df_travel[df_travel["ชื่อ-สกุล"] == name] if not df_travel.empty else pd.DataFrame()
-            if not ut.empty:
-                mt = ut[(ut["วันที่เริ่ม"] <= d) & (ut["วันที่สิ้นสุด"] >= d)]
-                if not mt.empty:
-                    status = "ไปราชการ"
+            for d0, d1, span_status in spans:   # ไปราชการอยู่หลังลา → ทับเหมือนเดิม
+                if d0 <= d <= d1:
+                    status = span_status
 
             cal_records.append({"ชื่อ-สกุล": name, "วันที่": d.strftime("%d"), "สถานะ": status, "วันที่เต็ม": d})
 
@@ -2881,13 +4947,13 @@ elif menu == "📅 ปฏิทินกลาง":
 elif menu == "🧭 บันทึกไปราชการ":
     st.markdown('<div class="section-header">🧭 บันทึกการเดินทางไปราชการ</div>', unsafe_allow_html=True)
 
-    _ensure_data_loaded()  # [I1]
+    _ensure_data_loaded(("travel","leave"))  # [I1]
     df_travel    = get_data("cache_travel")
-    _travel_fid  = st.session_state.get("_fid_travel")
+    _travel_fid  = _cache_value("_fid_travel")
     df_leave     = get_data("cache_leave")
-    df_att       = get_data("cache_att")
     df_staff     = get_data("cache_staff")
-    ALL_NAMES    = get_active_staff(df_staff) or get_all_names_fallback(df_leave, df_travel, df_att)
+    # [Lazy] attendance ใช้แค่เป็น fallback รายชื่อ — โหลดเฉพาะเมื่อไม่มี staff master
+    ALL_NAMES    = get_active_staff(df_staff) or get_all_names_fallback(df_leave, df_travel, get_data("cache_att"))
 
     st.info(f"📂 ข้อมูลไปราชการปัจจุบัน: **{len(df_travel)} รายการ**  "
             f"{'(file ID: ' + _travel_fid[:8] + '...)' if _travel_fid else '⚠️ ยังไม่มีไฟล์ใน Drive'}")
@@ -2922,18 +4988,17 @@ elif menu == "🧭 บันทึกไปราชการ":
                     st.error(e)
             else:
                 with st.status("กำลังบันทึก...", expanded=True) as status:
+                    upload_id = None
                     try:
                         link = "-"
-                        if uploaded_pdf:
-                            st.write("📤 อัปโหลดไฟล์...")
-                            fid_att = get_or_create_folder(ATTACHMENT_FOLDER_NAME, FOLDER_ID)
-                            if fid_att:
-                                fn = f"TRAVEL_{dt.datetime.now().strftime('%Y%m%d_%H%M')}_{len(final_staff)}pax.pdf"
-                                link = upload_pdf_to_drive(uploaded_pdf, fn, fid_att)
+                        if uploaded_pdf:   # [Attach] เก็บลงเครื่องก่อน — อัปโหลดเบื้องหลังหลังบันทึกแถว
+                            upload_id = spool_attachment(uploaded_pdf)
+                            fn   = f"TRAVEL_{dt.datetime.now().strftime('%Y%m%d_%H%M')}_{len(final_staff)}pax.pdf"
+                            link = pending_attachment_link(upload_id)
 
                         st.write("💾 บันทึกข้อมูล...")
                         ts   = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        days = count_weekdays(d_start, d_end)
+                        days = get_business_calendar().count(d_start, d_end)
                         new_rows = [
                             {"Timestamp": ts, "กลุ่มงาน": group_job, "ชื่อ-สกุล": p,
                              "เรื่อง/กิจกรรม": project, "สถานที่": location,
@@ -2941,11 +5006,11 @@ elif menu == "🧭 บันทึกไปราชการ":
                              "จำนวนวัน": days, "ไฟล์แนบ": link}
                             for p in final_staff
                         ]
-                        backup_excel(FILE_TRAVEL, df_travel)
-                        df_upd = pd.concat([df_travel, pd.DataFrame(new_rows)], ignore_index=True)
-
-                        # ส่ง known_file_id เพื่อให้ update ไฟล์เดิม ไม่สร้างใหม่
-                        if write_excel_to_drive(FILE_TRAVEL, df_upd, known_file_id=_travel_fid):
+                        # [Journal] บันทึกเป็น delta เล็ก ๆ — ไม่อัปโหลด travel_report ทั้งไฟล์ (รวมเข้าไฟล์หลักตามรอบ compaction)
+                        delta_id = append_delta_rows(FILE_TRAVEL, new_rows)
+                        if delta_id:
+                            if upload_id: queue_attachment(upload_id, fn, FILE_TRAVEL, delta_id); upload_id = None
+                            cache_apply_rows("travel", pd.DataFrame(new_rows), delta_id=delta_id)
                             # [N2] LINE Notify
                             st.write("🔔 ส่งแจ้งเตือน LINE...")
                             msg = format_travel_notify(final_staff, project, location, d_start, d_end, days)
@@ -2962,6 +5027,7 @@ elif menu == "🧭 บันทึกไปราชการ":
                     except Exception as e:
                         logger.error(f"travel form: {e}")
                         status.update(label=f"❌ {e}", state="error")
+                    if upload_id: discard_attachment(upload_id)   # แถวไม่ถูกบันทึก → ไม่อัปโหลด
 
     st.divider()
     st.subheader("📋 รายการล่าสุด")
@@ -2979,13 +5045,12 @@ elif menu == "🧭 บันทึกไปราชการ":
 elif menu == "🕒 บันทึกการลา":
     st.markdown('<div class="section-header">🕒 บันทึกการลา</div>', unsafe_allow_html=True)
 
-    _ensure_data_loaded()  # [I1]
+    _ensure_data_loaded(("leave","travel"))  # [I1]
     df_leave    = get_data("cache_leave")
-    _leave_fid  = st.session_state.get("_fid_leave")
+    _leave_fid  = _cache_value("_fid_leave")
     df_travel   = get_data("cache_travel")
-    df_att      = get_data("cache_att")
     df_staff    = get_data("cache_staff")
-    ALL_NAMES   = get_active_staff(df_staff) or get_all_names_fallback(df_leave, df_travel, df_att)
+    ALL_NAMES   = get_active_staff(df_staff) or get_all_names_fallback(df_leave, df_travel, get_data("cache_att"))
 
     st.info(f"📂 ข้อมูลการลาปัจจุบัน: **{len(df_leave)} รายการ**  "
             f"{'(file ID: ' + _leave_fid[:8] + '...)' if _leave_fid else '⚠️ ยังไม่มีไฟล์ใน Drive'}")
@@ -3005,11 +5070,12 @@ elif menu == "🕒 บันทึกการลา":
         l_submit = st.form_submit_button("💾 บันทึกการลา", use_container_width=True, type="primary")
 
         if l_submit:
-            days_req = count_weekdays(l_start, l_end)
+            days_req = get_business_calendar().count(l_start, l_end)   # หักวันหยุดราชการด้วย
             errors   = validate_leave_data(l_name, l_start, l_end, l_reason, df_leave)
 
             # [S4] ตรวจสอบ quota
-            quota_msg = check_leave_quota(l_name, l_type, days_req, df_leave, l_start.year) if l_name else None
+            quota_msg = check_leave_quota(l_name, l_type, days_req, df_leave, l_start.year,
+                                          ledger=get_quota_ledger()) if l_name else None
             if quota_msg and quota_msg.startswith("❌"):
                 errors.append(quota_msg)
 
@@ -3021,14 +5087,13 @@ elif menu == "🕒 บันทึกการลา":
                     st.warning(quota_msg)
 
                 with st.status("กำลังบันทึก...", expanded=True) as status:
+                    upload_id = None
                     try:
                         link = "-"
-                        if l_file:
-                            st.write("📤 อัปโหลดไฟล์...")
-                            fid = get_or_create_folder(ATTACHMENT_FOLDER_NAME, FOLDER_ID)
-                            if fid:
-                                fn = f"LEAVE_{l_name}_{dt.datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
-                                link = upload_pdf_to_drive(l_file, fn, fid)
+                        if l_file:   # [Attach] เก็บลงเครื่องก่อน — อัปโหลดเบื้องหลังหลังบันทึกแถว
+                            upload_id = spool_attachment(l_file)
+                            fn   = f"LEAVE_{l_name}_{dt.datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
+                            link = pending_attachment_link(upload_id)
 
                         st.write("💾 บันทึกข้อมูล...")
                         new_rec = {
@@ -3037,10 +5102,11 @@ elif menu == "🕒 บันทึกการลา":
                             "วันที่เริ่ม": pd.to_datetime(l_start), "วันที่สิ้นสุด": pd.to_datetime(l_end),
                             "จำนวนวันลา": days_req, "เหตุผล": l_reason, "ไฟล์แนบ": link,
                         }
-                        backup_excel(FILE_LEAVE, df_leave)
-                        df_upd = pd.concat([df_leave, pd.DataFrame([new_rec])], ignore_index=True)
-
-                        if write_excel_to_drive(FILE_LEAVE, df_upd, known_file_id=_leave_fid):
+                        # [Journal] บันทึกเป็น delta เล็ก ๆ — ไม่อัปโหลด leave_report ทั้งไฟล์
+                        delta_id = append_delta_rows(FILE_LEAVE, [new_rec])
+                        if delta_id:
+                            if upload_id: queue_attachment(upload_id, fn, FILE_LEAVE, delta_id); upload_id = None
+                            cache_apply_rows("leave", pd.DataFrame([new_rec]), delta_id=delta_id)
                             # [N1] LINE Notify
                             st.write("🔔 ส่งแจ้งเตือน LINE...")
                             sent = send_line_notify(format_leave_notify(new_rec))
@@ -3056,6 +5122,7 @@ elif menu == "🕒 บันทึกการลา":
                     except Exception as e:
                         logger.error(f"leave form: {e}")
                         status.update(label=f"❌ {e}", state="error")
+                    if upload_id: discard_attachment(upload_id)   # แถวไม่ถูกบันทึก → ไม่อัปโหลด
 
     st.divider()
     st.subheader("📋 รายการล่าสุด")
@@ -3073,23 +5140,26 @@ elif menu == "🕒 บันทึกการลา":
 elif menu == "📈 วันลาคงเหลือ":
     st.markdown('<div class="section-header">📈 สิทธิ์วันลาคงเหลือ</div>', unsafe_allow_html=True)
 
-    _ensure_data_loaded()  # [I1]
+    _ensure_data_loaded(("leave",))  # [I1]
     df_leave  = get_data("cache_leave")
     df_staff  = get_data("cache_staff")
     all_names = get_active_staff(df_staff) or get_all_names_fallback(df_leave, pd.DataFrame(), pd.DataFrame())
 
     selected_year = st.selectbox("ปี (พ.ศ.)", list(range(dt.date.today().year + 543, dt.date.today().year + 540, -1)))
     year_ad = selected_year - 543
+    use_archive = fiscal_year_be(dt.date(year_ad, 1, 1)) < hot_fiscal_year_min()   # [FY] ปีที่เริ่มในปีงบที่ย้ายเข้าคลังแล้ว
+    if use_archive: df_leave = get_data("cache_leave_all")
 
     selected_person = st.selectbox("เลือกบุคลากร (ว่าง = ดูทุกคน)", ["— ทุกคน —"] + all_names)
     names_to_show = all_names if selected_person == "— ทุกคน —" else [selected_person]
 
+    ledger = get_quota_ledger(all_years=use_archive)   # [S4] lookup O(1) ต่อ (คน, ประเภท) ไม่ scan df_leave
     quota_rows = []
     for name in names_to_show:
         row = {"ชื่อ-สกุล": name}
         has_alert = False
         for ltype, quota in LEAVE_QUOTA.items():
-            used      = get_leave_used(name, ltype, df_leave, year_ad)
+            used      = get_leave_used(name, ltype, df_leave, year_ad, ledger)
             remaining = max(0, quota - used)
             indicator, _ = get_quota_status(used, quota)
             row[f"{ltype}_ใช้"] = used
@@ -3107,7 +5177,7 @@ elif menu == "📈 วันลาคงเหลือ":
         st.subheader(f"📊 สิทธิ์ลาของ {selected_person} ปี {selected_year}")
         cols_q = st.columns(len(LEAVE_QUOTA))
         for i, (ltype, quota) in enumerate(LEAVE_QUOTA.items()):
-            used = get_leave_used(selected_person, ltype, df_leave, year_ad)
+            used = get_leave_used(selected_person, ltype, df_leave, year_ad, ledger)
             remaining = max(0, quota - used)
             indicator, badge_cls = get_quota_status(used, quota)
             with cols_q[i % len(cols_q)]:
@@ -3142,9 +5212,10 @@ elif menu == "📈 วันลาคงเหลือ":
 elif menu == "👤 จัดการบุคลากร":
     st.markdown('<div class="section-header">👤 จัดการฐานข้อมูลบุคลากร</div>', unsafe_allow_html=True)
 
-    _ensure_data_loaded()  # [I1]
-    df_staff    = get_data("cache_staff")
-    _staff_fid  = st.session_state.get("_fid_staff")
+    _ensure_data_loaded(("staff",))  # [I1]
+    df_staff    = _thaw(get_data("cache_staff"))   # ตารางใน snapshot แชร์ทุก session — แก้บนสำเนา
+    _staff_fid  = _cache_value("_fid_staff")
+    _staff_ver  = _cache_value(_read_version_key(FILE_STAFF))   # [OCC] เวอร์ชันที่ cache โหลดมา
 
     if df_staff.empty:
         df_staff = pd.DataFrame(columns=STAFF_MASTER_COLS)
@@ -3211,7 +5282,9 @@ elif menu == "👤 จัดการบุคลากร":
                         "วันเริ่มงาน": str(s_start), "สถานะ": s_status,
                     }
                     df_staff = pd.concat([df_staff, pd.DataFrame([new_staff])], ignore_index=True)
-                    if write_excel_to_drive(FILE_STAFF, df_staff, known_file_id=_staff_fid):
+                    if write_excel_to_drive(FILE_STAFF, df_staff, known_file_id=_staff_fid, write_through=True,
+                                            base_version=_staff_ver, merge_key=["ชื่อ-สกุล"]):
+                        cache_replace_dataset("staff", df_staff)
                         log_activity("เพิ่มบุคลากร", f"เพิ่ม {s_name} ({s_group})", s_name)
                         st.toast(f"✅ เพิ่ม {s_name} สำเร็จ", icon="✅")
                         st.rerun()
@@ -3243,7 +5316,9 @@ elif menu == "👤 จัดการบุคลากร":
                         df_staff.at[idx,"ตำแหน่ง"]         = e_pos
                         df_staff.at[idx,"ประเภทบุคลากร"]   = e_type
                         df_staff.at[idx,"สถานะ"]           = e_status
-                        if write_excel_to_drive(FILE_STAFF, df_staff, known_file_id=_staff_fid):
+                        if write_excel_to_drive(FILE_STAFF, df_staff, known_file_id=_staff_fid, write_through=True,
+                                                base_version=_staff_ver, merge_key=["ชื่อ-สกุล"]):
+                            cache_replace_dataset("staff", df_staff)
                             log_activity("แก้ไขบุคลากร", f"อัปเดตข้อมูล {edit_name} สถานะ→{e_status}", edit_name)
                             st.toast(f"✅ อัปเดต {edit_name} สำเร็จ", icon="✅")
                             st.rerun()
@@ -3258,26 +5333,24 @@ elif menu == "👤 จัดการบุคลากร":
 elif menu == "🔔 กิจกรรมล่าสุด":
     st.markdown('<div class="section-header">🔔 กิจกรรมล่าสุดในระบบ</div>', unsafe_allow_html=True)
 
-    # กิจกรรมล่าสุด: อ่านสดจาก Drive (ไม่ใช้ cache เพราะต้องการข้อมูล realtime)
-    df_log = read_excel_from_drive(FILE_NOTIFY)
+    # กิจกรรมล่าสุด: index คลัง log (เล็ก) → อ่านเฉพาะไฟล์เดือนที่ต้องใช้ + event ที่ยังรอ flush ในเครื่อง
+    df_idx, _ = activity_archive()
+    type_opts = sorted({t for ts in df_idx["types"] for t in ts.split("|") if t} | {"การลา", "ไปราชการ"})
+    col_f1, col_f2, col_f3 = st.columns(3)
+    with col_f1:
+        filter_type = st.selectbox("กรองตามประเภท", ["ทั้งหมด"] + type_opts)
+    with col_f2:
+        search_name = st.text_input("ค้นหาชื่อ")
+    with col_f3:
+        filter_seg = st.selectbox("เดือน", ["ล่าสุด"] + df_idx["segment"].tolist())
+    if not df_idx.empty:
+        st.caption(f"🗄️ คลัง {len(df_idx)} เดือน | {int(pd.to_numeric(df_idx['rows'], errors='coerce').sum()):,} รายการ")
 
-    if df_log.empty:
+    df_show = read_activity_feed(50, "" if filter_type == "ทั้งหมด" else filter_type, search_name.strip(),
+                                 "" if filter_seg == "ล่าสุด" else filter_seg)
+    if df_show.empty:
         st.info("ยังไม่มีกิจกรรมในระบบ กิจกรรมจะถูกบันทึกเมื่อมีการบันทึกการลาหรือไปราชการ")
     else:
-        df_log = df_log.sort_values("Timestamp", ascending=False).head(50)
-
-        col_f1, col_f2 = st.columns(2)
-        with col_f1:
-            filter_type = st.selectbox("กรองตามประเภท", ["ทั้งหมด"] + df_log["ประเภท"].dropna().unique().tolist())
-        with col_f2:
-            search_name = st.text_input("ค้นหาชื่อ")
-
-        df_show = df_log
-        if filter_type != "ทั้งหมด":
-            df_show = df_show[df_show["ประเภท"] == filter_type]
-        if search_name:
-            df_show = df_show[df_show["ผู้เกี่ยวข้อง"].str.contains(search_name, na=False)]
-
         TYPE_ICONS = {"การลา": "🕒", "ไปราชการ": "✈️", "เพิ่มบุคลากร": "➕", "แก้ไขบุคลากร": "✏️"}
 
         for _, row in df_show.iterrows():
@@ -3303,8 +5376,9 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
     password=st.text_input("🔑 รหัสผ่าน Admin",type="password")
     if password and check_admin_password(password):
         st.success("✅ เข้าสู่ระบบสำเร็จ")
+        _ensure_data_loaded(("leave","travel","att","manual"))
         df_leave=_dc("cache_leave"); df_travel=_dc("cache_travel"); df_att=_dc("cache_att"); df_staff=_dc("cache_staff")
-        _fid_leave=st.session_state.get("_fid_leave"); _fid_travel=st.session_state.get("_fid_travel"); _fid_staff=st.session_state.get("_fid_staff")
+        _fid_leave=_cache_value("_fid_leave"); _fid_travel=_cache_value("_fid_travel"); _fid_staff=_cache_value("_fid_staff")
         _fid_map={FILE_LEAVE:_fid_leave,FILE_TRAVEL:_fid_travel,FILE_STAFF:_fid_staff,FILE_ATTEND:None}
         tab1,tab2,tab3,tab4,tab5,tab6,tab_hol=st.tabs(["📂 ไฟล์ลา","📂 ไฟล์ราชการ","📂 ไฟล์สแกนนิ้ว","📂 ไฟล์บุคลากร","🔧 ตั้งค่า","👆 คีย์สแกน","🎌 วันหยุด"])
         def _df_for_display(df: pd.DataFrame) -> pd.DataFrame:
@@ -3321,9 +5395,16 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
             return df2
 
         def admin_file_panel(df, filename, tab_obj):
+            df = df.drop(columns=[c for c in DERIVED_COLS if c in df.columns])
             with tab_obj:
+                _meta = get_file_meta(filename)
+                _fid = _meta["id"] if _meta else _fid_map.get(filename)
+                # เวอร์ชันที่ admin เห็นในรอบแสดงผลก่อนกดปุ่ม → base_version ของการเขียนทับ/ย้อนเวอร์ชัน
+                _seen_key = f"seen_ver_{filename}"
+                _seen_ver = st.session_state.get(_seen_key)
+                st.session_state[_seen_key] = (_meta or {}).get("modifiedTime")
                 st.subheader(f"ไฟล์: {filename}")
-                st.caption(f"File ID: `{_fid_map.get(filename,'—')}`")
+                st.caption(f"File ID: `{_fid or '—'}`")
                 if df.empty:
                     st.warning("⚠️ ไม่มีข้อมูล")
                 else:
@@ -3347,19 +5428,109 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
                         st.info(f"{len(new_df)} แถว, {len(new_df.columns)} คอลัมน์")
                         st.dataframe(new_df.head(3))
                         if st.button("✅ ยืนยันอัปโหลด", key=f"confirm_{filename}", type="primary"):
-                            backup_excel(filename, df)
-                            if write_excel_to_drive(filename, new_df, known_file_id=_fid_map.get(filename)):
+                            _ok, _base = prepare_overwrite(filename, _fid, _seen_ver) if _fid else (True, None)   # [Rev] รวม delta + ปักรุ่นก่อนเขียนทับ
+                            if _ok and write_excel_to_drive(filename, new_df, known_file_id=_fid, base_version=_base):
+                                _reset_after_overwrite(filename)
                                 st.toast("✅ อัปเดตสำเร็จ", icon="✅")
                                 time.sleep(1)
                                 st.rerun()
                     except Exception as e:
                         st.error(f"❌ อ่านไฟล์ไม่ได้: {e}")
+                with st.expander("🕰️ ย้อนกลับเป็นเวอร์ชันก่อนหน้า (Drive revisions)"):
+                    _rev_fid = _fid
+                    _revs = list(reversed(list_revisions(_rev_fid))) if _rev_fid else []
+                    if not _revs: st.caption("ยังไม่มีประวัติเวอร์ชัน")
+                    else:
+                        st.caption(f"{len(_revs)} เวอร์ชัน | 📌 = เก็บถาวร ({sum(bool(r.get('keepForever')) for r in _revs)}/{_REVISION_KEEP_MAX}) — เวอร์ชันที่ไม่ปักจะถูก Drive ลบเองหลังราว 30 วัน")
+                        _rev_lbl = {r["id"]: f"{'📌 ' if r.get('keepForever') else ''}{str(r.get('modifiedTime',''))[:19].replace('T',' ')} UTC"
+                                             f" — {(r.get('lastModifyingUser') or {}).get('displayName','-')}" for r in _revs}
+                        _rev_id = st.selectbox("เวอร์ชัน", list(_rev_lbl), format_func=_rev_lbl.get, key=f"rev_{filename}")
+                        if st.checkbox("👁️ ดูตัวอย่าง", key=f"rev_prev_{filename}"):
+                            _df_rev = read_revision(_rev_fid, _rev_id)
+                            st.dataframe(_df_for_display(_df_rev.head(20)), use_container_width=True)
+                            st.caption(f"{len(_df_rev)} แถว (ปัจจุบัน {len(df)} แถว)")
+                        if st.button("♻️ ย้อนกลับเป็นเวอร์ชันนี้", key=f"rev_restore_{filename}", type="primary"):
+                            if restore_revision(filename, _rev_fid, _rev_id, _seen_ver):
+                                log_activity("ย้อนเวอร์ชันไฟล์", f"{filename} → {_rev_lbl[_rev_id]}")
+                                st.toast("✅ ย้อนเวอร์ชันสำเร็จ", icon="✅")
+                                time.sleep(1)
+                                st.rerun()
         admin_file_panel(df_leave,FILE_LEAVE,tab1); admin_file_panel(df_travel,FILE_TRAVEL,tab2)
         admin_file_panel(read_attendance_report(),FILE_ATTEND,tab3); admin_file_panel(df_staff,FILE_STAFF,tab4)
         with tab5:
             st.subheader("🔧 ตั้งค่าและ Debug")
             st.info(f"FOLDER_ID: `{FOLDER_ID}`\nFILE_ATTEND: `{FILE_ATTEND}`")
 
+            st.divider()
+            st.subheader("🧾 Delta journal (การลา / ไปราชการ)")
+            _pending = {f: len(v) for f, v in list_delta_files().items()}
+            st.caption(" | ".join(f"{f}: ค้าง {n} รายการ" for f, n in _pending.items())
+                       + f" — รวมเข้าไฟล์หลักอัตโนมัติเมื่อค้าง ≥ {_DELTA_COMPACT_MIN} หรือเก่าเกิน {_DELTA_COMPACT_AGE_SEC//3600} ชม.")
+            if st.button("🗜️ รวม delta เข้าไฟล์หลักตอนนี้", key="btn_compact_delta", disabled=not any(_pending.values())):
+                with st.spinner("กำลังรวม delta..."):
+                    _n = sum(compact_delta_journal(f, force=True) for f in DELTA_TARGETS)
+                st.success(f"✅ รวม {_n} delta เข้าไฟล์หลักแล้ว")
+
+            st.divider()
+            st.subheader("🗃️ คลังปีงบประมาณ (การลา / ไปราชการ)")
+            _arc = {f: sorted(list_fy_archives(f)[0]) for f in DELTA_TARGETS}
+            st.caption(f"ไฟล์หลักเก็บปีงบ {hot_fiscal_year_min()} ขึ้นไป | "
+                       + " | ".join(f"{f}: คลัง {', '.join(map(str, y)) or '—'}" for f, y in _arc.items()))
+            if st.button("📦 ย้ายปีงบเก่าเข้าคลังตอนนี้", key="btn_fy_archive"):
+                with st.spinner("กำลังย้ายปีงบเก่า..."):
+                    _moved = {f: archive_closed_fiscal_years(f) for f in DELTA_TARGETS}
+                if any(v is None for v in _moved.values()): st.warning("⚠️ มีงานเขียนไฟล์อื่นทำอยู่ หรือเขียนไม่สำเร็จ — ลองใหม่ภายหลัง")
+                st.success("✅ " + " | ".join(f"{f}: ย้าย {v or 0} แถว" for f, v in _moved.items()))
+
+            st.divider()
+            st.subheader("🧊 คลังสแกนนิ้ว (เดือนที่ปิดแล้ว)")
+            _att_idx = att_archive()[0]
+            _cube_v  = load_att_kpi_archive()[1]
+            st.caption(f"ไฟล์ร้อนเก็บเฉพาะเดือน {dt.date.today().strftime('%Y-%m')} | คลัง {len(_att_idx)} เดือน "
+                       f"({int(pd.to_numeric(_att_idx['rows'], errors='coerce').sum())} แถว) | "
+                       f"cube สรุป: {'ตรงเวอร์ชัน' if _cube_v and _cube_v == _att_inputs_version(_dc('cache_staff'), _dc('cache_manual'), _att_idx['เดือน']) else 'ต้องสรุปใหม่'}")
+            if not _att_idx.empty: st.dataframe(_att_idx, use_container_width=True)
+            if st.button("🧊 ย้ายเดือนที่ปิดแล้ว + สรุป cube ใหม่", key="btn_att_archive"):
+                with st.spinner("กำลังย้ายข้อมูลสแกนเข้าคลัง..."):
+                    _moved = compact_attendance_archive(force_cube=True)
+                if _moved is None: st.warning("⚠️ มีงานย้ายคลังทำอยู่ หรือเขียนไม่สำเร็จ — ลองใหม่ภายหลัง")
+                else:
+                    if _moved: _invalidate_cache(FILE_DATASETS[FILE_ATTEND])
+                    st.success(f"✅ ย้าย {len(_moved)} เดือน ({', '.join(_moved) or '—'})")
+
+            st.divider()
+            st.subheader("📎 คิวอัปโหลดไฟล์แนบ")
+            _jobs = list_attachment_jobs()
+            st.caption(f"รอ {sum(not j.get('failed') for j in _jobs)} | หยุดแล้ว {sum(bool(j.get('failed')) for j in _jobs)} — `{ATTACHMENT_SPOOL_DIR}`")
+            if _jobs:
+                st.dataframe(pd.DataFrame([{"ไฟล์": j["name"], "บันทึกใน": j["target"], "อัปโหลดแล้ว": bool(j.get("link")),
+                                            "ครั้งที่ล้ม": j.get("attempts", 0), "ข้อผิดพลาด": j.get("error", "")} for j in _jobs]),
+                             use_container_width=True)
+                if st.button("🔁 ลองอัปโหลดใหม่ทั้งหมด", key="btn_attach_retry"):
+                    st.success(f"✅ ส่ง {retry_attachment_jobs()} งานกลับเข้าคิวแล้ว")
+
+            st.divider()
+            st.subheader("🗄️ Local store (SQLite)")
+            _ls = _local_store()
+            st.dataframe(pd.DataFrame([{"ตาราง": n, "แถว": _ls["rows"].get(n, 0), "เวอร์ชันใน store": str(_ls["tokens"].get(n, "—")),
+                                        "เวอร์ชัน snapshot": str(dataset_version(n)) if n != "holidays" else "—"}
+                                       for n in LOCAL_STORE_TABLES]), use_container_width=True)
+            st.caption(f"`{LOCAL_STORE_PATH}` — ซิงก์ล่าสุด: {_ls['synced_at'].strftime('%H:%M:%S') if _ls['synced_at'] else '—'}"
+                       + (f" | ⚠️ {_ls['error']}" if _ls["error"] else ""))
+            if st.button("🔁 ซิงก์ store ตอนนี้", key="btn_sync_store"):
+                with st.spinner("กำลังซิงก์..."):
+                    _done = sync_local_store()
+                st.success(f"✅ ซิงก์แล้ว: {', '.join(_done) or 'ทุกตารางเป็นปัจจุบัน'}")
+
+            st.divider()
+            st.subheader("🔐 การเขียนไฟล์พร้อมกัน (optimistic concurrency)")
+            _wm = _write_metrics()
+            _wc = st.columns(4)
+            _wc[0].metric("เขียนสำเร็จ", _wm["writes"]); _wc[1].metric("ชนกัน (conflict)", _wm["conflicts"])
+            _wc[2].metric("แถวที่ merge ให้", _wm["merged_rows"]); _wc[3].metric("ยกเลิก", _wm["aborted"])
+            if _wm["by_file"]:
+                st.caption("conflict รายไฟล์: " + " | ".join(f"{f}: {n}" for f, n in sorted(_wm["by_file"].items())))
+
             st.divider()
             st.subheader("🔍 Debug ไฟล์สแกนนิ้ว (attendance_report.xlsx)")
             st.caption("ใช้เพื่อตรวจสอบว่าโค้ดอ่านไฟล์ถูกต้องหรือไม่")
@@ -3420,7 +5591,7 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
                         st.error(f"❌ เกิดข้อผิดพลาด: {e}")
         with tab6:
             st.subheader("👆 บันทึกเวลาทำการสำหรับผู้ที่ลืมสแกนนิ้ว")
-            df_manual_tab=_dc("cache_manual"); _manual_fid=get_file_id(FILE_MANUAL_SCAN)
+            df_manual_tab=_dc("cache_manual")
             with st.form("form_manual_scan"):
                 ms_name=st.selectbox("ชื่อ-สกุล *",get_active_staff(df_staff))
                 ms_date=st.date_input("วันที่ลืมสแกน *",value=dt.date.today(),max_value=dt.date.today())
@@ -3428,11 +5599,25 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
                 ms_time_in=c_t1.time_input("เวลาเข้างาน *",value=dt.time(8,30))
                 ms_time_out=c_t2.time_input("เวลาออกงาน *",value=dt.time(16,30))
                 if st.form_submit_button("💾 บันทึกข้อมูลสแกนนิ้ว",type="primary"):
-                    new_row={"ชื่อ-สกุล":ms_name,"วันที่":pd.to_datetime(ms_date),"เวลาเข้า":ms_time_in.strftime("%H:%M"),"เวลาออก":ms_time_out.strftime("%H:%M"),"หมายเหตุ":f"Admin คีย์แทน — {dt.datetime.now().strftime('%d/%m/%Y %H:%M')}"}
-                    df_manual_upd=pd.concat([df_manual_tab,pd.DataFrame([new_row])],ignore_index=True)
-                    if write_excel_to_drive(FILE_MANUAL_SCAN,df_manual_upd,known_file_id=_manual_fid):
+                    new_row={"ชื่อ-สกุล":ms_name,"วันที่":pd.to_datetime(ms_date),"เวลาเข้า":ms_time_in.strftime("%H:%M"),"เวลาออก":ms_time_out.strftime("%H:%M"),"หมายเหตุ":f"Admin คีย์แทน — {dt.datetime.now().strftime('%d/%m/%Y %H:%M')}","_op":MANUAL_OP_ADD}
+                    if append_manual_scan_ops([new_row]):
                         log_activity("คีย์สแกนนิ้ว",f"Admin คีย์ {ms_date} เข้า {ms_time_in.strftime('%H:%M')} ออก {ms_time_out.strftime('%H:%M')}",ms_name)
                         st.toast("✅ บันทึกสแกนนิ้วสำเร็จ",icon="✅"); time.sleep(1); st.rerun()
+            if not df_manual_tab.empty:
+                with st.expander(f"🗑️ ลบรายการที่คีย์แทน ({len(df_manual_tab)} รายการ)"):
+                    _ms_opts=(df_manual_tab["ชื่อ-สกุล"].astype(str)+" | "+pd.to_datetime(df_manual_tab["วันที่"]).dt.strftime("%Y-%m-%d")).tolist()
+                    ms_del=st.selectbox("เลือกรายการ",_ms_opts,key="ms_del_pick")
+                    if st.button("🗑️ ลบรายการนี้",key="btn_ms_del"):
+                        _nm,_d=ms_del.rsplit(" | ",1)
+                        if append_manual_scan_ops([{"ชื่อ-สกุล":_nm,"วันที่":pd.to_datetime(_d),"_op":MANUAL_OP_DEL}]):
+                            log_activity("ลบสแกนนิ้ว",f"Admin ลบ {_d}",_nm)
+                            st.toast("✅ ลบสำเร็จ",icon="🗑️"); time.sleep(1); st.rerun()
+            with st.expander("📥 ย้ายข้อมูลสแกนนิ้วเก่าจาก Activity Log (ครั้งเดียว)"):
+                st.caption("นำรายการ คีย์สแกนนิ้ว/ลบสแกนนิ้ว ที่ยังเหลือใน activity_log.xlsx เข้า manual_scan.xlsx — รายการซ้ำจะถูกรวมตามลำดับเวลา")
+                if st.button("📥 ย้ายข้อมูล",key="btn_ms_migrate"):
+                    _ops=manual_scans_from_activity_log(read_excel_from_drive(FILE_NOTIFY))
+                    if not _ops: st.info("ไม่พบรายการใน Activity Log")
+                    elif append_manual_scan_ops(_ops): st.success(f"✅ ย้ายข้อมูล {len(_ops)} รายการ")
         with tab_hol:
             st.subheader("🎌 จัดการวันหยุดพิเศษ / วันหยุดราชการ")
             st.caption(
@@ -3452,7 +5637,7 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
                 hol_show_fixed = st.checkbox("แสดงวันหยุดราชการตายตัว (กำหนดโดยระบบ)", value=True, key="hol_show_fixed")
 
             # โหลดข้อมูล
-            df_hol_custom, _hol_fid = load_holidays_with_id()
+            df_hol_custom, _hol_fid, _hol_ver = load_holidays_with_id()
             df_hol_fixed  = get_fixed_holidays_for_year(hol_view_year_ad)
 
             if hol_show_fixed:
@@ -3556,7 +5741,8 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
                             [df_hol_custom, pd.DataFrame([new_hol])], ignore_index=True
                         ).sort_values("วันที่").reset_index(drop=True)
 
-                        if write_excel_to_drive(FILE_HOLIDAYS, df_hol_new, known_file_id=_hol_fid):
+                        if write_excel_to_drive(FILE_HOLIDAYS, df_hol_new, known_file_id=_hol_fid,
+                                                base_version=_hol_ver, merge_key=["วันที่","ชื่อวันหยุด"]):
                             log_activity(
                                 "เพิ่มวันหยุดพิเศษ",
                                 f"{ha_name} ({ha_date.strftime('%d/%m/%Y')}) ประเภท {ha_type}",
@@ -3599,7 +5785,7 @@ elif menu == "⚙️ ผู้ดูแลระบบ":
                         idx_del = df_hol_del[df_hol_del["label"] == del_hol_label].index.tolist()
                         if idx_del:
                             df_hol_after = df_hol_custom_fresh.drop(index=idx_del).reset_index(drop=True)
-                            if write_excel_to_drive(FILE_HOLIDAYS, df_hol_after, known_file_id=_hol_fid):
+                            if write_excel_to_drive(FILE_HOLIDAYS, df_hol_after, known_file_id=_hol_fid, base_version=_hol_ver):
                                 log_activity("ลบวันหยุดพิเศษ", del_hol_label, "Admin")
                                 st.toast("✅ ลบวันหยุดสำเร็จ", icon="🗑️")
                                 st.cache_data.clear()
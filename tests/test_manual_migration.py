@@ -0,0 +1,109 @@
+"""
+ย้าย op สแกนนิ้วจาก activity_log เดิมเข้า manual_scan store — scan ที่ลบแล้วต้องไม่กลับมาหลัง compaction + restart
+
+app.py เป็นสคริปต์ Streamlit (import แล้วรันหน้าเว็บ) → ดึงเฉพาะฟังก์ชันที่ทดสอบด้วย ast แล้วแทนชั้น Drive ด้วยไฟล์ในหน่วยความจำ
+"""
+import ast
+import datetime as dt
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+NAMES = {
+    "MANUAL_SCAN_COLS", "MANUAL_SCAN_STORE_COLS", "MANUAL_OP_ADD", "MANUAL_OP_DEL", "MANUAL_MIGRATED_PROP",
+    "_coerce_manual_store", "_latest_manual_ops", "resolve_manual_scans", "compact_manual_store",
+    "_parse_manual_scan_detail", "_parse_delete_scan_detail", "manual_scans_from_activity_log",
+    "append_manual_scan_ops", "migrate_legacy_manual_scans", "_mark_manual_migrated",
+}
+PERSON = "นาย ทดสอบ ระบบ"
+LEGACY_LOG = pd.DataFrame({
+    "Timestamp": ["2024-01-05 10:00:00"], "ประเภท": ["คีย์สแกนนิ้ว"],
+    "รายละเอียด": ["Admin คีย์ 2024-01-03 เข้า 08:30 ออก 16:30"], "ผู้เกี่ยวข้อง": [PERSON],
+})
+
+
+class FakeDrive:
+    """manual_scan.xlsx บน Drive: เนื้อหา + modifiedTime + appProperties (คงอยู่ข้าม process)"""
+    def __init__(self):
+        self.df, self.props, self.rev = None, {}, 0
+
+    def meta(self, filename, parent_id=None, sidecar=False):
+        if filename != "manual_scan.xlsx" or self.df is None: return None
+        return {"id": "fid", "name": filename, "modifiedTime": f"t{self.rev}", "appProperties": dict(self.props)}
+
+    def write(self, filename, df, known_file_id=None, write_through=False, parent_id=None, base_version=None,
+              merge_key=None, sidecar=None):
+        if base_version is not None and base_version != f"t{self.rev}": return False
+        self.df, self.rev = df.copy(), self.rev + 1
+        return True
+
+    def update(self, fileId, body, supportsAllDrives=True, fields=""):
+        self.props.update(body.get("appProperties") or {}); self.rev += 1
+        return {"id": fileId}
+
+
+class _Cleared:
+    def __init__(self, fn): self.fn = fn
+    def __call__(self, *a, **k): return self.fn(*a, **k)
+    def clear(self, *a, **k): pass
+
+
+def start_process(drive: FakeDrive) -> dict:
+    """namespace ใหม่ = process ใหม่ (state ระดับ process เริ่มว่าง) บน Drive เดิม"""
+    tree = ast.parse(open(APP, encoding="utf-8").read())
+    nodes = []
+    for n in tree.body:
+        if isinstance(n, ast.FunctionDef): name = n.name
+        elif isinstance(n, ast.Assign): name = getattr(n.targets[0], "id", None)
+        else: continue
+        if name in NAMES:
+            if isinstance(n, ast.FunctionDef): n.decorator_list = []
+            nodes.append(n)
+    state = {"lock": threading.Lock(), "done": False}
+    versioned = lambda filename: ((drive.df.copy(), "fid", f"t{drive.rev}") if drive.df is not None else (pd.DataFrame(), None, None))
+    ns = dict(
+        np=np, pd=pd, dt=dt, re=re, threading=threading, Dict=Dict, List=List, Optional=Optional, Tuple=Tuple,
+        logger=logging.getLogger("test"), FILE_MANUAL_SCAN="manual_scan.xlsx", FILE_NOTIFY="activity_log.xlsx",
+        _MANUAL_COMPACT_MIN_DEAD=1, _manual_migration_state=lambda: state, _wants_sidecar=lambda f: False,
+        get_file_meta=drive.meta, read_file_meta=lambda meta, sidecar=None: drive.df.copy(),
+        read_excel_versioned=versioned, read_excel_from_drive=lambda f: LEGACY_LOG.copy(),
+        write_excel_to_drive=drive.write, _drive_execute=lambda fn: fn(),
+        get_drive_service=lambda: type("Svc", (), {"files": lambda self: drive})(),
+        load_manual_scan_store=_Cleared(lambda: None), load_manual_scans=_Cleared(lambda: None),
+        cache_replace_dataset=lambda name, df: None,
+    )
+    exec(compile(ast.Module(nodes, []), APP, "exec"), ns)
+    return ns
+
+
+def live_scans(ns: dict, drive: FakeDrive) -> pd.DataFrame:
+    return ns["resolve_manual_scans"](ns["_coerce_manual_store"](drive.df))
+
+
+def test_deleted_legacy_scan_stays_deleted_after_compaction_and_restart():
+    drive = FakeDrive()
+    ns = start_process(drive)
+    assert ns["migrate_legacy_manual_scans"]() == 1                      # add (จาก activity_log)
+    assert len(live_scans(ns, drive)) == 1
+    assert drive.props.get(ns["MANUAL_MIGRATED_PROP"])
+    day = pd.Timestamp("2024-01-03")
+    assert ns["append_manual_scan_ops"]([{"ชื่อ-สกุล": PERSON, "วันที่": day, "_op": "del"}])   # delete → compact
+    assert drive.df.empty                                                 # compaction ตัดทั้ง add และ tombstone
+    ns = start_process(drive)                                             # restart
+    assert ns["migrate_legacy_manual_scans"]() == 0
+    assert live_scans(ns, drive).empty
+
+
+def test_migration_is_idempotent_within_store():
+    drive = FakeDrive()
+    assert start_process(drive)["migrate_legacy_manual_scans"]() == 1
+    drive.props.clear()                                                   # จดไม่สำเร็จ → เทียบ store ซ้ำ ไม่เกิดแถวซ้ำ
+    ns = start_process(drive)
+    assert ns["migrate_legacy_manual_scans"]() == 0
+    assert len(drive.df) == 1